@@ -0,0 +1,6 @@
+"""
+URLconf of requests served by the ASGI handler, see `core.middleware.AsyncViewsMiddleware`
+"""
+from core.urls import build_urlpatterns
+
+urlpatterns = build_urlpatterns(async_reads=True)
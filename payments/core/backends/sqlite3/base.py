@@ -0,0 +1,32 @@
+"""
+SQLite backend for concurrent workers, e.g. of edge nodes, configured by OPTIONS of the database:
+
+    'pragmas': PRAGMA statements, that are run on every new connection, e.g. {'journal_mode': 'WAL'}
+    'transaction_mode': mode of transactions of atomic blocks, e.g. 'IMMEDIATE'
+
+In the default DEFERRED mode a transaction takes the write lock with its first write, and if another transaction
+writes first, the one, that has read already, can not wait for it and fails with "database is locked" at once.
+IMMEDIATE transactions take the write lock when they begin, so they wait for each other up to the busy timeout.
+Other OPTIONS are arguments of `sqlite3.connect`, as they are for the Django backend.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = kwargs.pop('pragmas', {})
+        self.transaction_mode = kwargs.pop('transaction_mode', None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute('BEGIN {}'.format(self.transaction_mode))
@@ -0,0 +1,166 @@
+"""
+Cache of account representations and of account ids of owners, that is used by account read endpoints.
+
+Every cached value is stored together with versions of change counters of its keys (`ChangeCounter`), that are
+read from the database before the value, and it is valid only while they are the same. Counters are incremented
+in transactions of transfers and of other changes of accounts, so a value is never returned once a change of it
+is committed, whichever process made it, and a value read before the change and cached after it is never returned
+either. Every lookup reads the counters of the slots of its keys only, with one query per shard of its accounts,
+see `core.sharding`, and a hit saves the query of accounts and their serialization.
+Values are also invalidated write-through: transfers and changes of accounts delete them after the commit,
+see `balances_changed`, so the cache keeps no values, that can not be hits anymore. Writes of other processes
+are not seen by the cache of this one, and their values are caught by counters.
+Accounts with balance buckets are not cached, credits to them do not increment counters, see `BalanceBucket`.
+The default cache is in-process, deployments with many processes may share one, e.g. `core.cache.DjangoCache`.
+"""
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core import sharding
+from core.cache import create_cache
+from core.models import Account, BalanceBucket, ChangeCounter
+from core.serializers import AccountSerializer
+from core.signals import balances_changed
+
+_cache = create_cache(settings.BALANCE_CACHE)
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _account_key(account_id: str) -> str:
+    return 'account:' + account_id
+
+
+def _owner_key(owner: str) -> str:
+    return 'owner:' + owner
+
+
+def _read_versions(keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, int], int]:
+    """
+    Current versions of counters of (alias, key) pairs by (alias of the database, slot)
+    """
+    slots = defaultdict(set)
+    for alias, key in keys:
+        slots[alias].add(ChangeCounter.slot_for(key))
+    return {
+        (alias, slot): version
+        for alias, alias_slots in sorted(slots.items())
+        for slot, (version, _) in ChangeCounter.versions(using=alias, slots=alias_slots).items()
+    }
+
+
+def _stamp(versions: Dict[Tuple[str, int], int], keys: Iterable[Tuple[str, str]]) -> tuple:
+    """
+    Versions of counters of (alias, key) pairs, that a value is valid for
+    """
+    slots = sorted({(alias, ChangeCounter.slot_for(key)) for alias, key in keys})
+    return tuple((alias, slot, versions.get((alias, slot), 0)) for alias, slot in slots)
+
+
+def _get(key: str, versions: Dict[Tuple[str, int], int]) -> Optional[object]:
+    """
+    The value cached for current versions of its counters, or None
+    """
+    entry = _cache.get(key)
+    valid = entry is not None and all(
+        versions.get((alias, slot), 0) == version for alias, slot, version in entry[0]
+    )
+    with _stats_lock:
+        _stats['hits' if valid else 'misses'] += 1
+    return entry[1] if valid else None
+
+
+def get_accounts(account_ids: Iterable[str], versions: Optional[Dict[Tuple[str, int], int]] = None) -> List[dict]:
+    """
+    Serialized accounts in the order of `account_ids`, not existing accounts are skipped.
+    `versions` are versions of counters of their shards, if they were already read before the accounts
+    """
+    account_ids = list(account_ids)
+    if not account_ids:
+        return []
+    shards = {account_id: sharding.shard_for(account_id) for account_id in account_ids}
+    if versions is None:
+        versions = _read_versions((shards[account_id], account_id) for account_id in account_ids)
+    accounts = {}
+    missed_ids = defaultdict(list)
+    for account_id in account_ids:
+        data = _get(_account_key(account_id), versions)
+        if data is None:
+            missed_ids[shards[account_id]].append(account_id)
+        else:
+            accounts[account_id] = data
+
+    for alias, ids in missed_ids.items():
+        rows = list(
+            Account.objects.using(alias).filter(pk__in=ids).values_list(*AccountSerializer.fast_columns, 'buckets')
+        )
+        # balances of accounts with buckets include credits pending in them, that do not change versions
+        # of the accounts, so they are read every time
+        pending = BalanceBucket.balances([row[0] for row in rows if row[-1]], alias)
+        representations = AccountSerializer.fast_representation(
+            (pk, owner, balance + pending.get(pk, 0), currency) for pk, owner, balance, currency, _ in rows
+        )
+        for row, data in zip(rows, representations):
+            account_id = row[0]
+            if not row[-1]:
+                _cache.set(_account_key(account_id), (_stamp(versions, [(alias, account_id)]), data))
+            accounts[account_id] = data
+
+    return [accounts[account_id] for account_id in account_ids if account_id in accounts]
+
+
+def get_owner_account_ids(owner: str) -> List[str]:
+    """
+    Ids of accounts of the owner, in every shard
+    """
+    counter_keys = [(alias, ChangeCounter.owner_key(owner)) for alias in sharding.shards()]
+    versions = _read_versions(counter_keys)
+    account_ids = _get(_owner_key(owner), versions)
+    if account_ids is None:
+        rows = sharding.fan_out(Account.objects.filter(owner=owner).order_by('pk').values_list('pk'))
+        account_ids = [pk for pk, in rows]
+        _cache.set(_owner_key(owner), (_stamp(versions, counter_keys), account_ids))
+    return account_ids
+
+
+@receiver(balances_changed, sender=Account)
+def _forget_changed_accounts(sender, account_ids, **kwargs):
+    for account_id in account_ids:
+        _cache.delete(_account_key(account_id))
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def _forget_saved_account(sender, instance, using, **kwargs):
+    account_key, owner_key = _account_key(instance.pk), _owner_key(instance.owner)
+
+    def forget():
+        _cache.delete(account_key)
+        _cache.delete(owner_key)
+    transaction.on_commit(forget, using=using)
+
+
+def stats() -> dict:
+    """
+    Hits and misses of account and owner lookups, and stats of the cache backend
+    """
+    with _stats_lock:
+        result = dict(_stats)
+    backend_stats = _cache.stats()
+    result['evictions'] = backend_stats['evictions']
+    if 'size' in backend_stats:
+        result['size'] = backend_stats['size']
+        result['max_size'] = backend_stats['max_size']
+    return result
+
+
+def clear():
+    _cache.clear()
+    with _stats_lock:
+        _stats.update(hits=0, misses=0)
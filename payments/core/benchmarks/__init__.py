@@ -0,0 +1,150 @@
+"""
+Benchmarks of the payments API, run with `manage.py bench <name>`.
+They never touch the configured database, every run creates and destroys a test database of its own.
+"""
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Callable, List
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.test import APIClient
+
+from core.const import CURRENCY_PHP
+from core.models import Account, Payment
+
+SEED_BATCH_SIZE = 5000
+
+
+@contextmanager
+def temporary_database(on_disk: bool = False):
+    """
+    Test database and environment, set up for the duration of the block like the ones of the test runner,
+    so that the test client can be used and queries are not recorded.
+    SQLite test databases are in memory, unless they are `on_disk`: in a temporary file, as configured databases are
+    """
+    setup_test_environment(debug=False)
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict['TEST']
+    old_test_name = test_settings.get('NAME')
+    directory = None
+    if on_disk and connection.vendor == 'sqlite':
+        directory = tempfile.TemporaryDirectory()
+        test_settings['NAME'] = os.path.join(directory.name, 'bench.sqlite3')
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        if directory is not None:
+            test_settings['NAME'] = old_test_name
+            directory.cleanup()
+
+
+def seed_accounts(count: int, owners: int = 100, balance: Decimal = Decimal(1000000)) -> List[str]:
+    account_ids = ['acc_{:09d}'.format(i) for i in range(count)]
+    for start in range(0, count, SEED_BATCH_SIZE):
+        Account.objects.bulk_create([
+            Account(id=account_id, owner='owner_{}'.format(i % owners), balance=balance, currency=CURRENCY_PHP)
+            for i, account_id in enumerate(account_ids[start:start + SEED_BATCH_SIZE], start)
+        ])
+    return account_ids
+
+
+def seed_payments(count: int, account_ids: List[str]):
+    """
+    Stores transfers between `account_ids` round robin, balances of accounts are not changed
+    """
+    for start in range(0, count, SEED_BATCH_SIZE):
+        Payment.objects.bulk_create([
+            Payment(
+                from_account_id=account_ids[i % len(account_ids)],
+                to_account_id=account_ids[(i + 1) % len(account_ids)],
+                amount=Decimal(i % 10000) / 100, currency=CURRENCY_PHP,
+            )
+            for i in range(start, min(start + SEED_BATCH_SIZE, count))
+        ])
+
+
+def best_time(func: Callable, repeat: int = 3) -> float:
+    """
+    The best of `repeat` run times of `func`, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of sorted `values`
+    """
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+def drive(request: Callable[[APIClient, int], object], requests: int, threads: int = 1) -> dict:
+    """
+    Sends `requests` requests from `threads` threads, each with a client of its own,
+    the i-th one by `request(client, i)`. Returns throughput and latency percentiles in milliseconds,
+    failed requests are counted as errors and left out of latencies.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        client = APIClient()
+        try:
+            for i in range(offset, requests, threads):
+                started = time.perf_counter()
+                try:
+                    response = request(client, i)
+                except Exception:
+                    ok = False
+                else:
+                    ok = response.status_code < 400
+                elapsed = time.perf_counter() - started
+                with lock:
+                    (latencies if ok else errors).append(elapsed)
+        finally:
+            connection.close()
+            if connection.connection is not None:
+                # connections to in-memory SQLite test databases are left open by `close`, and would keep
+                # the database of the run alive after it is destroyed
+                connection.connection.close()
+                connection.connection = None
+
+    workers = [threading.Thread(target=worker, args=(offset,)) for offset in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = time.perf_counter() - started
+    return dict(summarize(latencies, len(errors), seconds), threads=threads)
+
+
+def summarize(latencies: List[float], errors: int, seconds: float) -> dict:
+    """
+    Throughput and latency percentiles in milliseconds of requests, that were sent in `seconds`,
+    `latencies` are the ones of succeeded requests
+    """
+    latencies = sorted(latencies)
+    result = {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'rps': round(len(latencies) / seconds, 1),
+    }
+    for percent in (50, 95, 99):
+        result['p{}_ms'.format(percent)] = round(percentile(latencies, percent) * 1000, 3) if latencies else None
+    return result
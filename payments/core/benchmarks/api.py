@@ -0,0 +1,59 @@
+"""
+Throughput and latency of the API endpoints through the test client, sequential and with concurrent clients
+"""
+import random
+from typing import Callable, List, Tuple
+
+from core.benchmarks import drive, seed_accounts, seed_payments, temporary_database
+from core.const import CURRENCY_PHP
+
+DEFAULT_ROWS = (10000, 100000)
+DEFAULT_ACCOUNTS = 1000
+DEFAULT_REQUESTS = 500
+DEFAULT_THREADS = (1, 4)
+
+
+def _get_accounts(client, i):
+    return client.get('/v1/accounts')
+
+
+def _get_payments(client, i):
+    return client.get('/v1/payments')
+
+
+def _post_payments(account_ids):
+    def request(client, i):
+        from_account, to_account = random.Random(i).sample(account_ids, 2)
+        return client.post('/v1/payments', {
+            'from_account': from_account,
+            'to_account': to_account,
+            'amount': '1.00',
+            'currency': CURRENCY_PHP,
+        }, format='json')
+    return request
+
+
+def scenarios(account_ids: List[str]) -> List[Tuple[str, Callable]]:
+    """
+    Names and request functions of benchmarked endpoints, writes go last, so that reads see the seeded number of rows
+    """
+    return [
+        ('get_accounts', _get_accounts),
+        ('get_payments', _get_payments),
+        ('post_payments', _post_payments(account_ids)),
+    ]
+
+
+def run(rows: List[int] = DEFAULT_ROWS, accounts: int = DEFAULT_ACCOUNTS, requests: int = DEFAULT_REQUESTS,
+        threads: List[int] = DEFAULT_THREADS) -> List[dict]:
+    results = []
+    for count in rows:
+        with temporary_database():
+            account_ids = seed_accounts(accounts)
+            seed_payments(count, account_ids)
+            for name, request in scenarios(account_ids):
+                for thread_count in threads:
+                    result = {'benchmark': 'api.' + name, 'rows': count, 'accounts': accounts}
+                    result.update(drive(request, requests, thread_count))
+                    results.append(result)
+    return results
@@ -0,0 +1,58 @@
+"""
+Throughput of transfers to one hot account from many payers through the API, with credits of the hot account
+spread across numbers of balance buckets, see `core.models.BalanceBucket`. Without buckets every transfer locks
+the row of the hot account, with them it locks one of its buckets, so throughput grows with buckets until
+other rows limit it. It needs a backend with row-level locks, such as PostgreSQL (PAYMENTS_POSTGRES_DB): SQLite
+serializes all writes behind one database lock, so every number of buckets gives the same throughput, and the
+benchmark refuses to run there.
+"""
+import random
+from decimal import Decimal
+from typing import List
+
+from django.core.management.base import CommandError
+from django.db import connection
+
+from core.benchmarks import drive, seed_accounts, temporary_database
+from core.const import CURRENCY_PHP
+from core.models import Account
+
+DEFAULT_ACCOUNTS = 1000
+DEFAULT_REQUESTS = 1000
+DEFAULT_THREADS = (16,)
+DEFAULT_BUCKETS = (0, 4, 16)
+
+HOT_ACCOUNT_ID = 'acc_hot'
+
+
+def _post_payments(account_ids: List[str]):
+    def request(client, i):
+        return client.post('/v1/payments', {
+            'from_account': random.Random(i).choice(account_ids),
+            'to_account': HOT_ACCOUNT_ID,
+            'amount': '1.00',
+            'currency': CURRENCY_PHP,
+        }, format='json')
+    return request
+
+
+def run(accounts: int = DEFAULT_ACCOUNTS, requests: int = DEFAULT_REQUESTS, threads: List[int] = DEFAULT_THREADS,
+        buckets: List[int] = DEFAULT_BUCKETS) -> List[dict]:
+    if not connection.features.has_select_for_update:
+        raise CommandError(
+            "The contention benchmark needs a database with row-level locks, such as PostgreSQL "
+            "(PAYMENTS_POSTGRES_DB), {} serializes all writes".format(connection.vendor)
+        )
+    results = []
+    for bucket_count in buckets:
+        with temporary_database():
+            account_ids = seed_accounts(accounts)
+            hot_account = Account.objects.create(
+                id=HOT_ACCOUNT_ID, owner='merchant', balance=Decimal(0), currency=CURRENCY_PHP,
+            )
+            hot_account.set_buckets(bucket_count)
+            for thread_count in threads:
+                result = {'benchmark': 'contention.post_payments', 'accounts': accounts, 'buckets': bucket_count}
+                result.update(drive(_post_payments(account_ids), requests, thread_count))
+                results.append(result)
+    return results
@@ -0,0 +1,126 @@
+"""
+Overhead of `MetricsMiddleware` and of metrics of `Account.pay` on latency of the API endpoints.
+
+Latencies of requests with and without metrics differ by less than their run to run noise, so the overhead
+is also estimated from the cost of the instrumentation itself: of the middleware around a request,
+that does nothing, and of the execute wrapper around every query of the request.
+"""
+import re
+from typing import List
+from unittest import mock
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from rest_framework.test import APIClient
+
+from core import metrics
+from core.benchmarks import api, best_time, drive, seed_accounts, seed_payments, temporary_database
+from core.middleware import MetricsMiddleware
+
+DEFAULT_ROWS = (10000,)
+DEFAULT_REQUESTS = 200
+MIDDLEWARE = 'core.middleware.MetricsMiddleware'
+CALLS = 10000
+
+
+class _NoMeasure:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def _run_without_metrics(request, requests):
+    middleware = [name for name in settings.MIDDLEWARE if name != MIDDLEWARE]
+    with override_settings(MIDDLEWARE=middleware), mock.patch('core.metrics.measure', _NoMeasure):
+        return drive(request, requests)
+
+
+def _run_with_metrics(request, requests):
+    middleware = [MIDDLEWARE] + [name for name in settings.MIDDLEWARE if name != MIDDLEWARE]
+    with override_settings(MIDDLEWARE=middleware):
+        return drive(request, requests)
+
+
+def _middleware_us(repeat: int) -> float:
+    """
+    Cost of the middleware around a request, that makes no queries, in microseconds
+    """
+    request = RequestFactory().get('/')
+    response = HttpResponse()
+
+    def get_response(request):
+        return response
+
+    middleware = MetricsMiddleware(get_response)
+
+    def bare():
+        for _ in range(CALLS):
+            get_response(request)
+
+    def measured():
+        for _ in range(CALLS):
+            middleware(request)
+
+    return (best_time(measured, repeat) - best_time(bare, repeat)) / CALLS * 1000000
+
+
+def _query_us(repeat: int) -> float:
+    """
+    Cost of counting of a query by the execute wrapper, in microseconds
+    """
+    def queries():
+        with connection.cursor() as cursor:
+            for _ in range(CALLS):
+                cursor.execute('SELECT 1')
+
+    def measured():
+        with metrics.metered(metrics.QueryMeter()):
+            queries()
+
+    return (best_time(measured, repeat) - best_time(queries, repeat)) / CALLS * 1000000
+
+
+def _queries_per_request(request) -> int:
+    response = request(APIClient(), 0)
+    return int(re.search(r'desc="(\d+) queries"', response['Server-Timing']).group(1))
+
+
+def run(rows: List[int] = DEFAULT_ROWS, accounts: int = api.DEFAULT_ACCOUNTS, requests: int = DEFAULT_REQUESTS,
+        repeat: int = 10) -> List[dict]:
+    results = []
+    for count in rows:
+        with temporary_database():
+            account_ids = seed_accounts(accounts)
+            seed_payments(count, account_ids)
+            middleware_us = _middleware_us(repeat)
+            query_us = _query_us(repeat)
+            for name, request in api.scenarios(account_ids):
+                # variants alternate and swap their order, so that both see the same state of the database
+                # and of caches, the best median of each variant is taken
+                medians = {_run_without_metrics: [], _run_with_metrics: []}
+                for i in range(repeat):
+                    variants = (_run_without_metrics, _run_with_metrics)
+                    for variant in (variants if i % 2 else reversed(variants)):
+                        medians[variant].append(variant(request, requests)['p50_ms'])
+                without_ms = min(medians[_run_without_metrics])
+                with_ms = min(medians[_run_with_metrics])
+                queries = _queries_per_request(request)
+                instrumentation_us = middleware_us + queries * query_us
+                results.append({
+                    'benchmark': 'metrics.' + name,
+                    'rows': count,
+                    'requests': requests,
+                    'queries': queries,
+                    'p50_ms_without_metrics': without_ms,
+                    'p50_ms_with_metrics': with_ms,
+                    'instrumentation_us': round(instrumentation_us, 1),
+                    'overhead_percent': round(instrumentation_us / 1000 / without_ms * 100, 2),
+                })
+    return results
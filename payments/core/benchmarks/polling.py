@@ -0,0 +1,34 @@
+"""
+Cost of polling lists, that did not change: unconditional requests, which read and serialize a page every time,
+against conditional ones with the ETag of the previous response, which are answered with 304, see `core.conditional`.
+"""
+from typing import List
+
+from rest_framework.test import APIClient
+
+from core.benchmarks import drive, seed_accounts, seed_payments, temporary_database
+
+DEFAULT_ROWS = (10000, 100000)
+DEFAULT_ACCOUNTS = 1000
+DEFAULT_REQUESTS = 1000
+DEFAULT_THREADS = (1, 4)
+
+PATHS = (('accounts', '/v1/accounts'), ('payments', '/v1/payments'))
+
+
+def run(rows: List[int] = DEFAULT_ROWS, accounts: int = DEFAULT_ACCOUNTS, requests: int = DEFAULT_REQUESTS,
+        threads: List[int] = DEFAULT_THREADS) -> List[dict]:
+    results = []
+    for count in rows:
+        with temporary_database():
+            seed_payments(count, seed_accounts(accounts))
+            for name, path in PATHS:
+                response = APIClient().get(path)
+                etag = response['ETag']
+                for mode, headers in (('unconditional', {}), ('if_none_match', {'HTTP_IF_NONE_MATCH': etag})):
+                    for thread_count in threads:
+                        result = {'benchmark': 'polling.{}.{}'.format(name, mode), 'rows': count, 'accounts': accounts}
+                        result.update(drive(lambda client, i: client.get(path, **headers), requests, thread_count))
+                        result['response_bytes'] = len(APIClient().get(path, **headers).content)
+                        results.append(result)
+    return results
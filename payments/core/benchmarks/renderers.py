@@ -0,0 +1,56 @@
+"""
+Sizes, encode and decode times of pages of lists in the compact binary format against JSON.
+Binary pages are decoded into columns, as bulk consumers read them, see `core.renderers.read_table`.
+"""
+import json
+from typing import List
+
+from rest_framework.renderers import JSONRenderer
+
+from core import renderers
+from core.benchmarks import best_time, seed_accounts, seed_payments, temporary_database
+from core.models import Account, Payment
+from core.serializers import AccountSerializer, PaymentSerializer
+from core.views import AccountsList, PaymentsList
+
+DEFAULT_ROWS = (100, 1000, 10000)
+
+
+def _pages(count: int) -> list:
+    """
+    Names, views and data of pages of `count` accounts and of `count` transfers, as the list endpoints have them
+    """
+    accounts = AccountSerializer.fast_representation(Account.objects.values_list(*AccountSerializer.fast_columns))
+    legs = PaymentSerializer.fast_legs(Payment.objects.values_list(*PaymentSerializer.fast_columns)[:count])
+    next_link = 'http://testserver/v1/payments?cursor=cD0xMDA%3D'
+    return [
+        ('accounts', AccountsList(), {'next': next_link, 'previous': None, 'results': accounts}),
+        ('payments', PaymentsList(), {'next': next_link, 'previous': None, 'results': legs}),
+    ]
+
+
+def run(rows: List[int] = DEFAULT_ROWS, repeat: int = 5) -> List[dict]:
+    results = []
+    for count in rows:
+        with temporary_database():
+            seed_payments(count, seed_accounts(count))
+            for name, view, data in _pages(count):
+                context = {'view': view}
+                json_content = JSONRenderer().render(data)
+                columns_content = renderers.ColumnsRenderer().render(data, renderer_context=context)
+                json_encode = best_time(lambda: JSONRenderer().render(data), repeat)
+                columns_encode = best_time(
+                    lambda: renderers.ColumnsRenderer().render(data, renderer_context=context), repeat,
+                )
+                results.append({
+                    'benchmark': 'renderers.' + name,
+                    'rows': len(data['results']),
+                    'json_bytes': len(json_content),
+                    'columns_bytes': len(columns_content),
+                    'size_ratio': round(len(json_content) / len(columns_content), 2),
+                    'json_encode_s': round(json_encode, 5),
+                    'columns_encode_s': round(columns_encode, 5),
+                    'json_decode_s': round(best_time(lambda: json.loads(json_content), repeat), 5),
+                    'columns_decode_s': round(best_time(lambda: renderers.read_table(columns_content), repeat), 5),
+                })
+    return results
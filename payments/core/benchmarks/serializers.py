@@ -0,0 +1,53 @@
+"""
+ModelSerializer against the `values_list` fast path of list serializers, both including the query and JSON rendering
+"""
+from typing import List
+
+from rest_framework.renderers import JSONRenderer
+
+from core.benchmarks import best_time, seed_accounts, seed_payments, temporary_database
+from core.models import Account, Payment
+from core.serializers import AccountSerializer, PaymentSerializer
+
+DEFAULT_ROWS = (10000, 100000, 1000000)
+
+
+def _model_serializer_accounts():
+    JSONRenderer().render(AccountSerializer(Account.objects.all(), many=True).data)
+
+
+def _fast_accounts():
+    rows = Account.objects.values_list(*AccountSerializer.fast_columns)
+    JSONRenderer().render(AccountSerializer.fast_representation(rows))
+
+
+def _model_serializer_payments():
+    legs = [leg for payment in Payment.objects.all() for leg in payment.legs()]
+    JSONRenderer().render(PaymentSerializer(legs, many=True).data)
+
+
+def _fast_payments():
+    rows = Payment.objects.values_list(*PaymentSerializer.fast_columns)
+    JSONRenderer().render(PaymentSerializer.fast_legs(rows))
+
+
+def run(rows: List[int] = DEFAULT_ROWS, repeat: int = 3) -> List[dict]:
+    results = []
+    for count in rows:
+        with temporary_database():
+            account_ids = seed_accounts(count)
+            seed_payments(count, account_ids)
+            for name, model_serializer, fast in (
+                ('accounts', _model_serializer_accounts, _fast_accounts),
+                ('payments', _model_serializer_payments, _fast_payments),
+            ):
+                model_serializer_time = best_time(model_serializer, repeat)
+                fast_time = best_time(fast, repeat)
+                results.append({
+                    'benchmark': 'serializers.' + name,
+                    'rows': count,
+                    'model_serializer_s': round(model_serializer_time, 4),
+                    'fast_s': round(fast_time, 4),
+                    'speedup': round(model_serializer_time / fast_time, 2),
+                })
+    return results
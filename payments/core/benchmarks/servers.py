@@ -0,0 +1,131 @@
+"""
+Reads of lists by many slow clients at once, served by the WSGI handler in a pool of sync workers, as WSGI servers
+serve them, and by the ASGI handler in one event loop. Clients are simulated in the process: every client takes
+`slow_ms` milliseconds to read a response, a sync worker is held for that time, and the event loop is not.
+"""
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Sequence
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+
+from core.benchmarks import seed_accounts, seed_payments, summarize, temporary_database
+
+DEFAULT_ROWS = (10000,)
+DEFAULT_ACCOUNTS = 1000
+DEFAULT_REQUESTS = 400
+DEFAULT_THREADS = (50, 200)
+DEFAULT_WORKERS = 4
+DEFAULT_SLOW_MS = 100
+
+PATHS = ('/v1/payments', '/v1/accounts')
+
+
+def _environ(path: str) -> dict:
+    return {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+    }
+
+
+def _scope(path: str) -> dict:
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'query_string': b'', 'headers': [(b'host', b'testserver')], 'server': ('testserver', 80),
+    }
+
+
+async def _clients(request: Callable[[int], Awaitable[int]], requests: int, clients: int) -> dict:
+    """
+    Sends `requests` requests from `clients` concurrent clients, the i-th one by `request(i)`, that returns
+    the status of the response, once it is read by the client
+    """
+    latencies = []
+    errors = []
+
+    async def client(offset):
+        for i in range(offset, requests, clients):
+            started = time.perf_counter()
+            try:
+                ok = await request(i) < 400
+            except Exception:
+                ok = False
+            (latencies if ok else errors).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(offset) for offset in range(clients)))
+    return summarize(latencies, len(errors), time.perf_counter() - started)
+
+
+def wsgi_clients(paths: Sequence[str], requests: int, clients: int, workers: int, slow_ms: float) -> dict:
+    """
+    Requests of slow clients, served by the WSGI handler in `workers` threads
+    """
+    handler = WSGIHandler()
+
+    def serve(path):
+        statuses = []
+        body = handler(_environ(path), lambda status, headers: statuses.append(int(status.split()[0])))
+        try:
+            b''.join(body)
+            # the worker writes the response, until the client reads it
+            time.sleep(slow_ms / 1000)
+        finally:
+            body.close()
+        return statuses[0]
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return await _clients(
+                lambda i: loop.run_in_executor(executor, serve, paths[i % len(paths)]), requests, clients,
+            )
+
+    return asyncio.run(main())
+
+
+def asgi_clients(paths: Sequence[str], requests: int, clients: int, slow_ms: float) -> dict:
+    """
+    Requests of slow clients, served by the ASGI handler in one event loop
+    """
+    handler = ASGIHandler()
+
+    async def serve(path):
+        statuses = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+            elif not message.get('more_body'):
+                await asyncio.sleep(slow_ms / 1000)
+
+        await handler(_scope(path), receive, send)
+        return statuses[0]
+
+    return asyncio.run(_clients(lambda i: serve(paths[i % len(paths)]), requests, clients))
+
+
+def run(rows: List[int] = DEFAULT_ROWS, accounts: int = DEFAULT_ACCOUNTS, requests: int = DEFAULT_REQUESTS,
+        threads: List[int] = DEFAULT_THREADS, workers: int = DEFAULT_WORKERS) -> List[dict]:
+    results = []
+    for count in rows:
+        with temporary_database():
+            seed_payments(count, seed_accounts(accounts))
+            for clients in threads:
+                for name, measure in (
+                    ('wsgi', lambda: dict(wsgi_clients(PATHS, requests, clients, workers, DEFAULT_SLOW_MS),
+                                          workers=workers)),
+                    ('asgi', lambda: asgi_clients(PATHS, requests, clients, DEFAULT_SLOW_MS)),
+                ):
+                    result = {'benchmark': 'servers.' + name, 'rows': count, 'accounts': accounts}
+                    result.update(measure(), threads=clients, slow_ms=DEFAULT_SLOW_MS)
+                    results.append(result)
+    return results
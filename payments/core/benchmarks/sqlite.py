@@ -0,0 +1,60 @@
+"""
+Throughput of concurrent reads and transfers on a database in a file, with the configured SQLite settings.
+Run it with the default settings and with PAYMENTS_SQLITE_PROFILE=production to compare them: with the default
+ones every request opens a connection, readers wait for commits of writers, and transfers, that read before they
+write, fail with "database is locked", which are counted as errors.
+"""
+import random
+from typing import List
+
+from django.db import connection
+
+from core.benchmarks import drive, seed_accounts, seed_payments, temporary_database
+from core.const import CURRENCY_PHP
+
+DEFAULT_ROWS = (10000,)
+DEFAULT_ACCOUNTS = 1000
+DEFAULT_REQUESTS = 1000
+DEFAULT_THREADS = (1, 8)
+
+# percent of requests of the mixed scenario, that are transfers
+WRITE_PERCENT = 20
+
+
+def _requests(account_ids: List[str], write_percent: int):
+    def request(client, i):
+        rng = random.Random(i)
+        if rng.randrange(100) < write_percent:
+            from_account, to_account = rng.sample(account_ids, 2)
+            return client.post('/v1/payments', {
+                'from_account': from_account, 'to_account': to_account, 'amount': '1.00', 'currency': CURRENCY_PHP,
+            }, format='json')
+        if i % 2:
+            return client.get('/v1/accounts/' + rng.choice(account_ids))
+        return client.get('/v1/payments', {'page_size': 20})
+    return request
+
+
+def _profile() -> str:
+    options = connection.settings_dict['OPTIONS']
+    return '{} {}, conn_max_age {}'.format(
+        options.get('pragmas', {}).get('journal_mode', 'DELETE'), options.get('transaction_mode', 'DEFERRED'),
+        connection.settings_dict['CONN_MAX_AGE'],
+    )
+
+
+def run(rows: List[int] = DEFAULT_ROWS, accounts: int = DEFAULT_ACCOUNTS, requests: int = DEFAULT_REQUESTS,
+        threads: List[int] = DEFAULT_THREADS) -> List[dict]:
+    results = []
+    for count in rows:
+        with temporary_database(on_disk=True):
+            account_ids = seed_accounts(accounts)
+            seed_payments(count, account_ids)
+            for name, write_percent in (('reads', 0), ('mixed', WRITE_PERCENT)):
+                for thread_count in threads:
+                    result = {
+                        'benchmark': 'sqlite.' + name, 'rows': count, 'accounts': accounts, 'profile': _profile(),
+                    }
+                    result.update(drive(_requests(account_ids, write_percent), requests, thread_count))
+                    results.append(result)
+    return results
@@ -0,0 +1,81 @@
+"""
+Cold start time of a process and time of requests with the full settings and with API-only ones
+(`payments.settings_api`). Every measurement is made in a fresh process: the start is the time of importing
+the WSGI application, that sets up Django, and requests are sent by the Django test client, so they pass through
+all the middleware of the settings, to read endpoints, whose queries are few, so the rest is their overhead.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+from django.conf import settings
+from django.test import Client
+
+from core.benchmarks import percentile, seed_accounts, summarize, temporary_database
+
+DEFAULT_REQUESTS = 1000
+DEFAULT_REPEAT = 5
+
+SETTINGS_MODULES = ('payments.settings', 'payments.settings_api')
+PATHS = ('/v1/accounts/acc_000000000', '/v1/fx-rates')
+
+_START_SCRIPT = """
+import time
+started = time.perf_counter()
+import payments.wsgi
+print(time.perf_counter() - started)
+"""
+
+_REQUESTS_SCRIPT = """
+import sys
+import django
+django.setup()
+from core.benchmarks import startup
+startup.measure_requests(int(sys.argv[1]))
+"""
+
+
+def _python(script: str, settings_module: str, *args) -> str:
+    return subprocess.check_output(
+        [sys.executable, '-c', script, *args], cwd=settings.BASE_DIR, universal_newlines=True,
+        env=dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module),
+    )
+
+
+def measure_requests(requests: int):
+    """
+    Prints results of `requests` requests to every one of PATHS as JSON lines, it is run in the measured process
+    """
+    with temporary_database():
+        seed_accounts(1)
+        client = Client()
+        for path in PATHS:
+            # the first request loads whatever is loaded lazily
+            client.get(path)
+            latencies = []
+            errors = 0
+            started = time.perf_counter()
+            for _ in range(requests):
+                request_started = time.perf_counter()
+                if client.get(path).status_code < 400:
+                    latencies.append(time.perf_counter() - request_started)
+                else:
+                    errors += 1
+            print(json.dumps(dict(summarize(latencies, errors, time.perf_counter() - started), path=path)))
+
+
+def run(requests: int = DEFAULT_REQUESTS, repeat: int = DEFAULT_REPEAT) -> List[dict]:
+    results = []
+    for settings_module in SETTINGS_MODULES:
+        starts = sorted(float(_python(_START_SCRIPT, settings_module)) for _ in range(repeat))
+        results.append({
+            'benchmark': 'startup.import', 'settings': settings_module, 'repeat': repeat,
+            'best_ms': round(starts[0] * 1000, 1), 'p50_ms': round(percentile(starts, 50) * 1000, 1),
+        })
+        for line in _python(_REQUESTS_SCRIPT, settings_module, str(requests)).splitlines():
+            result = json.loads(line)
+            results.append(dict({'benchmark': 'startup.requests', 'settings': settings_module}, **result))
+    return results
@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class LRUCache:
+    """
+    Thread safe in-process cache, that keeps at most `max_size` of the most recently used items
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._items[key]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def add(self, key: Hashable, value: Any) -> bool:
+        """
+        Sets the value only if the key is not cached yet, returns whether it was set
+        """
+        with self._lock:
+            if key in self._items:
+                return False
+        self.set(key, value)
+        return True
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._items),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DjangoCache:
+    """
+    Adapter of a Django cache backend with the interface of `LRUCache`, so the cache can be shared between processes.
+    Evictions are done by the backend itself and are not counted.
+    """
+    def __init__(self, alias: str = 'default', timeout: int = None, key_prefix: str = ''):
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _key(self, key: Hashable) -> str:
+        return self.key_prefix + str(key)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self.cache.get(self._key(key))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is None else value
+
+    def set(self, key: Hashable, value: Any):
+        self.cache.set(self._key(key), value, self.timeout)
+
+    def add(self, key: Hashable, value: Any) -> bool:
+        return self.cache.add(self._key(key), value, self.timeout)
+
+    def delete(self, key: Hashable):
+        self.cache.delete(self._key(key))
+
+    def clear(self):
+        self.cache.clear()
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': None,
+        }
+
+
+def create_cache(config: dict):
+    """
+    Creates cache from the config like {'BACKEND': 'core.cache.LRUCache', 'OPTIONS': {'max_size': 1000}}
+    """
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
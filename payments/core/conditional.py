@@ -0,0 +1,53 @@
+"""
+Conditional GET of lists of accounts and payments, for clients, that poll them.
+
+Every change of accounts and every payment increments change counters in its transaction, see `ChangeCounter`,
+so versions of counters of all shards are the version of the lists. The ETag of a response is a hash of the sum
+of versions and of everything else, that the response depends on: the path with its query and the accepted media
+type. A request with a matching `If-None-Match`, or with `If-Modified-Since` not older than the last change,
+is answered with 304 after one query of counters per shard, without reading rows or serializing them.
+Counters are read before rows, so a change committed in between makes the next response a new one, and they are
+read once per request, the balance cache validates its entries by the same versions, see `core.balances`.
+Last-Modified has a resolution of seconds, so pollers should send `If-None-Match`, which is exact.
+"""
+import hashlib
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from core import sharding
+from core.models import ChangeCounter
+
+# versions of counters by (alias of the database, slot), and the time of the last change of any of them
+Versions = Tuple[Dict[Tuple[str, int], int], Optional[datetime]]
+
+
+def read_versions(request) -> Versions:
+    """
+    Versions of counters of all shards, read once per request
+    """
+    if not hasattr(request, '_counter_versions'):
+        versions, last_changed_at = {}, None
+        for alias in sharding.shards():
+            for slot, (version, changed_at) in ChangeCounter.versions(using=alias).items():
+                versions[alias, slot] = version
+                if last_changed_at is None or changed_at > last_changed_at:
+                    last_changed_at = changed_at
+        request._counter_versions = versions, last_changed_at
+    return request._counter_versions
+
+
+def etag(request, *args, **kwargs) -> str:
+    versions, _ = read_versions(request)
+    key = '\n'.join((str(sum(versions.values())), request.get_full_path(), request.META.get('HTTP_ACCEPT', '')))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def last_modified(request, *args, **kwargs) -> Optional[datetime]:
+    return read_versions(request)[1]
+
+
+# decorator of `get` methods of list views
+conditional_list = method_decorator(condition(etag_func=etag, last_modified_func=last_modified))
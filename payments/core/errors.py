@@ -1,17 +1,54 @@
 from typing import List
 
 
+class CrossShardBatch(Exception):
+    """
+    Exception for informing, that the transfer leaves the shard of an atomic batch, so it can not be made with it
+    """
+    code = 'cross_shard_batch'
+
+
+class DuplicateAccount(Exception):
+    """
+    Exception for informing, that account_ids are already used by other accounts
+    """
+    code = 'duplicate_account'
+    account_ids = None
+
+    def __init__(self, account_ids: List[str]):
+        self.account_ids = account_ids
+
+
+class IdempotencyKeyReused(Exception):
+    """
+    Exception for informing, that the idempotency key was used by a request with another body
+    """
+    code = 'idempotency_key_reused'
+
+
 class InsufficientBalance(Exception):
     """
     Exception for informing, that account does not have enough money
     """
-    pass
+    code = 'insufficient_balance'
+
+
+class InvalidAccount(Exception):
+    """
+    Exception for informing, that data of a new account is not valid, `errors` are the ones of its fields
+    """
+    code = 'invalid_account'
+    errors = None
+
+    def __init__(self, errors: dict):
+        self.errors = errors
 
 
 class InvalidAccountCurrency(Exception):
     """
     Exception for informing, that account_ids currency is not valid for the operation
     """
+    code = 'invalid_account_currency'
     account_ids = None
 
     def __init__(self, account_ids: List[str]):
@@ -22,4 +59,29 @@ class InvalidAmount(Exception):
     """
     Exception for informing, that amount of money is not valid for the operation
     """
-    pass
+    code = 'invalid_amount'
+
+
+class TransferAborted(Exception):
+    """
+    Exception for informing, that the cross-shard transfer was aborted by recovery, before it was decided
+    """
+    code = 'transfer_aborted'
+
+
+class UnknownAccount(Exception):
+    """
+    Exception for informing, that account_ids do not exist
+    """
+    code = 'unknown_account'
+    account_ids = None
+
+    def __init__(self, account_ids: List[str]):
+        self.account_ids = account_ids
+
+
+class UnknownFxRate(Exception):
+    """
+    Exception for informing, that there is no exchange rate between currencies of the transfer
+    """
+    code = 'unknown_fx_rate'
@@ -0,0 +1,72 @@
+"""
+Streaming export of the payment ledger.
+Transfers are read with a server-side cursor in chunks and are encoded chunk by chunk, so memory used by the export
+does not depend on the size of the ledger. They are exported in the order of ids, so an interrupted export
+can be resumed with the id of the last exported transfer. Transfers of shards are merged by their ids.
+Converted transfers have their credited amounts, currencies and rates too, see `FxConversion`.
+"""
+import json
+from typing import Iterator
+
+from core import sharding
+from core.models import Payment
+from core.serializers import PaymentSerializer, field_formatter
+
+FORMAT_JSON = 'json'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = (FORMAT_JSON, FORMAT_NDJSON)
+CONTENT_TYPES = {
+    FORMAT_JSON: 'application/json',
+    FORMAT_NDJSON: 'application/x-ndjson',
+}
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# columns of exported transfers, see `item`
+COLUMNS = ('pk', 'from_account_id', 'to_account_id', 'amount', 'currency', 'to_amount', 'to_currency', 'rate')
+
+
+def item(row: tuple, format_amount) -> dict:
+    """
+    Exported transfer of the row of COLUMNS, decimal values are formatted by `format_amount`
+    """
+    pk, from_account_id, to_account_id, amount, currency, to_amount, to_currency, rate = row
+    result = {
+        'id': pk, 'from_account': from_account_id, 'to_account': to_account_id,
+        'amount': format_amount(amount), 'currency': currency,
+    }
+    if to_amount is not None:
+        result.update(to_amount=format_amount(to_amount), to_currency=to_currency, rate='{:f}'.format(rate))
+    return result
+
+
+def export_payments(export_format: str, after_id: int = 0, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Yields the JSON array or the newline delimited JSON objects of transfers with ids greater than `after_id`
+    """
+    format_amount = field_formatter(PaymentSerializer, 'amount')
+    rows = sharding.fan_out(
+        Payment.objects.filter(pk__gt=after_id).order_by('pk').values_list(*COLUMNS)
+    ).iterator(chunk_size=chunk_size)
+
+    if export_format == FORMAT_JSON:
+        separator, prefix, suffix = ',\n', '[\n', '\n]\n'
+    else:
+        separator, prefix, suffix = '\n', '', '\n'
+
+    chunk = []
+    started = False
+    for row in rows:
+        chunk.append(json.dumps(item(row, format_amount)))
+        if len(chunk) == chunk_size:
+            yield (separator if started else prefix) + separator.join(chunk)
+            started = True
+            chunk = []
+
+    if chunk:
+        yield (separator if started else prefix) + separator.join(chunk)
+        started = True
+    if started:
+        yield suffix
+    elif export_format == FORMAT_JSON:
+        yield '[]\n'
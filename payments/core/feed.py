@@ -0,0 +1,110 @@
+"""
+Change feed of the payment ledger, for services, that mirror it.
+
+Consumers read transfers after the position of their last batch in the feed, in the order of positions, so the cost
+of a read depends on the number of new transfers only. Positions are given to transfers after they are committed,
+by reads of the feed, see `PaymentFeedSequence`, so a transfer, that is committed after the read of a batch,
+is always after its position, whatever its id is: ids follow the order, in which transfers start, and with several
+transactions in flight, or with blocks of ids of processes of shards, see `PaymentIdBlock`, a transfer may be
+committed after one with a greater id. A read, that finds none, may wait for them: it is woken up
+after the commit of every transfer of the process, see `balances_changed`, and checks the database every
+PAYMENT_FEED_CHECK_INTERVAL seconds for the ones of other processes. Under WSGI waiting reads hold their threads,
+under ASGI they wait on the event loop, and only reads of the database run in the pool of async reads,
+see `core.views.async_long_polls`.
+"""
+import asyncio
+import contextlib
+import threading
+import time
+from typing import Iterator, List, Set, Tuple
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from core import export, sharding
+from core.models import Account, Payment, PaymentFeedSequence
+from core.serializers import PaymentSerializer, field_formatter
+from core.signals import balances_changed
+
+DEFAULT_LIMIT = 100
+
+# number of commits of transfers in this process, waiting reads are notified of every one
+_commits = 0
+_committed = threading.Condition()
+# events of reads, that wait on event loops, they are set after every commit too, see `watch_commits`
+_events = set()  # type: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]
+
+
+@receiver(balances_changed, sender=Account)
+def _notify(sender, **kwargs):
+    global _commits
+    with _committed:
+        _commits += 1
+        _committed.notify_all()
+        events = list(_events)
+    for loop, event in events:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # the loop is closed, while its read leaves the context of `watch_commits`
+            pass
+
+
+@contextlib.contextmanager
+def watch_commits() -> Iterator[asyncio.Event]:
+    """
+    Event of the running loop, that is set after every commit of a transfer of the process while in the context
+    """
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with _committed:
+        _events.add(waiter)
+    try:
+        yield waiter[1]
+    finally:
+        with _committed:
+            _events.discard(waiter)
+
+
+async def wait_for_commit(committed: asyncio.Event, timeout: float):
+    """
+    Waits on the event loop for at most `timeout` seconds until the event of `watch_commits` is set
+    """
+    try:
+        await asyncio.wait_for(committed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+def read_payments(since: int = 0, limit: int = DEFAULT_LIMIT) -> Tuple[List[dict], int]:
+    """
+    At most `limit` transfers after the `since` position in the order of the feed, as they are exported,
+    and the position of the last one, that is the cursor of the next read, or `since` if there are none
+    """
+    PaymentFeedSequence.assign()
+    format_amount = field_formatter(PaymentSerializer, 'amount')
+    rows = list(sharding.fan_out(
+        Payment.objects.filter(feed_sequence__gt=since).order_by('feed_sequence').values_list(
+            'feed_sequence', *export.COLUMNS,
+        )
+    )[:limit])
+    return [export.item(row, format_amount) for _, *row in rows], rows[-1][0] if rows else since
+
+
+def wait_for_payments(since: int = 0, limit: int = DEFAULT_LIMIT, timeout: float = 0) -> Tuple[List[dict], int]:
+    """
+    Transfers after `since` as `read_payments` has them, waiting for at most `timeout` seconds until there are any,
+    and the cursor of the next read
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        with _committed:
+            commits = _commits
+        payments, cursor = read_payments(since, limit)
+        remaining = deadline - time.monotonic()
+        if payments or remaining <= 0:
+            return payments, cursor
+        with _committed:
+            # commits made since the read above are not missed, they are counted
+            _committed.wait_for(
+                lambda: _commits != commits, timeout=min(remaining, settings.PAYMENT_FEED_CHECK_INTERVAL),
+            )
@@ -0,0 +1,116 @@
+from typing import Iterable, List
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from core.const import PAYMENT_DIRECTIONS_INCOMING, PAYMENT_DIRECTIONS_OUTGOING
+from core.merging import MergedQuery
+
+
+class QueryParamsFilter(BaseFilterBackend):
+    """
+    Filters queryset by exact values of query params.
+    `lookups` maps query param names to queryset lookups, params from `integer_params` are validated to be integers.
+    """
+    lookups = {}
+    integer_params = ()
+
+    def get_filters(self, request) -> dict:
+        filters = {}
+        for param, lookup in self.lookups.items():
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            if param in self.integer_params:
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise ValidationError({param: ['A valid integer is required.']})
+            filters[lookup] = value
+        return filters
+
+    def filter_queryset(self, request, queryset, view):
+        return queryset.filter(**self.get_filters(request))
+
+
+class AccountsFilter(QueryParamsFilter):
+    lookups = {
+        'owner': 'owner',
+        'currency': 'currency',
+    }
+
+
+class OwnerTotalsFilter(QueryParamsFilter):
+    lookups = {
+        'owner': 'owner',
+        'currency': 'currency',
+    }
+
+
+class PaymentsFilter(QueryParamsFilter):
+    """
+    Payments are stored as single transfer rows, but are filtered as their incoming and outgoing legs are.
+    So a transfer matches, if any of its legs does, and `filter_legs` leaves only matching legs of transfers.
+    Transfers of both legs are found by their own queries, that are merged by `MergedQuery`, so each of them is
+    an index search in the order of the list, while an OR of them would be sorted after the search.
+    The incoming leg of a converted transfer is in the currency of its destination account, see `FxConversion`.
+    """
+    lookups = {
+        'min_id': 'pk__gte',
+        'max_id': 'pk__lte',
+    }
+    integer_params = ('min_id', 'max_id')
+    leg_lookups = {
+        'to_account': 'to_account_id',
+        'from_account': 'from_account_id',
+        'direction': 'direction',
+        'currency': 'currency',
+    }
+
+    def get_leg_filters(self, request) -> dict:
+        return {
+            lookup: request.query_params[param]
+            for param, lookup in self.leg_lookups.items() if request.query_params.get(param)
+        }
+
+    def filter_queryset(self, request, queryset, view):
+        queryset = super().filter_queryset(request, queryset, view)
+        leg_filters = self.get_leg_filters(request)
+        direction = leg_filters.pop('direction', None)
+        currency = leg_filters.pop('currency', None)
+        if not leg_filters and direction is None and currency is None:
+            return queryset
+
+        # outgoing leg is the stored transfer, incoming one has accounts swapped
+        swapped_lookups = {'to_account_id': 'from_account_id', 'from_account_id': 'to_account_id'}
+        outgoing = Q(**leg_filters)
+        incoming = Q(**{swapped_lookups[lookup]: value for lookup, value in leg_filters.items()})
+        conditions = []
+        if direction in (None, PAYMENT_DIRECTIONS_OUTGOING):
+            conditions.append(outgoing if currency is None else outgoing & Q(currency=currency))
+        if direction in (None, PAYMENT_DIRECTIONS_INCOMING):
+            if currency is None:
+                conditions.append(incoming)
+            else:
+                if not conditions or leg_filters:
+                    # legs of transfers in one currency, unless they are matched by outgoing legs already
+                    conditions.append(incoming & Q(currency=currency, to_currency=''))
+                conditions.append(incoming & Q(to_currency=currency))
+        if not conditions:
+            return queryset.none()
+        if len(conditions) == 1:
+            return queryset.filter(conditions[0])
+        # a transfer may match both legs, e.g. a transfer to the same account
+        return MergedQuery((queryset.filter(condition) for condition in conditions), distinct=True)
+
+    def filter_legs(self, request, legs: Iterable[dict]) -> List[dict]:
+        """
+        Leaves only matching legs, given in their serialized form
+        """
+        leg_params = {
+            param: request.query_params[param] for param in self.leg_lookups if request.query_params.get(param)
+        }
+        if not leg_params:
+            return list(legs)
+        return [leg for leg in legs if all(leg[param] == value for param, value in leg_params.items())]
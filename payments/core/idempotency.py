@@ -0,0 +1,91 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from core import sharding
+from core.cache import LRUCache
+from core.errors import IdempotencyKeyReused
+from core.models import IdempotencyKey
+
+IDEMPOTENCY_KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+# responses of recently seen keys, so replayed requests do not touch the database at all:
+# {key: (fingerprint of the request, status, body, time of the key)}, entries expire after IDEMPOTENCY_KEY_TTL,
+# as keys are purged from the database
+_responses = LRUCache(settings.IDEMPOTENCY_CACHE_SIZE)
+
+
+def get_key(request) -> Optional[str]:
+    return request.META.get(IDEMPOTENCY_KEY_HEADER) or None
+
+
+def fingerprint(data) -> str:
+    """
+    Hash of the canonical JSON of the parsed body of the request
+    """
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _is_expired(created_at: datetime) -> bool:
+    return created_at + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL) <= timezone.now()
+
+
+def get_response(key: str, request_fingerprint: str) -> Optional[Tuple[int, dict]]:
+    """
+    Status and body of the response, that was given to the first request with this key,
+    or None if there was no such request yet.
+    Raises IdempotencyKeyReused, if the first request had another body
+    """
+    entry = _responses.get(key)
+    if entry is not None and _is_expired(entry[3]):
+        _responses.delete(key)
+        entry = None
+    if entry is None:
+        # keys are stored in shards of source accounts of their payments
+        records = (
+            IdempotencyKey.objects.using(alias).filter(key=key).only(
+                'request_fingerprint', 'response_status', 'response_body', 'created_at',
+            ).first()
+            for alias in sharding.shards()
+        )
+        record = next((record for record in records if record is not None), None)
+        if record is None:
+            return None
+        entry = (
+            record.request_fingerprint, record.response_status, json.loads(record.response_body),
+            record.created_at,
+        )
+        # keys past their TTL are replayed until they are purged, but they are not cached
+        if not _is_expired(record.created_at):
+            _responses.set(key, entry)
+
+    stored_fingerprint, response_status, body, _ = entry
+    if stored_fingerprint != request_fingerprint:
+        raise IdempotencyKeyReused()
+    return response_status, body
+
+
+def new_record(key: str, request_fingerprint: str, status: int, body: dict) -> IdempotencyKey:
+    """
+    Not saved record of the response, it has to be saved in the transaction, that makes the payment
+    """
+    return IdempotencyKey(
+        key=key, request_fingerprint=request_fingerprint, response_status=status, response_body=json.dumps(body),
+    )
+
+
+def remember(record: IdempotencyKey):
+    """
+    Caches response of the saved record, once it is committed
+    """
+    entry = (
+        record.request_fingerprint, record.response_status, json.loads(record.response_body),
+        record.created_at,
+    )
+    transaction.on_commit(lambda: _responses.set(record.key, entry))
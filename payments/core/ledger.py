@@ -0,0 +1,243 @@
+"""
+Ledger of accounts: balances at points in time and consistency checks.
+
+Every payment is a ledger entry of both of its accounts, numbered by sequences of them (`Payment.from_sequence`,
+`Payment.to_sequence`, the last one is `Account.sequence`) and timestamped. The first entry of an account saves
+its opening balance as a snapshot, and the balance is saved again every BALANCE_SNAPSHOT_INTERVAL entries
+(`BalanceSnapshot`), in the transaction of the payment. So the balance at any time is the balance of the latest
+snapshot before it, changed by entries after the snapshot, and there are fewer of them than the interval.
+Checks read the same bounded tails of the ledger: an account is checked against its latest snapshot,
+and a snapshot against the previous one, so amounts of the payments table are never read in full. Entries
+of an account are numbered from 1 to its sequence once each, that is checked with indexes of sequences only.
+The ledger of an account is stored in its shard, see `core.sharding`, and shards are checked one by one.
+Incoming entries of converted transfers change balances by their credited amounts, see `FxConversion`.
+Credits pending in balance buckets of hot accounts are entries without sequences, until they are consolidated,
+see `BalanceBucket`.
+"""
+from datetime import datetime
+from decimal import Decimal
+from typing import Iterator, Optional, Tuple
+
+from django.db import DEFAULT_DB_ALIAS, models
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from core import sharding
+from core.errors import UnknownAccount
+from core.models import Account, BalanceBucket, BalanceSnapshot, Payment
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# amount of an incoming entry, in the currency of its account
+CREDIT_AMOUNT = Coalesce('to_amount', 'amount')
+
+# (account_id, snapshot_id or None for the account, sequence, expected_sequence, balance, expected_balance),
+# expected values are None, when there is no snapshot to check against
+Discrepancy = Tuple[str, Optional[int], int, Optional[int], Decimal, Optional[Decimal]]
+
+
+def balance_at(account_id: str, at: datetime) -> Tuple[Decimal, int]:
+    """
+    Balance of the account at the time `at`, and the sequence of its last ledger entry made by then.
+    Raises UnknownAccount
+    """
+    using = sharding.shard_for(account_id)
+    # the opening balance is the balance before the first entry, whenever it was made
+    snapshot = (
+        BalanceSnapshot.objects.using(using).filter(Q(created_at__lte=at) | Q(sequence=0), account_id=account_id)
+        .order_by('-created_at', '-sequence').values_list('sequence', 'balance').first()
+    )
+    if snapshot is None:
+        # accounts without entries have their current balances ever, but for credits pending in their buckets
+        account = Account.objects.using(using).filter(pk=account_id).values_list('balance', 'sequence').first()
+        if account is None:
+            raise UnknownAccount([account_id])
+        balance, sequence = account
+    else:
+        sequence, balance = snapshot
+    # credits pending in balance buckets are reported as a part of the balance, they have no sequences yet
+    incoming = Q(to_account_id=account_id) & (Q(to_sequence__gt=sequence) | Q(to_sequence__isnull=True))
+    outgoing = Q(from_account_id=account_id, from_sequence__gt=sequence)
+    entries = Payment.objects.using(using).filter(incoming | outgoing, created_at__lte=at).aggregate(
+        incoming=Sum(CREDIT_AMOUNT, filter=incoming), outgoing=Sum('amount', filter=outgoing),
+        to_sequence=Max('to_sequence', filter=incoming), from_sequence=Max('from_sequence', filter=outgoing),
+    )
+    balance += (entries['incoming'] or 0) - (entries['outgoing'] or 0)
+    return balance, max(sequence, entries['to_sequence'] or 0, entries['from_sequence'] or 0)
+
+
+def _with_entries(queryset: models.QuerySet, account, after, upto=None) -> models.QuerySet:
+    """
+    `queryset` annotated with totals and numbers of incoming and outgoing ledger entries of `account`,
+    whose sequences are greater than `after` and are not greater than `upto`, all of them are expressions
+    """
+    amount_field = Payment._meta.get_field('amount')
+    for side, account_field, sequence_field, amount in (
+        ('incoming', 'to_account', 'to_sequence', CREDIT_AMOUNT),
+        ('outgoing', 'from_account', 'from_sequence', 'amount'),
+    ):
+        lookups = {account_field: account, sequence_field + '__gt': after}
+        if upto is not None:
+            lookups[sequence_field + '__lte'] = upto
+        entries = Payment.objects.filter(**lookups).order_by().values(account_field)
+        queryset = queryset.annotate(**{
+            side + '_amount': Coalesce(
+                Subquery(entries.annotate(total=Sum(amount)).values('total')), Value(Decimal(0)),
+                output_field=amount_field,
+            ),
+            side + '_entries': Coalesce(
+                Subquery(entries.annotate(number=Count('pk')).values('number')), Value(0),
+                output_field=models.BigIntegerField(),
+            ),
+        })
+    return queryset
+
+
+def check_accounts(chunk_size: int = DEFAULT_CHUNK_SIZE, using: str = DEFAULT_DB_ALIAS) -> Iterator[Discrepancy]:
+    """
+    Accounts of the shard, whose balances or sequences differ from their latest snapshots changed by entries
+    after them, or whose balance buckets differ from their pending credits, then balances are reported with
+    buckets and with credits, or whose entries are not numbered 1 to their sequences once each, then the last
+    sequence of entries is expected, or the number of distinct ones, when the last one is the sequence.
+    Accounts are read in chunks, each of them with one query.
+    """
+    amount_field = Payment._meta.get_field('amount')
+    latest = BalanceSnapshot.objects.filter(account=OuterRef('pk')).order_by('-sequence')
+    buckets = BalanceBucket.objects.filter(account=OuterRef('pk')).order_by().values('account')
+    pending = Payment.objects.filter(
+        to_account=OuterRef('pk'), to_sequence__isnull=True,
+    ).order_by().values('to_account')
+    accounts = Account.objects.using(using).order_by('pk').annotate(
+        snapshot_sequence=Subquery(latest.values('sequence')[:1]),
+        snapshot_balance=Subquery(latest.values('balance')[:1]),
+        buckets_amount=Coalesce(
+            Subquery(buckets.annotate(total=Sum('balance')).values('total')), Value(Decimal(0)),
+            output_field=amount_field,
+        ),
+        pending_amount=Coalesce(
+            Subquery(pending.annotate(total=Sum(CREDIT_AMOUNT)).values('total')), Value(Decimal(0)),
+            output_field=amount_field,
+        ),
+    )
+    accounts = _with_sequences(accounts)
+    accounts = _with_entries(accounts, OuterRef('pk'), OuterRef('snapshot_sequence')).values_list(
+        'pk', 'sequence', 'balance', 'snapshot_sequence', 'snapshot_balance', 'buckets_amount', 'pending_amount',
+        'last_sequence', 'distinct_sequences', 'incoming_amount', 'incoming_entries', 'outgoing_amount',
+        'outgoing_entries',
+    )
+
+    last_pk = ''
+    while True:
+        chunk = list(accounts.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+        for (
+            pk, sequence, balance, snapshot_sequence, snapshot_balance, buckets_amount, pending_amount,
+            last_sequence, distinct_sequences, *entries
+        ) in chunk:
+            if buckets_amount != pending_amount:
+                yield pk, None, sequence, sequence, balance + buckets_amount, balance + pending_amount
+                continue
+            if snapshot_sequence is None:
+                # the ledger of the account is empty
+                if sequence:
+                    yield pk, None, sequence, None, balance, None
+                continue
+            if last_sequence != sequence:
+                yield pk, None, sequence, last_sequence, balance, balance
+                continue
+            if distinct_sequences != sequence:
+                # sequences of entries are duplicated, and others are missing
+                yield pk, None, sequence, distinct_sequences, balance, balance
+                continue
+            expected_sequence, expected_balance = _apply(snapshot_sequence, snapshot_balance, *entries)
+            if (sequence, balance) != (expected_sequence, expected_balance):
+                yield pk, None, sequence, expected_sequence, balance, expected_balance
+
+
+def _with_sequences(accounts: models.QuerySet) -> models.QuerySet:
+    """
+    Accounts annotated with the last sequence of their ledger entries, and with the number of distinct sequences
+    of them, an outgoing and an incoming entry with the same sequence are counted once
+    """
+    number_field = models.BigIntegerField()
+    outgoing = Payment.objects.filter(from_account=OuterRef('pk')).order_by().values('from_account')
+    incoming = Payment.objects.filter(
+        to_account=OuterRef('pk'), to_sequence__isnull=False,
+    ).order_by().values('to_account')
+    both = outgoing.filter(
+        from_sequence__in=Payment.objects.filter(to_account=OuterRef(OuterRef('pk'))).values('to_sequence'),
+    )
+    sequences = {}
+    for name, entries, expression in (
+        ('outgoing', outgoing, Count('from_sequence', distinct=True)),
+        ('incoming', incoming, Count('to_sequence', distinct=True)),
+        ('both', both, Count('from_sequence', distinct=True)),
+    ):
+        sequences[name] = Coalesce(
+            Subquery(entries.annotate(number=expression).values('number')), Value(0), output_field=number_field,
+        )
+    last = {
+        name: Coalesce(
+            Subquery(entries.annotate(last=Max(field)).values('last')), Value(0), output_field=number_field,
+        )
+        for name, entries, field in (('outgoing', outgoing, 'from_sequence'), ('incoming', incoming, 'to_sequence'))
+    }
+    return accounts.annotate(
+        last_sequence=Greatest(last['outgoing'], last['incoming']),
+        distinct_sequences=sequences['outgoing'] + sequences['incoming'] - sequences['both'],
+    )
+
+
+def check_snapshots(
+    after_id: int = 0, upto_id: Optional[int] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+    using: str = DEFAULT_DB_ALIAS,
+) -> Iterator[Discrepancy]:
+    """
+    Snapshots of the shard with ids in (after_id, upto_id], whose balances differ from previous snapshots of their
+    accounts changed by entries between them, so snapshots are checked once each, run after run.
+    Opening balances are not checked, there is nothing before them.
+    """
+    previous = BalanceSnapshot.objects.filter(
+        account=OuterRef('account'), sequence__lt=OuterRef('sequence'),
+    ).order_by('-sequence')
+    snapshots = BalanceSnapshot.objects.using(using).filter(sequence__gt=0).order_by('pk').annotate(
+        previous_sequence=Subquery(previous.values('sequence')[:1]),
+        previous_balance=Subquery(previous.values('balance')[:1]),
+    )
+    if upto_id is not None:
+        snapshots = snapshots.filter(pk__lte=upto_id)
+    snapshots = _with_entries(
+        snapshots, OuterRef('account'), OuterRef('previous_sequence'), OuterRef('sequence'),
+    ).values_list(
+        'pk', 'account_id', 'sequence', 'balance', 'previous_sequence', 'previous_balance',
+        'incoming_amount', 'incoming_entries', 'outgoing_amount', 'outgoing_entries',
+    )
+
+    last_pk = after_id
+    while True:
+        chunk = list(snapshots.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+        for pk, account_id, sequence, balance, previous_sequence, previous_balance, *entries in chunk:
+            if previous_sequence is None:
+                yield account_id, pk, sequence, None, balance, None
+                continue
+            expected_sequence, expected_balance = _apply(previous_sequence, previous_balance, *entries)
+            if (sequence, balance) != (expected_sequence, expected_balance):
+                yield account_id, pk, sequence, expected_sequence, balance, expected_balance
+
+
+def _apply(
+    sequence: int, balance: Decimal, incoming_amount: Decimal, incoming_entries: int, outgoing_amount: Decimal,
+    outgoing_entries: int,
+) -> Tuple[int, Decimal]:
+    """
+    Sequence and balance after the entries
+    """
+    return (
+        sequence + incoming_entries + outgoing_entries,
+        balance + incoming_amount - outgoing_amount,
+    )
@@ -0,0 +1,65 @@
+import inspect
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.benchmarks import api, contention, metrics, polling, renderers, serializers, servers, sqlite, startup
+
+BENCHMARKS = {
+    'api': api.run,
+    'contention': contention.run,
+    'metrics': metrics.run,
+    'polling': polling.run,
+    'renderers': renderers.run,
+    'serializers': serializers.run,
+    'servers': servers.run,
+    'sqlite': sqlite.run,
+    'startup': startup.run,
+}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Runs benchmarks on a temporary test database and prints their results as JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+        parser.add_argument('--rows', type=int, nargs='+', help="Numbers of rows to benchmark with.")
+        parser.add_argument('--repeat', type=int, help="Runs of every measurement, the best one is taken.")
+        parser.add_argument('--accounts', type=int, help="Number of accounts to seed.")
+        parser.add_argument('--requests', type=int, help="Number of requests of every measurement.")
+        parser.add_argument('--threads', type=int, nargs='+', help="Numbers of concurrent clients.")
+        parser.add_argument('--workers', type=int, help="Number of sync workers, that serve WSGI requests.")
+        parser.add_argument('--buckets', type=int, nargs='+', help="Numbers of balance buckets of the hot account.")
+        parser.add_argument('--output', help="File to append results to, for comparison across commits.")
+
+    def handle(self, *args, **options):
+        benchmark = BENCHMARKS[options['benchmark']]
+        parameters = inspect.signature(benchmark).parameters
+        kwargs = {}
+        for name in ('rows', 'repeat', 'accounts', 'requests', 'threads', 'workers', 'buckets'):
+            if options[name] is None:
+                continue
+            if name not in parameters:
+                raise CommandError("--{} is not supported by the {} benchmark".format(name, options['benchmark']))
+            kwargs[name] = options[name]
+
+        context = {'commit': _commit(), 'database': connection.vendor}
+        lines = []
+        for result in benchmark(**kwargs):
+            line = json.dumps(dict(result, **context))
+            lines.append(line)
+            self.stdout.write(line)
+        if options['output']:
+            with open(options['output'], 'a') as output:
+                output.writelines(line + '\n' for line in lines)
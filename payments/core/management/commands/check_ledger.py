@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max
+
+from core import sharding
+from core.ledger import DEFAULT_CHUNK_SIZE, check_accounts, check_snapshots
+from core.models import BalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = "Checks balances of accounts and balance snapshots against the ledger of payments, fails on discrepancies"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--after-snapshot', type=int, default=0,
+            help="Check snapshots with greater ids only, the last checked id is printed by every run.",
+        )
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS, choices=sharding.shards(),
+            help="Shard to check, ids of snapshots are counted in every shard, so each of them is checked by its runs.",
+        )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        # snapshots saved while accounts are checked are left to the next run
+        upto_id = BalanceSnapshot.objects.using(using).aggregate(last=Max('pk'))['last'] or 0
+        upto_id = max(upto_id, options['after_snapshot'])
+        discrepancies = list(check_accounts(options['chunk_size'], using))
+        discrepancies += check_snapshots(options['after_snapshot'], upto_id, options['chunk_size'], using)
+
+        for account_id, snapshot_id, sequence, expected_sequence, balance, expected_balance in discrepancies:
+            self.stdout.write("Account {}{}: sequence {}, expected {}; balance {}, expected {}".format(
+                account_id, '' if snapshot_id is None else ' snapshot {}'.format(snapshot_id),
+                sequence, expected_sequence, balance, expected_balance,
+            ))
+        self.stdout.write("Checked snapshots up to id {}".format(upto_id))
+        if discrepancies:
+            raise CommandError("Found {} discrepancies".format(len(discrepancies)))
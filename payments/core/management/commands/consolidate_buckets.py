@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core import sharding
+from core.models import Account
+
+
+class Command(BaseCommand):
+    help = "Moves credits pending in balance buckets to balances of their accounts, e.g. before reports"
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', help="Accounts to consolidate, all with buckets by default.")
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.filter(buckets__gt=0).order_by('pk')
+        if options['account_ids']:
+            accounts = accounts.filter(pk__in=options['account_ids'])
+        credits = 0
+        count = 0
+        for account in list(sharding.fan_out(accounts)):
+            credits += account.consolidate_buckets()
+            count += 1
+        self.stdout.write("Consolidated {} credits of {} accounts".format(credits, count))
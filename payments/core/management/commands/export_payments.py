@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.export import DEFAULT_CHUNK_SIZE, FORMAT_NDJSON, FORMATS, export_payments
+
+
+class Command(BaseCommand):
+    help = "Exports payments in the order of their ids, as a JSON array or as newline delimited JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default=FORMAT_NDJSON, dest='export_format')
+        parser.add_argument('--after', type=int, default=0, help="Export payments with greater ids only, to resume.")
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--output', help="File to write to, default is stdout.")
+
+    def handle(self, *args, **options):
+        chunks = export_payments(options['export_format'], options['after'], options['chunk_size'])
+        if not options['output']:
+            for data in chunks:
+                self.stdout.write(data, ending='')
+            return
+        with open(options['output'], 'w') as output:
+            output.writelines(chunks)
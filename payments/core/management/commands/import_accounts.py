@@ -0,0 +1,55 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.provisioning import DEFAULT_BATCH_SIZE, FORMAT_CSV, FORMAT_NDJSON, FORMATS, import_accounts, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates accounts with opening balances from CSV with id, owner, balance and currency columns, or from "
+        "newline delimited JSON objects with these fields. Invalid rows and rows with used ids are reported and skipped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="File to read, - is stdin.")
+        parser.add_argument(
+            '--format', choices=FORMATS, dest='input_format',
+            help="Format of the input, by the extension of the file by default, NDJSON for stdin.",
+        )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("Batch size must be positive")
+        input_format = options['input_format']
+        if input_format is None:
+            input_format = FORMAT_CSV if options['input'].lower().endswith('.csv') else FORMAT_NDJSON
+
+        if options['input'] == '-':
+            self._import(sys.stdin, input_format, options['batch_size'])
+            return
+        try:
+            stream = open(options['input'], newline='' if input_format == FORMAT_CSV else None)
+        except OSError as e:
+            raise CommandError("Can not read {}: {}".format(options['input'], e))
+        with stream:
+            self._import(stream, input_format, options['batch_size'])
+
+    def _import(self, stream, input_format: str, batch_size: int):
+        started = time.perf_counter()
+        created = rejected = 0
+        for batch_created, rejections in import_accounts(read_rows(stream, input_format), batch_size):
+            created += batch_created
+            rejected += len(rejections)
+            for number, account_id, error in rejections:
+                self.stderr.write("Row {}{}: {}{}".format(
+                    number, '' if account_id is None else ' ({})'.format(account_id), error.code,
+                    '' if getattr(error, 'errors', None) is None else ' ' + json.dumps(error.errors),
+                ))
+        seconds = time.perf_counter() - started
+        self.stdout.write("Created {} accounts, rejected {} rows in {:.2f}s, {:.0f} rows/s".format(
+            created, rejected, seconds, (created + rejected) / seconds if seconds else 0,
+        ))
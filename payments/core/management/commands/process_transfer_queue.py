@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import transfer_queue
+
+
+class Command(BaseCommand):
+    help = "Makes queued transfers in group commits, polls the queue until it is stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=transfer_queue.DEFAULT_BATCH_SIZE,
+            help="Maximum number of transfers made in one transaction.",
+        )
+        parser.add_argument('--poll-interval', type=float, default=0.1, help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty.")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            processed = transfer_queue.process_batch(options['batch_size'])
+            total += processed
+            if processed:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+        self.stdout.write("Processed {} transfers".format(total))
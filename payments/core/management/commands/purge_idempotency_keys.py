@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core import sharding
+from core.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Deletes idempotency keys of payment requests, that are older than IDEMPOTENCY_KEY_TTL"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl', type=int, default=settings.IDEMPOTENCY_KEY_TTL,
+            help="Age of keys to delete, in seconds. Default is IDEMPOTENCY_KEY_TTL setting.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help="Number of keys deleted with one query, so the table is not locked for long.",
+        )
+
+    def handle(self, *args, **options):
+        deleted = 0
+        for alias in sharding.shards():
+            expired_keys = IdempotencyKey.objects.using(alias).filter(
+                created_at__lt=timezone.now() - timedelta(seconds=options['ttl'])
+            ).order_by('pk')
+
+            while True:
+                pks = list(expired_keys.values_list('pk', flat=True)[:options['batch_size']])
+                if not pks:
+                    break
+                deleted += IdempotencyKey.objects.using(alias).filter(pk__in=pks).delete()[0]
+
+        self.stdout.write("Deleted {} idempotency keys".format(deleted))
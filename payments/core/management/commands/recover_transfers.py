@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import CrossShardTransfer
+
+
+class Command(BaseCommand):
+    help = "Finishes cross-shard transfers, that were left by their coordinators, e.g. by stopped processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--timeout', type=int, default=settings.CROSS_SHARD_PREPARE_TIMEOUT,
+            help="Transfers, that are not decided for this number of seconds, are aborted. "
+                 "Default is CROSS_SHARD_PREPARE_TIMEOUT setting.",
+        )
+
+    def handle(self, *args, **options):
+        count = CrossShardTransfer.recover(timezone.now() - timedelta(seconds=options['timeout']))
+        self.stdout.write("Finished {} transfers".format(count))
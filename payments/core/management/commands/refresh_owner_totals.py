@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import sharding
+from core.models import OwnerTotal
+
+
+class Command(BaseCommand):
+    help = "Computes totals of owners from their accounts, e.g. after accounts were created with bulk_create"
+
+    def add_arguments(self, parser):
+        parser.add_argument('owners', nargs='*', help="Owners to compute totals of, all of them by default.")
+
+    def handle(self, *args, **options):
+        count = 0
+        for alias in sharding.shards():
+            with transaction.atomic(using=alias):
+                count += OwnerTotal.refresh(options['owners'] or None, alias)
+        self.stdout.write("Computed {} owner totals".format(count))
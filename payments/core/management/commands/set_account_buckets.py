@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import sharding
+from core.models import Account
+
+
+class Command(BaseCommand):
+    help = "Spreads credits of a hot account across balance buckets, 0 buckets turn them off"
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_id')
+        parser.add_argument('buckets', type=int)
+
+    def handle(self, *args, **options):
+        if options['buckets'] < 0:
+            raise CommandError("Number of buckets can not be negative")
+        try:
+            account = Account.objects.using(sharding.shard_for(options['account_id'])).get(pk=options['account_id'])
+        except Account.DoesNotExist:
+            raise CommandError("Unknown account: {}".format(options['account_id']))
+        account.set_buckets(options['buckets'])
+        self.stdout.write("Set {} balance buckets of account {}".format(account.buckets, account.pk))
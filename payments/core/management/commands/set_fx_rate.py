@@ -0,0 +1,29 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from core.const import CURRENCIES
+from core.models import FxRate
+
+
+class Command(BaseCommand):
+    help = "Sets the rate of conversion of amounts from one currency to another, as its next version"
+
+    def add_arguments(self, parser):
+        parser.add_argument('from_currency', choices=CURRENCIES)
+        parser.add_argument('to_currency', choices=CURRENCIES)
+        parser.add_argument('rate', help="Amount of `to_currency`, that one unit of `from_currency` is worth.")
+
+    def handle(self, *args, **options):
+        try:
+            rate = Decimal(options['rate'])
+        except InvalidOperation:
+            raise CommandError("Invalid rate: {}".format(options['rate']))
+        try:
+            fx_rate = FxRate.set_rate(options['from_currency'], options['to_currency'], rate)
+        except ValidationError as e:
+            raise CommandError("; ".join(e.messages))
+        self.stdout.write("Set {} {} rate {} version {}".format(
+            fx_rate.from_currency, fx_rate.to_currency, fx_rate.rate, fx_rate.version,
+        ))
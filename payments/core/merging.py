@@ -0,0 +1,106 @@
+"""
+Read only queries, whose rows are merged from several querysets in the order of the query.
+
+Every queryset is ordered and limited by the database on its own, so each of them can be served by its own index,
+where one query with OR of their filters would be sorted after it is read. Querysets may be of different databases,
+e.g. of shards, see `core.sharding`.
+"""
+import heapq
+from itertools import groupby, islice
+from typing import Callable, Iterable, Optional
+
+
+class MergedQuery:
+    """
+    Read only query of the union of querysets of one model, their rows are merged in the order of the query.
+    It supports what list views and pagination use: filter, exclude, order_by, only, values_list, using,
+    iteration, slicing and chunked iteration, so it can be paginated as a queryset.
+    With `distinct` a row found by several querysets is returned once, querysets have to be ordered by a unique key.
+    With `combine` rows with equal keys of the ordering are combined into one by it, so slices count combined rows.
+    """
+    def __init__(
+        self, querysets: Iterable, distinct: bool = False, combine: Optional[Callable[[list], object]] = None,
+    ):
+        self.querysets = tuple(querysets)
+        self.model = self.querysets[0].model
+        self.distinct = distinct
+        self.combine = combine
+
+    def _chain(self, method: str, *args, **kwargs) -> 'MergedQuery':
+        return MergedQuery(
+            (getattr(queryset, method)(*args, **kwargs) for queryset in self.querysets), self.distinct,
+            self.combine,
+        )
+
+    def filter(self, *args, **kwargs) -> 'MergedQuery':
+        return self._chain('filter', *args, **kwargs)
+
+    def exclude(self, *args, **kwargs) -> 'MergedQuery':
+        return self._chain('exclude', *args, **kwargs)
+
+    def order_by(self, *fields) -> 'MergedQuery':
+        return self._chain('order_by', *fields)
+
+    def only(self, *fields) -> 'MergedQuery':
+        return self._chain('only', *fields)
+
+    def values_list(self, *fields, **kwargs) -> 'MergedQuery':
+        return self._chain('values_list', *fields, **kwargs)
+
+    def using(self, alias: str) -> 'MergedQuery':
+        return self._chain('using', alias)
+
+    def _merge(self, limit: Optional[int] = None, chunk_size: Optional[int] = None):
+        first = self.querysets[0]
+        ordering = list(first.query.order_by or self.model._meta.ordering)
+        descending = {field.startswith('-') for field in ordering}
+        if len(descending) > 1:
+            raise ValueError("Rows are merged in one direction only, ordering is {}".format(ordering))
+        fields = [field.lstrip('-') for field in ordering]
+        # rows of `values_list` are tuples, ordering fields are taken from them by positions
+        columns = list(first._fields or ())
+        if columns and not set(fields) <= set(columns):
+            raise ValueError("Rows are merged by {}, that are not selected".format(fields))
+        positions = [columns.index(field) for field in fields if field in columns]
+
+        def key(row):
+            if isinstance(row, dict):
+                return tuple(row[field] for field in fields)
+            if isinstance(row, tuple):
+                return tuple(row[position] for position in positions)
+            return tuple(getattr(row, field) for field in fields)
+
+        querysets = [queryset.order_by(*ordering) for queryset in self.querysets]
+        if limit is not None:
+            querysets = [queryset[:limit] for queryset in querysets]
+        if chunk_size is not None:
+            querysets = [queryset.iterator(chunk_size=chunk_size) for queryset in querysets]
+        rows = heapq.merge(*querysets, key=key, reverse=descending == {True})
+        if self.combine is not None:
+            # every queryset has a row per key at most, so the first `limit` combined rows are complete
+            return (self.combine(list(group)) for _, group in groupby(rows, key=key))
+        return self._unique(rows) if self.distinct else rows
+
+    @staticmethod
+    def _unique(rows):
+        # rows found by several querysets are equal, and are next to each other in the order of a unique key
+        previous = None
+        for row in rows:
+            if previous is None or row != previous:
+                yield row
+            previous = row
+
+    def __iter__(self):
+        return iter(self._merge())
+
+    def iterator(self, chunk_size: int = 2000):
+        """
+        Merged rows of querysets, that are read in chunks as `QuerySet.iterator` reads them
+        """
+        return self._merge(chunk_size=chunk_size)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError("Merged rows are taken by slices only")
+        # every queryset returns its first `stop` rows, merged rows are sliced as the query would be
+        return list(islice(self._merge(item.stop), item.start, item.stop))
@@ -0,0 +1,182 @@
+"""
+In-process histograms of request latencies and SQL queries, exposed in Prometheus text format.
+
+Histograms are kept per process, so every worker of a deployment has to be scraped on its own.
+Observing a value is a bisect over the bucket bounds and an increment under a lock, that is cheap enough
+to be done for every request and every payment.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Sequence, Tuple
+
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+
+HELP = {
+    'http_request_duration_seconds': "Total latency of requests.",
+    'http_request_db_queries': "SQL queries per request.",
+    'http_request_db_duration_seconds': "Time of SQL queries per request.",
+    'http_request_render_duration_seconds': "Time of rendering of response bodies.",
+    'account_pay_duration_seconds': "Latency of Account.pay.",
+    'account_pay_db_queries': "SQL queries per Account.pay.",
+    'account_pay_db_duration_seconds': "Time of SQL queries per Account.pay.",
+}
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # the last count is of the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def cumulative_counts(self) -> Iterator[Tuple[str, int]]:
+        with self._lock:
+            counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            yield str(bound), total
+
+
+_lock = threading.Lock()
+_histograms = {}  # type: Dict[str, Dict[Tuple[Tuple[str, str], ...], Histogram]]
+
+
+def observe(name: str, value: float, labels: Dict[str, str], buckets: Sequence[float] = SECONDS_BUCKETS):
+    key = tuple(sorted(labels.items()))
+    series = _histograms.get(name)
+    histogram = series.get(key) if series is not None else None
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(name, {}).setdefault(key, Histogram(buckets))
+    histogram.observe(value)
+
+
+def get_histogram(name: str, **labels) -> Histogram:
+    return _histograms[name][tuple(sorted(labels.items()))]
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+class QueryMeter:
+    """
+    Database execute wrapper, that counts queries and their time
+    """
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+# meter of the current request or operation; a context variable follows requests of async views
+# into the thread of sync code, where their queries are made, so concurrent requests are counted apart
+_current_meter = contextvars.ContextVar('query_meter', default=None)
+
+
+def _execute(execute, sql, params, many, context):
+    meter = _current_meter.get()
+    if meter is None:
+        return execute(sql, params, many, context)
+    return meter(execute, sql, params, many, context)
+
+
+def _install(connection):
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _execute)
+
+
+@receiver(connection_created)
+def _on_connection_created(sender, connection, **kwargs):
+    _install(connection)
+
+
+@contextmanager
+def metered(meter: QueryMeter):
+    """
+    Counts queries of the block by the meter, including queries of sync code, that it calls in other threads
+    """
+    _install(connection)
+    token = _current_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _current_meter.reset(token)
+
+
+@contextmanager
+def measure(operation: str, **labels):
+    """
+    Observes latency, number and time of SQL queries of the block as `<operation>_*` histograms.
+    Queries are counted by the meter of the enclosing request if there is one, so they are not wrapped twice.
+    """
+    meter = _current_meter.get()
+    if meter is None:
+        with metered(QueryMeter()), measure(operation, **labels):
+            yield
+        return
+
+    queries, db_seconds = meter.queries, meter.db_seconds
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(operation + '_duration_seconds', time.perf_counter() - started, labels)
+        observe(operation + '_db_queries', meter.queries - queries, labels, QUERIES_BUCKETS)
+        observe(operation + '_db_duration_seconds', meter.db_seconds - db_seconds, labels)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], **extra) -> str:
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+def render() -> str:
+    """
+    All histograms in Prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        metrics = sorted((name, sorted(series.items())) for name, series in _histograms.items())
+    for name, series in metrics:
+        if name in HELP:
+            lines.append('# HELP {} {}'.format(name, HELP[name]))
+        lines.append('# TYPE {} histogram'.format(name))
+        for labels, histogram in series:
+            for bound, count in histogram.cumulative_counts():
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, le=bound), count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), repr(histogram.sum)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+    return '\n'.join(lines) + '\n'
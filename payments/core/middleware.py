@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+from core import metrics
+
+
+class MetricsMiddleware:
+    """
+    Observes latency, SQL queries and rendering time of every request into `core.metrics` histograms,
+    labelled by the view and the method, and reports them to the client in `Server-Timing` header.
+    It should be the first middleware, so that the latency includes all the others.
+    It is async capable, so under ASGI the chain of middleware and async views are not run in the thread of sync code.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the instance as a coroutine function for the handler, as `MiddlewareMixin` of Django does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        meter, started = self._start(request)
+        with metrics.metered(meter):
+            response = self.get_response(request)
+        return self._finish(request, response, meter, started)
+
+    async def __acall__(self, request):
+        meter, started = self._start(request)
+        with metrics.metered(meter):
+            response = await self.get_response(request)
+        return self._finish(request, response, meter, started)
+
+    @staticmethod
+    def _start(request):
+        request.render_seconds = 0.0
+        return metrics.QueryMeter(), time.perf_counter()
+
+    @staticmethod
+    def _finish(request, response, meter, started):
+        total_seconds = time.perf_counter() - started
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        labels = {
+            'endpoint': resolver_match.func.__name__ if resolver_match is not None else 'unresolved',
+            'method': request.method,
+        }
+        metrics.observe('http_request_duration_seconds', total_seconds, labels)
+        metrics.observe('http_request_db_queries', meter.queries, labels, metrics.QUERIES_BUCKETS)
+        metrics.observe('http_request_db_duration_seconds', meter.db_seconds, labels)
+        metrics.observe('http_request_render_duration_seconds', request.render_seconds, labels)
+
+        response['Server-Timing'] = 'db;dur={:.3f};desc="{} queries", render;dur={:.3f}, total;dur={:.3f}'.format(
+            meter.db_seconds * 1000, meter.queries, request.render_seconds * 1000, total_seconds * 1000,
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        if response.is_rendered:
+            # rendered by an async view, that has set `render_seconds`, see `core.views.async_reads`
+            return response
+        # DRF responses are rendered right after this hook
+        started = time.perf_counter()
+
+        def rendered(response):
+            request.render_seconds = time.perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+class AsyncViewsMiddleware:
+    """
+    Routes requests, that are served by the ASGI handler, by ASYNC_URLCONF, whose read endpoints of lists are
+    async views, see `core.views.async_reads`. Under WSGI requests are routed by ROOT_URLCONF to sync views as ever,
+    async views there would need an event loop per request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        request.urlconf = settings.ASYNC_URLCONF
+        return await self.get_response(request)
@@ -0,0 +1,62 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='account',
+            options={'ordering': ['pk'], 'verbose_name': 'Account'},
+        ),
+        migrations.AlterModelOptions(
+            name='payment',
+            options={'ordering': ['-pk'], 'verbose_name': 'Payment'},
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='from_account',
+            field=models.ForeignKey(
+                db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='from_payments',
+                to='core.Account', verbose_name='Payment source account'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='to_account',
+            field=models.ForeignKey(
+                db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='to_payments',
+                to='core.Account', verbose_name='Payment destination account'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(fields=['owner', 'id'], name='account_owner_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(fields=['currency', 'id'], name='account_currency_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['to_account', '-id'], name='payment_to_account_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['from_account', '-id'], name='payment_from_account_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['currency', '-id'], name='payment_currency_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['direction', '-id'], name='payment_direction_idx'),
+        ),
+    ]
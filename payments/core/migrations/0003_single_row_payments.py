@@ -0,0 +1,94 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+DIRECTION_INCOMING = 'incoming'
+DIRECTION_OUTGOING = 'outgoing'
+CHUNK_SIZE = 2000
+
+
+def collapse_payment_pairs(apps, schema_editor):
+    """
+    Every transfer was stored as an outgoing payment, immediately followed by its mirrored incoming one.
+    Incoming payments with such a pair are deleted, incoming payments without it are turned into outgoing ones.
+    """
+    using = schema_editor.connection.alias
+    Payment = apps.get_model('core', 'Payment')
+    incoming_payments = Payment.objects.using(using).filter(direction=DIRECTION_INCOMING).order_by('pk')
+
+    last_pk = 0
+    while True:
+        chunk = list(incoming_payments.filter(pk__gt=last_pk)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+
+        pairs = Payment.objects.using(using).in_bulk([payment.pk - 1 for payment in chunk])
+        mirrored_pks = []
+        orphans = []
+        for payment in chunk:
+            pair = pairs.get(payment.pk - 1)
+            if pair is not None and (
+                pair.direction, pair.to_account_id, pair.from_account_id, pair.amount, pair.currency
+            ) == (
+                DIRECTION_OUTGOING, payment.from_account_id, payment.to_account_id, payment.amount, payment.currency
+            ):
+                mirrored_pks.append(payment.pk)
+            else:
+                payment.to_account_id, payment.from_account_id = payment.from_account_id, payment.to_account_id
+                payment.direction = DIRECTION_OUTGOING
+                orphans.append(payment)
+
+        Payment.objects.using(using).filter(pk__in=mirrored_pks).delete()
+        Payment.objects.using(using).bulk_update(orphans, ('to_account', 'from_account', 'direction'))
+
+
+def expand_payment_pairs(apps, schema_editor):
+    """
+    Stores the mirrored incoming payment for every transfer again. They get new pks, after all existing payments.
+    """
+    using = schema_editor.connection.alias
+    Payment = apps.get_model('core', 'Payment')
+    outgoing_payments = Payment.objects.using(using).filter(direction=DIRECTION_OUTGOING).order_by('pk')
+
+    last_pk = 0
+    while True:
+        chunk = list(outgoing_payments.filter(pk__gt=last_pk)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        Payment.objects.using(using).bulk_create([
+            Payment(
+                to_account_id=payment.from_account_id, from_account_id=payment.to_account_id,
+                direction=DIRECTION_INCOMING, amount=payment.amount, currency=payment.currency,
+            )
+            for payment in chunk
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(collapse_payment_pairs, expand_payment_pairs),
+        # default makes the removal reversible
+        migrations.AlterField(
+            model_name='payment',
+            name='direction',
+            field=models.CharField(
+                choices=[('incoming', 'incoming'), ('outgoing', 'outgoing')], default='outgoing', max_length=64,
+                verbose_name='Payment direction'
+            ),
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_direction_idx',
+        ),
+        migrations.RemoveField(
+            model_name='payment',
+            name='direction',
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_single_row_payments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True, verbose_name='Key')),
+                ('request_fingerprint', models.CharField(max_length=64, verbose_name='Request fingerprint')),
+                ('response_status', models.PositiveSmallIntegerField(verbose_name='Response status')),
+                ('response_body', models.TextField(verbose_name='Response body')),
+                (
+                    'created_at',
+                    models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Created at')
+                ),
+                (
+                    'payment',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Payment',
+                        verbose_name='Payment made by the request'
+                    )
+                ),
+            ],
+            options={
+                'verbose_name': 'Idempotency key',
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeCounter',
+            fields=[
+                ('slot', models.PositiveSmallIntegerField(primary_key=True, serialize=False, verbose_name='Slot')),
+                ('version', models.BigIntegerField(default=0, verbose_name='Version')),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Changed at')),
+            ],
+            options={
+                'verbose_name': 'Change counter',
+                'ordering': ['slot'],
+            },
+        ),
+    ]
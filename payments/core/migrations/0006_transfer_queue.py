@@ -0,0 +1,67 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_change_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=4, max_digits=20, verbose_name='Amount')),
+                (
+                    'currency',
+                    models.CharField(
+                        choices=[('PHP', 'PHP'), ('USD', 'USD'), ('EUR', 'EUR')], max_length=5, verbose_name='Currency'
+                    )
+                ),
+                (
+                    'status',
+                    models.CharField(
+                        choices=[('QUEUED', 'QUEUED'), ('CREATED', 'CREATED'), ('ERROR', 'ERROR')], default='QUEUED',
+                        max_length=10, verbose_name='Status'
+                    )
+                ),
+                ('error', models.CharField(blank=True, default='', max_length=50, verbose_name='Error code')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Processed at')),
+                (
+                    'from_account',
+                    models.ForeignKey(
+                        db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                        to='core.Account', verbose_name='Transfer source account'
+                    )
+                ),
+                (
+                    'payment',
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+',
+                        to='core.Payment', verbose_name='Payment made by the transfer'
+                    )
+                ),
+                (
+                    'to_account',
+                    models.ForeignKey(
+                        db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                        to='core.Account', verbose_name='Transfer destination account'
+                    )
+                ),
+            ],
+            options={
+                'verbose_name': 'Queued transfer',
+                'ordering': ['pk'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='queuedtransfer',
+            index=models.Index(fields=['status', 'id'], name='queued_transfer_status_idx'),
+        ),
+    ]
@@ -0,0 +1,141 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:09
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+import django.utils.timezone
+
+CHUNK_SIZE = 2000
+
+
+def number_ledger_entries(apps, schema_editor):
+    """
+    Existing payments become ledger entries of their accounts in the order of their ids, all of them got the time
+    of the migration. Opening balances of accounts are their current balances without all their payments,
+    and snapshots are saved as `BalanceSnapshot.due` saves them.
+    """
+    using = schema_editor.connection.alias
+    Account = apps.get_model('core', 'Account')
+    Payment = apps.get_model('core', 'Payment')
+    BalanceSnapshot = apps.get_model('core', 'BalanceSnapshot')
+    interval = settings.BALANCE_SNAPSHOT_INTERVAL
+
+    balances = defaultdict(Decimal)
+    for account_field, sign in (('to_account', -1), ('from_account', 1)):
+        totals = Payment.objects.using(using).order_by().values_list(account_field).annotate(total=Sum('amount'))
+        for account_id, total in totals:
+            balances[account_id] += sign * total
+    for account_id, balance in Account.objects.using(using).filter(pk__in=list(balances)).values_list('pk', 'balance'):
+        balances[account_id] += balance
+
+    sequences = defaultdict(int)
+    payments = Payment.objects.using(using).order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(payments.filter(pk__gt=last_pk)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+
+        snapshots = []
+        for payment in chunk:
+            from_account_id, to_account_id = payment.from_account_id, payment.to_account_id
+            for account_id in {from_account_id, to_account_id}:
+                if not sequences[account_id]:
+                    snapshots.append(BalanceSnapshot(
+                        account_id=account_id, sequence=0, balance=balances[account_id],
+                        created_at=payment.created_at,
+                    ))
+            sequences[from_account_id] += 1
+            payment.from_sequence = sequences[from_account_id]
+            sequences[to_account_id] += 1
+            payment.to_sequence = sequences[to_account_id]
+            balances[from_account_id] -= payment.amount
+            balances[to_account_id] += payment.amount
+
+            entries = 2 if from_account_id == to_account_id else 1
+            for account_id in {from_account_id, to_account_id}:
+                sequence = sequences[account_id]
+                if sequence // interval > (sequence - entries) // interval:
+                    snapshots.append(BalanceSnapshot(
+                        account_id=account_id, sequence=sequence, balance=balances[account_id],
+                        created_at=payment.created_at,
+                    ))
+
+        Payment.objects.using(using).bulk_update(chunk, ('from_sequence', 'to_sequence'))
+        BalanceSnapshot.objects.using(using).bulk_create(snapshots)
+
+    accounts = [Account(pk=account_id, sequence=sequence) for account_id, sequence in sequences.items()]
+    Account.objects.using(using).bulk_update(accounts, ('sequence',), batch_size=CHUNK_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_transfer_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='sequence',
+            field=models.BigIntegerField(default=0, verbose_name='Ledger sequence'),
+        ),
+        # existing payments get the time of the migration
+        migrations.AddField(
+            model_name='payment',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='from_sequence',
+            field=models.BigIntegerField(default=0, verbose_name='Source account sequence'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='to_sequence',
+            field=models.BigIntegerField(default=0, verbose_name='Destination account sequence'),
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.BigIntegerField(verbose_name='Ledger sequence')),
+                ('balance', models.DecimalField(decimal_places=4, max_digits=20, verbose_name='Balance')),
+                ('created_at', models.DateTimeField(verbose_name='Created at')),
+                (
+                    'account',
+                    models.ForeignKey(
+                        db_index=False, on_delete=django.db.models.deletion.PROTECT,
+                        related_name='balance_snapshots', to='core.account', verbose_name='Account'
+                    )
+                ),
+            ],
+            options={
+                'verbose_name': 'Balance snapshot',
+                'ordering': ['account', 'sequence'],
+            },
+        ),
+        migrations.RunPython(number_ledger_entries, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['to_account', 'to_sequence'], name='payment_to_sequence_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['from_account', 'from_sequence'], name='payment_from_sequence_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='balancesnapshot',
+            index=models.Index(fields=['account', 'created_at'], name='balance_snapshot_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='balancesnapshot',
+            constraint=models.UniqueConstraint(fields=('account', 'sequence'), name='balance_snapshot_sequence_uniq'),
+        ),
+    ]
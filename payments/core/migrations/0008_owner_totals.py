@@ -0,0 +1,97 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:14
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+CURRENCY_CHOICES = [('PHP', 'PHP'), ('USD', 'USD'), ('EUR', 'EUR')]
+BATCH_SIZE = 1000
+
+
+def count_owner_totals(apps, schema_editor):
+    """
+    Totals are computed from accounts, and volumes from payments, both with grouped queries
+    """
+    using = schema_editor.connection.alias
+    Account = apps.get_model('core', 'Account')
+    Payment = apps.get_model('core', 'Payment')
+    OwnerTotal = apps.get_model('core', 'OwnerTotal')
+    OwnerVolume = apps.get_model('core', 'OwnerVolume')
+
+    totals = Account.objects.using(using).order_by().values_list('owner', 'currency').annotate(
+        Sum('balance'), Count('pk'),
+    )
+    OwnerTotal.objects.using(using).bulk_create(
+        [
+            OwnerTotal(owner=owner, currency=currency, balance=balance, accounts=count)
+            for owner, currency, balance, count in totals
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+    volumes = {}
+    for direction, owner_field in (('outgoing', 'from_account__owner'), ('incoming', 'to_account__owner')):
+        rows = Payment.objects.using(using).order_by().annotate(day=TruncDate('created_at')).values_list(
+            owner_field, 'currency', 'day',
+        ).annotate(Sum('amount'), Count('pk'))
+        for owner, currency, day, amount, count in rows:
+            volume = volumes.setdefault((owner, currency, day), OwnerVolume(owner=owner, currency=currency, day=day))
+            setattr(volume, direction, amount)
+            setattr(volume, direction + '_payments', count)
+    OwnerVolume.objects.using(using).bulk_create(volumes.values(), batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OwnerTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owner', models.CharField(max_length=200, verbose_name='Account owner ID')),
+                ('currency', models.CharField(choices=CURRENCY_CHOICES, max_length=5, verbose_name='Currency')),
+                ('balance', models.DecimalField(decimal_places=4, default=0, max_digits=24, verbose_name='Balance')),
+                ('accounts', models.PositiveIntegerField(default=0, verbose_name='Number of accounts')),
+            ],
+            options={
+                'verbose_name': 'Owner total',
+                'ordering': ['owner', 'currency'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OwnerVolume',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owner', models.CharField(max_length=200, verbose_name='Account owner ID')),
+                ('currency', models.CharField(choices=CURRENCY_CHOICES, max_length=5, verbose_name='Currency')),
+                ('day', models.DateField(verbose_name='Day')),
+                (
+                    'outgoing',
+                    models.DecimalField(decimal_places=4, default=0, max_digits=24, verbose_name='Outgoing volume')
+                ),
+                ('outgoing_payments', models.PositiveIntegerField(default=0, verbose_name='Outgoing payments')),
+                (
+                    'incoming',
+                    models.DecimalField(decimal_places=4, default=0, max_digits=24, verbose_name='Incoming volume')
+                ),
+                ('incoming_payments', models.PositiveIntegerField(default=0, verbose_name='Incoming payments')),
+            ],
+            options={
+                'verbose_name': 'Owner volume',
+                'ordering': ['owner', 'currency', 'day'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ownervolume',
+            constraint=models.UniqueConstraint(fields=('owner', 'currency', 'day'), name='owner_volume_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='ownertotal',
+            constraint=models.UniqueConstraint(fields=('owner', 'currency'), name='owner_total_uniq'),
+        ),
+        migrations.RunPython(count_owner_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,151 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+CURRENCY_CHOICES = [('PHP', 'PHP'), ('USD', 'USD'), ('EUR', 'EUR')]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_owner_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrossShardTransfer',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='Payment ID')),
+                ('from_account', models.CharField(max_length=200, verbose_name='Source account ID')),
+                ('to_account', models.CharField(max_length=200, verbose_name='Destination account ID')),
+                ('amount', models.DecimalField(decimal_places=4, max_digits=20, verbose_name='Amount')),
+                ('currency', models.CharField(choices=CURRENCY_CHOICES, max_length=5, verbose_name='Currency')),
+                (
+                    'state',
+                    models.CharField(
+                        choices=[
+                            ('PREPARING', 'PREPARING'), ('COMMITTING', 'COMMITTING'), ('COMMITTED', 'COMMITTED'),
+                            ('ABORTING', 'ABORTING'), ('ABORTED', 'ABORTED'),
+                        ],
+                        default='PREPARING', max_length=10, verbose_name='State'
+                    )
+                ),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Changed at')),
+            ],
+            options={
+                'verbose_name': 'Cross-shard transfer',
+                'ordering': ['pk'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentIdBlock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_id', models.BigIntegerField(verbose_name='Next ID')),
+            ],
+            options={
+                'verbose_name': 'Payment id block',
+            },
+        ),
+        migrations.CreateModel(
+            name='PreparedTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transfer_id', models.BigIntegerField(verbose_name='Transfer ID')),
+                (
+                    'side',
+                    models.CharField(
+                        choices=[('DEBIT', 'DEBIT'), ('CREDIT', 'CREDIT')], max_length=6, verbose_name='Side'
+                    )
+                ),
+                ('account', models.CharField(max_length=200, verbose_name='Account ID')),
+                (
+                    'state',
+                    models.CharField(
+                        choices=[('PREPARED', 'PREPARED'), ('COMMITTED', 'COMMITTED'), ('ABORTED', 'ABORTED')],
+                        default='PREPARED', max_length=9, verbose_name='State'
+                    )
+                ),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+            ],
+            options={
+                'verbose_name': 'Prepared transfer',
+                'ordering': ['transfer_id', 'side'],
+            },
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='held',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Held amount'),
+        ),
+        # accounts of payments and of queued transfers may be stored in other shards
+        migrations.AlterField(
+            model_name='idempotencykey',
+            name='payment',
+            field=models.ForeignKey(
+                db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+',
+                to='core.payment', verbose_name='Payment made by the request'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='from_account',
+            field=models.ForeignKey(
+                db_constraint=False, db_index=False, on_delete=django.db.models.deletion.PROTECT,
+                related_name='from_payments', to='core.account', verbose_name='Payment source account'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='to_account',
+            field=models.ForeignKey(
+                db_constraint=False, db_index=False, on_delete=django.db.models.deletion.PROTECT,
+                related_name='to_payments', to='core.account', verbose_name='Payment destination account'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='queuedtransfer',
+            name='from_account',
+            field=models.ForeignKey(
+                db_constraint=False, db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                to='core.account', verbose_name='Transfer source account'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='queuedtransfer',
+            name='payment',
+            field=models.ForeignKey(
+                blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+', to='core.payment', verbose_name='Payment made by the transfer'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='queuedtransfer',
+            name='status',
+            field=models.CharField(
+                choices=[
+                    ('QUEUED', 'QUEUED'), ('PROCESSING', 'PROCESSING'), ('CREATED', 'CREATED'), ('ERROR', 'ERROR'),
+                ],
+                default='QUEUED', max_length=10, verbose_name='Status'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='queuedtransfer',
+            name='to_account',
+            field=models.ForeignKey(
+                db_constraint=False, db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+',
+                to='core.account', verbose_name='Transfer destination account'
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='preparedtransfer',
+            constraint=models.UniqueConstraint(fields=('transfer_id', 'side'), name='prepared_transfer_side_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='crossshardtransfer',
+            index=models.Index(fields=['state', 'id'], name='cross_shard_state_idx'),
+        ),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:37
+
+from django.db import migrations, models
+import django.utils.timezone
+
+CURRENCY_CHOICES = [('PHP', 'PHP'), ('USD', 'USD'), ('EUR', 'EUR')]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FxRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                (
+                    'from_currency',
+                    models.CharField(choices=CURRENCY_CHOICES, max_length=5, verbose_name='Source currency')
+                ),
+                (
+                    'to_currency',
+                    models.CharField(choices=CURRENCY_CHOICES, max_length=5, verbose_name='Destination currency')
+                ),
+                ('rate', models.DecimalField(decimal_places=10, max_digits=20, verbose_name='Rate')),
+                ('version', models.PositiveIntegerField(verbose_name='Version')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+            ],
+            options={
+                'verbose_name': 'FX rate',
+                'ordering': ['from_currency', 'to_currency', 'version'],
+            },
+        ),
+        migrations.AddField(
+            model_name='crossshardtransfer',
+            name='rate',
+            field=models.DecimalField(blank=True, decimal_places=10, max_digits=20, null=True, verbose_name='FX rate'),
+        ),
+        migrations.AddField(
+            model_name='crossshardtransfer',
+            name='rate_version',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='FX rate version'),
+        ),
+        migrations.AddField(
+            model_name='crossshardtransfer',
+            name='to_amount',
+            field=models.DecimalField(
+                blank=True, decimal_places=4, max_digits=20, null=True, verbose_name='Destination amount'
+            ),
+        ),
+        migrations.AddField(
+            model_name='crossshardtransfer',
+            name='to_currency',
+            field=models.CharField(
+                blank=True, choices=CURRENCY_CHOICES, default='', max_length=5, verbose_name='Destination currency'
+            ),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='rate',
+            field=models.DecimalField(blank=True, decimal_places=10, max_digits=20, null=True, verbose_name='FX rate'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='rate_version',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='FX rate version'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='to_amount',
+            field=models.DecimalField(
+                blank=True, decimal_places=4, max_digits=20, null=True, verbose_name='Destination amount'
+            ),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='to_currency',
+            field=models.CharField(
+                blank=True, choices=CURRENCY_CHOICES, default='', max_length=5, verbose_name='Destination currency'
+            ),
+        ),
+        migrations.AddField(
+            model_name='queuedtransfer',
+            name='to_currency',
+            field=models.CharField(
+                blank=True, choices=CURRENCY_CHOICES, default='', max_length=5, verbose_name='Destination currency'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['to_currency', '-id'], name='payment_to_currency_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='fxrate',
+            constraint=models.UniqueConstraint(
+                fields=('from_currency', 'to_currency', 'version'), name='fx_rate_version_uniq'
+            ),
+        ),
+    ]
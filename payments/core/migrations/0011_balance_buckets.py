@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_fx_rates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='buckets',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Balance buckets'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='to_sequence',
+            field=models.BigIntegerField(default=0, null=True, verbose_name='Destination account sequence'),
+        ),
+        migrations.CreateModel(
+            name='BalanceBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField(verbose_name='Index')),
+                ('balance', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Balance')),
+                (
+                    'account',
+                    models.ForeignKey(
+                        db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='balance_buckets',
+                        to='core.account', verbose_name='Account',
+                    )
+                ),
+            ],
+            options={
+                'verbose_name': 'Balance bucket',
+                'ordering': ['account', 'index'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='balancebucket',
+            constraint=models.UniqueConstraint(fields=('account', 'index'), name='balance_bucket_uniq'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:48
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def number_committed_payments(apps, schema_editor):
+    """
+    Existing transfers are in the feed in the order of their ids, so cursors, that were their ids, stay valid.
+    Credit sides of cross-shard transfers, that are entries of their destination accounts only, are not listed.
+    """
+    using = schema_editor.connection.alias
+    Payment = apps.get_model('core', 'Payment')
+    Payment.objects.using(using).update(feed_sequence=F('pk'))
+    Payment.objects.using(using).filter(from_sequence=0, to_sequence__gt=0).update(feed_sequence=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_balance_buckets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentFeedSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last', models.BigIntegerField(default=0, verbose_name='Last position')),
+            ],
+            options={
+                'verbose_name': 'Payment feed sequence',
+            },
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='feed_sequence',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Feed sequence'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['feed_sequence'], name='payment_feed_sequence_idx'),
+        ),
+        migrations.RunPython(number_committed_payments, migrations.RunPython.noop),
+    ]
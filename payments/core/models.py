@@ -1,36 +1,146 @@
+import decimal
+import operator
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime
 from decimal import Decimal
+from functools import reduce
+from itertools import groupby
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from core.errors import InvalidAccountCurrency, InvalidAmount, InsufficientBalance
-from django.db import models, transaction
+from core import metrics, sharding
+from core.cache import LRUCache
+from core.errors import (
+    CrossShardBatch, InvalidAccountCurrency, InvalidAmount, InsufficientBalance, TransferAborted, UnknownAccount,
+    UnknownFxRate,
+)
+from core.signals import balances_changed
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models, transaction
+from django.core.exceptions import ValidationError
+from django.db.models import Case, Count, F, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.db.transaction import TransactionManagementError
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy
 
-from .const import CURRENCIES, PAYMENT_DIRECTIONS, PAYMENT_DIRECTIONS_OUTGOING, PAYMENT_DIRECTIONS_INCOMING
+from .const import CURRENCIES, PAYMENT_DIRECTIONS_OUTGOING, PAYMENT_DIRECTIONS_INCOMING
 
 CURRENCY_CHOICES = tuple((_c, _c) for _c in CURRENCIES)
-PAYMENT_DIRECTION_CHOICES = tuple((_d, _d) for _d in PAYMENT_DIRECTIONS)
+
+# (from_account_id, to_account_id, amount, currency), optionally followed by the currency of the destination account,
+# if it differs, see `Account.pay`
+Transfer = Union[Tuple[str, str, Decimal, str], Tuple[str, str, Decimal, str, str]]
 
 
 class Account(models.Model):
     class Meta:
         verbose_name = "Account"
         ordering = ['pk']
+        indexes = [
+            models.Index(fields=['owner', 'id'], name='account_owner_idx'),
+            models.Index(fields=['currency', 'id'], name='account_currency_idx'),
+        ]
 
     id = models.CharField(verbose_name=ugettext_lazy("Account ID"), max_length=200, primary_key=True)
     owner = models.CharField(verbose_name=ugettext_lazy("Account owner ID"), max_length=200)
     balance = models.DecimalField(verbose_name=ugettext_lazy("Balance"), max_digits=20, decimal_places=4, default=0)
     currency = models.CharField(verbose_name=ugettext_lazy("Currency"), max_length=5, choices=CURRENCY_CHOICES)
+    # number of ledger entries of the account, that is the sequence of the last one, see `Payment.from_sequence`
+    sequence = models.BigIntegerField(verbose_name=ugettext_lazy("Ledger sequence"), default=0)
+    # part of the balance, that is held by prepared cross-shard transfers from the account, see `PreparedTransfer`
+    held = models.DecimalField(verbose_name=ugettext_lazy("Held amount"), max_digits=20, decimal_places=4, default=0)
+    # number of balance buckets of a hot account, that credits are spread across, see `BalanceBucket`
+    buckets = models.PositiveSmallIntegerField(verbose_name=ugettext_lazy("Balance buckets"), default=0)
+
+    # fields of accounts, that payments are validated and routed with, see `cached`
+    CACHED_FIELDS = ('id', 'currency', 'buckets')
+    # {account id: (expiry time, alias of the shard, currency, buckets)} of this process
+    _cached = LRUCache(settings.ACCOUNT_CACHE_SIZE)
 
-    def pay(self, to_account: 'Account', amount: Decimal, currency: str):
+    @classmethod
+    def cached(cls, account_id: str) -> Optional['Account']:
+        """
+        The account with CACHED_FIELDS only, or None if it does not exist. Its other fields are loaded, when they are
+        read. The currency of an account never changes, so the fields are cached for ACCOUNT_CACHE_TTL seconds,
+        and the database is not queried on hits. A stale number of buckets does not make payments wrong,
+        see `_pay`, and changes of accounts in this process remove them from the cache at once.
+        """
+        entry = cls._cached.get(account_id)
+        if entry is None or entry[0] <= time.monotonic():
+            using = sharding.shard_for(account_id)
+            row = cls.objects.using(using).filter(pk=account_id).values_list(*cls.CACHED_FIELDS[1:]).first()
+            if row is None:
+                return None
+            entry = (time.monotonic() + settings.ACCOUNT_CACHE_TTL, using, *row)
+            cls._cached.set(account_id, entry)
+        _, using, *values = entry
+        return cls.from_db(using, cls.CACHED_FIELDS, (account_id, *values))
+
+    @classmethod
+    def clear_cached(cls):
+        cls._cached.clear()
+
+    def pay(
+        self, to_account: 'Account', amount: Decimal, currency: str, idempotency_key: 'IdempotencyKey' = None,
+        to_currency: Optional[str] = None,
+    ) -> 'Payment':
         """
         Make a payment, that transfers amount of money from this account to `to_account`.
-        Raises InvalidAccountCurrency, InvalidAmount, InsufficientBalance
+        Both accounts are locked inside the transaction, so it is safe to call concurrently
+        for the same accounts from many workers; balances and sequences of both instances are refreshed.
+        The payment is the next ledger entry of both accounts, snapshots of their balances are saved when due.
+        A credit of an account with balance buckets is added to one of them, and the account is not locked,
+        see `BalanceBucket`; its credits are consolidated, when a debit of it needs them.
+        `balances_changed` signal is sent after the transaction is committed.
+        Accounts of different shards are paid with two-phase commit, see `CrossShardTransfer`.
+        Latency and queries of every call are observed as `account_pay_*` metrics.
+        Raises InvalidAccountCurrency, InvalidAmount, InsufficientBalance, UnknownFxRate
         :param to_account: destination account
         :param amount: positive Decimal with amount of transfer
         :param currency: currency of money
+        :param idempotency_key: not saved record of the request, it is saved together with the payment,
+            so IntegrityError is raised and nothing is paid if the key is already used
+        :param to_currency: currency of `to_account`, if it differs from `currency`: the amount is converted to it
+            with the current rate, that is recorded on the payment, see `FxRate`
+        """
+        with metrics.measure('account_pay'):
+            return self._pay(to_account, amount, currency, idempotency_key, to_currency or currency)
+
+    def _pay(
+        self, to_account: 'Account', amount: Decimal, currency: str, idempotency_key: Optional['IdempotencyKey'],
+        to_currency: str,
+    ) -> 'Payment':
+        self._validate(to_account, amount, currency, to_currency)
+
+        using = sharding.shard_for(self.pk)
+        if sharding.shard_for(to_account.pk) != using:
+            payment = CrossShardTransfer.transfer(
+                self.pk, to_account.pk, amount, currency, idempotency_key, to_currency,
+            )
+            for account in (self, to_account):
+                account.refresh_from_db(using=sharding.shard_for(account.pk), fields=('balance', 'sequence'))
+            return payment
+
+        conversion = FxRate.convert(amount, currency, to_currency)
+        try:
+            return self._pay_in_transaction(to_account, amount, currency, idempotency_key, conversion, using)
+        except BalanceBucket.DoesNotExist:
+            # buckets of the destination account were removed after it was loaded, see `set_buckets`
+            to_account.refresh_from_db(using=using, fields=('buckets',))
+            return self._pay_in_transaction(to_account, amount, currency, idempotency_key, conversion, using)
+
+    def _validate(self, to_account: 'Account', amount: Decimal, currency: str, to_currency: str):
+        """
+        Checks of the payment, that need no queries
         """
         invalid_currency_acc_ids = []
-        for acc in (self, to_account):
-            if acc.currency != currency:
+        for acc, acc_currency in ((self, currency), (to_account, to_currency)):
+            if acc.currency != acc_currency:
                 invalid_currency_acc_ids.append(acc.pk)
         if invalid_currency_acc_ids:
             raise InvalidAccountCurrency(invalid_currency_acc_ids)
@@ -38,46 +148,1380 @@ class Account(models.Model):
         if amount < 0:
             raise InvalidAmount()
 
-        if amount > self.balance:
+    def check_pay(self, to_account: 'Account', amount: Decimal, currency: str, to_currency: Optional[str] = None):
+        """
+        Validates the payment as `pay` does, but makes nothing: currencies and the amount are checked first, with no
+        queries, then the FX rate and the balance, that is available to this account now, with one query
+        or with two for an account with balance buckets. Nothing is locked, so the payment may still be rejected.
+        Raises InvalidAccountCurrency, InvalidAmount, InsufficientBalance, UnknownAccount, UnknownFxRate
+        """
+        to_currency = to_currency or currency
+        self._validate(to_account, amount, currency, to_currency)
+        FxRate.convert(amount, currency, to_currency)
+
+        using = sharding.shard_for(self.pk)
+        row = Account.objects.using(using).filter(pk=self.pk).values_list('balance', 'held', 'buckets').first()
+        if row is None:
+            raise UnknownAccount([self.pk])
+        balance, held, buckets = row
+        if buckets:
+            balance += BalanceBucket.balances([self.pk], using).get(self.pk, 0)
+        if balance - held < amount:
             raise InsufficientBalance()
 
-        self.balance -= amount
-        to_account.balance += amount
-        payments = [
-            Payment(
-                to_account=to_account, from_account=self, direction=PAYMENT_DIRECTIONS_OUTGOING,
-                amount=amount, currency=currency,
-            ),
-            Payment(
-                to_account=self, from_account=to_account, direction=PAYMENT_DIRECTIONS_INCOMING,
-                amount=amount, currency=currency,
+    def _pay_in_transaction(
+        self, to_account: 'Account', amount: Decimal, currency: str, idempotency_key: Optional['IdempotencyKey'],
+        conversion: dict, using: str,
+    ) -> 'Payment':
+        credit = conversion.get('to_amount', amount)
+        bucket = random.randrange(to_account.buckets) if to_account.buckets and to_account.pk != self.pk else None
+        credited_ids = [to_account.pk] if bucket is None else []
+
+        with transaction.atomic(using=using):
+            if connections[using].features.has_select_for_update:
+                # rows are always locked in pk order, so concurrent transfers between the same accounts
+                # in opposite directions can not deadlock on each other
+                list(Account._select_for_transfer([self.pk, *credited_ids], using).values_list('pk', flat=True))
+            # debit is conditional on the current balance in the database, not on the balance loaded
+            # into this instance, and on backends without row locks the first write locks the database;
+            # amounts held by prepared cross-shard transfers can not be spent
+            debit = Account.objects.using(using).filter(pk=self.pk, balance__gte=F('held') + amount)
+            debit_changes = {'balance': F('balance') - amount, 'sequence': F('sequence') + 1}
+            debited = debit.update(**debit_changes)
+            consolidated = []
+            if not debited:
+                # credits pending in buckets of the account can be spent too
+                consolidated = BalanceBucket.consolidate(self.pk, using)
+                if consolidated:
+                    debited = debit.update(**debit_changes)
+            if not debited:
+                raise InsufficientBalance()
+            if bucket is None:
+                Account.objects.using(using).filter(pk=to_account.pk).update(
+                    balance=F('balance') + credit, sequence=F('sequence') + 1,
+                )
+            elif not BalanceBucket.objects.using(using).filter(account_id=to_account.pk, index=bucket).update(
+                balance=F('balance') + credit,
+            ):
+                raise BalanceBucket.DoesNotExist()
+
+            # balances and sequences are read while accounts are locked, so they are the ones after this payment;
+            # credits pending in buckets are not counted in them
+            accounts = {
+                pk: (balance, sequence, owner)
+                for pk, balance, sequence, owner in Account.objects.using(using).filter(
+                    pk__in=(self.pk, to_account.pk)
+                ).values_list('pk', 'balance', 'sequence', 'owner')
+            }
+            (from_balance, from_sequence, from_owner), (to_balance, to_sequence, to_owner) = (
+                accounts[self.pk], accounts[to_account.pk]
             )
+
+            payment = Payment(
+                pk=PaymentIdBlock.take(1)[0], to_account=to_account, from_account=self, amount=amount,
+                currency=currency, **conversion
+            )
+            if to_account.pk == self.pk:
+                # a transfer to the same account is two entries of it, that do not change the balance
+                payment.from_sequence, payment.to_sequence = from_sequence - 1, to_sequence
+                snapshots = BalanceSnapshot.due(self.pk, to_sequence, to_balance, 2, 0, payment.created_at)
+            elif bucket is not None:
+                # the credit is numbered, when it is consolidated
+                payment.from_sequence, payment.to_sequence = from_sequence, None
+                snapshots = BalanceSnapshot.due(self.pk, from_sequence, from_balance, 1, -amount, payment.created_at)
+            else:
+                payment.from_sequence, payment.to_sequence = from_sequence, to_sequence
+                snapshots = BalanceSnapshot.due(
+                    self.pk, from_sequence, from_balance, 1, -amount, payment.created_at
+                ) + BalanceSnapshot.due(to_account.pk, to_sequence, to_balance, 1, credit, payment.created_at)
+            payment.save(using=using, force_insert=True)
+            if snapshots:
+                BalanceSnapshot.objects.using(using).bulk_create(snapshots)
+            if idempotency_key is not None:
+                idempotency_key.payment = payment
+                idempotency_key.save(using=using, force_insert=True)
+            owners = {self.pk: from_owner}
+            if bucket is None:
+                owners[to_account.pk] = to_owner
+            OwnerTotal.add_payments([payment], owners, using, credits=consolidated)
+            ChangeCounter.bump([self.pk, *credited_ids], using)
+
+            changed_account_ids = [self.pk, to_account.pk]
+            transaction.on_commit(
+                lambda: balances_changed.send(sender=Account, account_ids=changed_account_ids), using=using,
+            )
+
+        self.balance, self.sequence = from_balance, from_sequence
+        to_account.balance, to_account.sequence = to_balance, to_sequence
+
+        return payment
+
+    def set_buckets(self, buckets: int):
+        """
+        Spreads credits of the account across `buckets` balance buckets, 0 turns them off, see `BalanceBucket`.
+        Pending credits are consolidated first
+        """
+        if buckets < 0:
+            raise ValueError("Number of buckets can not be negative")
+        using = sharding.shard_for(self.pk)
+        with transaction.atomic(using=using):
+            list(Account._select_for_transfer([self.pk], using).values_list('pk', flat=True))
+            Account._consolidate_buckets(self.pk, using)
+            BalanceBucket.objects.using(using).filter(account_id=self.pk, index__gte=buckets).delete()
+            BalanceBucket.objects.using(using).bulk_create(
+                [BalanceBucket(account_id=self.pk, index=index) for index in range(buckets)], ignore_conflicts=True,
+            )
+            Account.objects.using(using).filter(pk=self.pk).update(buckets=buckets)
+            ChangeCounter.bump([self.pk], using)
+        Account._cached.delete(self.pk)
+        self.refresh_from_db(using=using, fields=('balance', 'sequence', 'buckets'))
+
+    def consolidate_buckets(self) -> int:
+        """
+        Moves credits pending in balance buckets of the account to its balance, see `BalanceBucket.consolidate`.
+        Returns the number of credits
+        """
+        using = sharding.shard_for(self.pk)
+        with transaction.atomic(using=using):
+            list(Account._select_for_transfer([self.pk], using).values_list('pk', flat=True))
+            credits = Account._consolidate_buckets(self.pk, using)
+        self.refresh_from_db(using=using, fields=('balance', 'sequence'))
+        return credits
+
+    @staticmethod
+    def _consolidate_buckets(account_id: str, using: str) -> int:
+        """
+        Consolidates pending credits of the locked account, with totals of its owner
+        """
+        credits = BalanceBucket.consolidate(account_id, using)
+        if credits:
+            owner = Account.objects.using(using).values_list('owner', flat=True).get(pk=account_id)
+            OwnerTotal.add_payments([], {account_id: owner}, using, credits=credits)
+            ChangeCounter.bump([account_id], using)
+        return len(credits)
+
+    def pending_balance(self) -> Decimal:
+        """
+        Sum of credits pending in balance buckets of the account, that is reported as a part of its balance
+        """
+        if not self.buckets:
+            return Decimal(0)
+        return BalanceBucket.balances([self.pk], sharding.shard_for(self.pk)).get(self.pk, Decimal(0))
+
+    @classmethod
+    def pay_batch(cls, transfers: List[Transfer], atomic: bool = True) -> List[Optional[Exception]]:
+        """
+        Make many payments at once, in the given order.
+        All referenced accounts are loaded with one query, transfers are validated against in-memory
+        balances, and then balances are updated with one query and payments are inserted with another one.
+        With several shards, an atomic batch is made in one shard, transfers leaving the shard of its first source
+        account get CrossShardBatch errors; otherwise runs of transfers within a shard are made as batches of it,
+        and transfers between shards one by one.
+        Returns list with an error for every transfer, or None if transfer is valid.
+        :param transfers: list of (from_account_id, to_account_id, amount, currency[, to_currency]),
+            see `pay` for `to_currency`
+        :param atomic: if True, nothing is written when any of transfers is invalid,
+            otherwise only valid transfers are made
+        """
+        return [
+            result if isinstance(result, Exception) else None
+            for result in cls._pay_batch(transfers, atomic=atomic, bulk_insert=True)
         ]
 
-        with transaction.atomic():
-            self.save(update_fields=('balance',))
-            to_account.save(update_fields=('balance',))
-            Payment.objects.bulk_create(payments)
+    @classmethod
+    def pay_group(
+        cls, transfers: List[Transfer], idempotency_keys: Optional[List['IdempotencyKey']] = None,
+    ) -> List[Union['Payment', Exception]]:
+        """
+        Make many independent payments in one transaction, in the given order, like `pay_batch` with `atomic=False`,
+        but payments are inserted one by one, so that they are known by their ids.
+        Returns list with the payment or the error of every transfer.
+        :param transfers: list of (from_account_id, to_account_id, amount, currency[, to_currency])
+        :param idempotency_keys: not saved records of transfers, they are saved together with their payments
+        """
+        return cls._pay_batch(transfers, atomic=False, bulk_insert=False, idempotency_keys=idempotency_keys)
+
+    @classmethod
+    def _pay_batch(
+        cls, transfers: List[Transfer], atomic: bool, bulk_insert: bool,
+        idempotency_keys: Optional[List['IdempotencyKey']] = None,
+    ) -> List[Union['Payment', Exception]]:
+        if idempotency_keys is None:
+            idempotency_keys = [None] * len(transfers)
+        # every transfer gets the currency of its destination account, that is the currency of the transfer by default
+        transfers = [tuple(transfer) if len(transfer) == 5 else (*transfer, transfer[3]) for transfer in transfers]
+        routes = [(sharding.shard_for(transfer[0]), sharding.shard_for(transfer[1])) for transfer in transfers]
+        if atomic:
+            using = routes[0][0]
+            if any(route != (using, using) for route in routes):
+                return [None if route == (using, using) else CrossShardBatch() for route in routes]
+            return cls._pay_in_shard(transfers, atomic, bulk_insert, idempotency_keys, using)
+
+        results = []
+        items = list(zip(routes, transfers, idempotency_keys))
+        for (from_shard, to_shard), run in groupby(items, key=operator.itemgetter(0)):
+            _, run_transfers, run_keys = zip(*run)
+            if from_shard == to_shard:
+                results.extend(cls._pay_in_shard(run_transfers, False, bulk_insert, run_keys, from_shard))
+                continue
+            for (from_account_id, to_account_id, amount, currency, to_currency), idempotency_key in zip(
+                run_transfers, run_keys
+            ):
+                try:
+                    results.append(CrossShardTransfer.transfer(
+                        from_account_id, to_account_id, amount, currency, idempotency_key, to_currency,
+                    ))
+                except (
+                    UnknownAccount, InvalidAccountCurrency, InvalidAmount, InsufficientBalance, TransferAborted,
+                    UnknownFxRate,
+                ) as e:
+                    results.append(e)
+        return results
+
+    @classmethod
+    def _pay_in_shard(
+        cls, transfers: Iterable[Tuple[str, str, Decimal, str, str]], atomic: bool, bulk_insert: bool,
+        idempotency_keys: Iterable[Optional['IdempotencyKey']], using: str,
+    ) -> List[Union['Payment', Exception]]:
+        account_ids = {acc_id for transfer in transfers for acc_id in transfer[:2]}
+        results = []
+        payments = []
+        keyed_payments = []
+        snapshots = []
+        deltas = defaultdict(Decimal)
+        entries = defaultdict(int)
+        credits = []
+        consolidated_ids = set()
+
+        with transaction.atomic(using=using):
+            accounts = {acc.pk: acc for acc in cls._select_for_transfer(account_ids, using)}
+
+            for (from_account_id, to_account_id, amount, currency, to_currency), idempotency_key in zip(
+                transfers, idempotency_keys
+            ):
+                from_account = accounts.get(from_account_id)
+                to_account = accounts.get(to_account_id)
+                try:
+                    unknown_acc_ids = [acc_id for acc_id in (from_account_id, to_account_id) if acc_id not in accounts]
+                    if unknown_acc_ids:
+                        raise UnknownAccount(unknown_acc_ids)
+                    invalid_currency_acc_ids = [
+                        acc.pk for acc, acc_currency in ((from_account, currency), (to_account, to_currency))
+                        if acc.currency != acc_currency
+                    ]
+                    if invalid_currency_acc_ids:
+                        raise InvalidAccountCurrency(invalid_currency_acc_ids)
+                    if amount < 0:
+                        raise InvalidAmount()
+                    conversion = FxRate.convert(amount, currency, to_currency)
+                    spendable = from_account.balance - from_account.held
+                    if amount > spendable and from_account.buckets and from_account.pk not in consolidated_ids:
+                        # credits pending in buckets of the account can be spent too, they are consolidated once,
+                        # buckets are locked until the end of the transaction; they are numbered after entries
+                        # of the batch made so far, and saved to the account together with them
+                        consolidated_ids.add(from_account.pk)
+                        account_credits = BalanceBucket.take(from_account.pk, from_account.sequence, using)
+                        if account_credits:
+                            amount_credited = sum((pending.credit_amount for pending in account_credits), Decimal(0))
+                            credits.extend(account_credits)
+                            from_account.balance += amount_credited
+                            from_account.sequence += len(account_credits)
+                            deltas[from_account.pk] += amount_credited
+                            entries[from_account.pk] += len(account_credits)
+                            snapshots.extend(BalanceSnapshot.due(
+                                from_account.pk, from_account.sequence, from_account.balance, len(account_credits),
+                                amount_credited, timezone.now(),
+                            ))
+                    if amount > from_account.balance - from_account.held:
+                        raise InsufficientBalance()
+                except (UnknownAccount, InvalidAccountCurrency, InvalidAmount, InsufficientBalance, UnknownFxRate) as e:
+                    results.append(e)
+                    continue
+
+                credit = conversion.get('to_amount', amount)
+                from_account.balance -= amount
+                to_account.balance += credit
+                deltas[from_account.pk] -= amount
+                deltas[to_account.pk] += credit
+                from_account.sequence += 1
+                from_sequence = from_account.sequence
+                to_account.sequence += 1
+                entries[from_account.pk] += 1
+                entries[to_account.pk] += 1
+                payment = Payment(
+                    to_account=to_account, from_account=from_account, amount=amount, currency=currency,
+                    from_sequence=from_sequence, to_sequence=to_account.sequence, **conversion
+                )
+                if to_account is from_account:
+                    changes = ((from_account, 2, 0),)
+                else:
+                    changes = ((from_account, 1, -amount), (to_account, 1, credit))
+                for account, account_entries, change in changes:
+                    snapshots.extend(BalanceSnapshot.due(
+                        account.pk, account.sequence, account.balance, account_entries, change, payment.created_at,
+                    ))
+                results.append(payment)
+                payments.append(payment)
+                if idempotency_key is not None:
+                    keyed_payments.append((payment, idempotency_key))
+
+            if not payments or (atomic and len(payments) < len(results)):
+                if credits:
+                    # nothing is paid, so credits are left pending
+                    transaction.set_rollback(True, using=using)
+                return results
+
+            changed_accounts = [
+                Account(pk=acc_id, balance=F('balance') + deltas[acc_id], sequence=F('sequence') + acc_entries)
+                for acc_id, acc_entries in entries.items()
+            ]
+            Account.objects.using(using).bulk_update(changed_accounts, ('balance', 'sequence'))
+            for payment, pk in zip(payments, PaymentIdBlock.take(len(payments))):
+                payment.pk = pk
+            if bulk_insert:
+                Payment.objects.using(using).bulk_create(payments)
+            else:
+                for payment in payments:
+                    payment.save(using=using, force_insert=True)
+            if snapshots:
+                BalanceSnapshot.objects.using(using).bulk_create(snapshots)
+            if keyed_payments:
+                for payment, idempotency_key in keyed_payments:
+                    idempotency_key.payment = payment
+                IdempotencyKey.objects.using(using).bulk_create([key for _, key in keyed_payments])
+            OwnerTotal.add_payments(payments, {acc.pk: acc.owner for acc in accounts.values()}, using, credits=credits)
+            ChangeCounter.bump(deltas, using)
 
-        return payments
+            changed_account_ids = [acc.pk for acc in changed_accounts]
+            transaction.on_commit(
+                lambda: balances_changed.send(sender=Account, account_ids=changed_account_ids), using=using,
+            )
+
+        return results
+
+    @staticmethod
+    def _select_for_transfer(account_ids, using: str = DEFAULT_DB_ALIAS) -> models.QuerySet:
+        """
+        Accounts with given ids, locked for update in pk order where the database supports row locks
+        """
+        queryset = Account.objects.using(using).filter(pk__in=account_ids).order_by('pk')
+        if connections[using].features.has_select_for_update:
+            queryset = queryset.select_for_update()
+        return queryset
 
 
-class Payment(models.Model):
+class FxConversion(models.Model):
+    """
+    Conversion of a transfer to the currency of its destination account, that is credited with `to_amount`
+    in `to_currency`, converted with the rate of the version, see `FxRate`. Fields are empty for transfers
+    in one currency, that credit the amount in the currency of the transfer.
+    """
+    class Meta:
+        abstract = True
+
+    to_amount = models.DecimalField(
+        verbose_name=ugettext_lazy("Destination amount"), max_digits=20, decimal_places=4, null=True, blank=True,
+    )
+    to_currency = models.CharField(
+        verbose_name=ugettext_lazy("Destination currency"), max_length=5, choices=CURRENCY_CHOICES, blank=True,
+        default='',
+    )
+    rate = models.DecimalField(
+        verbose_name=ugettext_lazy("FX rate"), max_digits=20, decimal_places=10, null=True, blank=True,
+    )
+    rate_version = models.PositiveIntegerField(verbose_name=ugettext_lazy("FX rate version"), null=True, blank=True)
+
+    @property
+    def credit_amount(self) -> Decimal:
+        """
+        Amount credited to the destination account, in `credit_currency`
+        """
+        return self.amount if self.to_amount is None else self.to_amount
+
+    @property
+    def credit_currency(self) -> str:
+        return self.to_currency or self.currency
+
+    def conversion(self) -> dict:
+        """
+        Fields of the conversion, to make another transfer with it
+        """
+        return {
+            'to_amount': self.to_amount, 'to_currency': self.to_currency, 'rate': self.rate,
+            'rate_version': self.rate_version,
+        }
+
+
+class Payment(FxConversion):
+    """
+    Transfer of money from `from_account` to `to_account`, stored as a single row.
+    The transfer is shown to clients as a pair of outgoing and incoming payments, see `legs`.
+    It is a ledger entry of both accounts, numbered by the sequence of each of them, see `core.ledger`.
+    A transfer between shards is stored in both of them with the same id, each row is an entry of the account
+    of its shard only, the sequence of the other one is 0. So foreign keys are not constrained by databases.
+    """
     class Meta:
         verbose_name = "Payment"
         ordering = ['-pk']
+        # every filter of the payments list is served by one of these, including the `-pk` ordering,
+        # they also replace the default single column indexes of foreign keys
+        indexes = [
+            models.Index(fields=['to_account', '-id'], name='payment_to_account_idx'),
+            models.Index(fields=['from_account', '-id'], name='payment_from_account_idx'),
+            models.Index(fields=['currency', '-id'], name='payment_currency_idx'),
+            # incoming legs of converted transfers are in currencies of their destination accounts
+            models.Index(fields=['to_currency', '-id'], name='payment_to_currency_idx'),
+            # ledger entries of accounts, after their balance snapshots
+            models.Index(fields=['to_account', 'to_sequence'], name='payment_to_sequence_idx'),
+            models.Index(fields=['from_account', 'from_sequence'], name='payment_from_sequence_idx'),
+            # the change feed, and transfers, that are not given their positions in it yet
+            models.Index(fields=['feed_sequence'], name='payment_feed_sequence_idx'),
+        ]
 
     to_account = models.ForeignKey(
         Account, verbose_name="Payment destination account", on_delete=models.PROTECT,
-        related_name="to_payments",
+        related_name="to_payments", db_index=False, db_constraint=False,
     )
     from_account = models.ForeignKey(
         Account, verbose_name="Payment source account", on_delete=models.PROTECT,
-        related_name="from_payments",
-    )
-    direction = models.CharField(
-        verbose_name=ugettext_lazy("Payment direction"), max_length=64, choices=PAYMENT_DIRECTION_CHOICES
+        related_name="from_payments", db_index=False, db_constraint=False,
     )
 
     amount = models.DecimalField(verbose_name=ugettext_lazy("Amount"), max_digits=20, decimal_places=4, default=0)
     currency = models.CharField(verbose_name=ugettext_lazy("Currency"), max_length=5, choices=CURRENCY_CHOICES)
+    created_at = models.DateTimeField(verbose_name=ugettext_lazy("Created at"), default=timezone.now)
+    # sequences of the entry in ledgers of both accounts, they start with 1 and have no gaps,
+    # 0 is left by payments, that were stored bypassing `Account.pay`, e.g. by fixtures,
+    # and NULL by credits pending in balance buckets, until they are consolidated, see `BalanceBucket`
+    from_sequence = models.BigIntegerField(verbose_name=ugettext_lazy("Source account sequence"), default=0)
+    to_sequence = models.BigIntegerField(
+        verbose_name=ugettext_lazy("Destination account sequence"), default=0, null=True,
+    )
+    # position of the transfer in the change feed, that is given after it is committed, see `PaymentFeedSequence`;
+    # 0 is the one of the credit side of a cross-shard transfer, that is listed by the row of its debit side
+    feed_sequence = models.BigIntegerField(verbose_name=ugettext_lazy("Feed sequence"), null=True, blank=True)
+
+    # stored transfers are outgoing payments, incoming ones are derived from them by `legs`
+    direction = PAYMENT_DIRECTIONS_OUTGOING
+
+    def legs(self) -> List['Payment']:
+        """
+        Incoming and outgoing payments of the transfer, in the order they are listed to clients.
+        The incoming one is not a stored row, it has the same pk, swapped accounts and the credited amount.
+        """
+        incoming = Payment(
+            pk=self.pk, to_account_id=self.from_account_id, from_account_id=self.to_account_id,
+            amount=self.credit_amount, currency=self.credit_currency,
+        )
+        incoming.direction = PAYMENT_DIRECTIONS_INCOMING
+        return [incoming, self]
+
+
+class FxRate(models.Model):
+    """
+    Exchange rate from `from_currency` to `to_currency`: one unit of the first one is worth `rate` of the second one.
+    Every change of the rate of a pair is a new row with the next version, so payments keep the version of the rate,
+    that they were converted with. Rates of both directions of a pair are set separately.
+    Rates are stored in the default database, and every process keeps current ones in memory, see `current`.
+    """
+    class Meta:
+        verbose_name = "FX rate"
+        ordering = ['from_currency', 'to_currency', 'version']
+        constraints = [
+            models.UniqueConstraint(fields=['from_currency', 'to_currency', 'version'], name='fx_rate_version_uniq'),
+        ]
+
+    from_currency = models.CharField(
+        verbose_name=ugettext_lazy("Source currency"), max_length=5, choices=CURRENCY_CHOICES,
+    )
+    to_currency = models.CharField(
+        verbose_name=ugettext_lazy("Destination currency"), max_length=5, choices=CURRENCY_CHOICES,
+    )
+    rate = models.DecimalField(verbose_name=ugettext_lazy("Rate"), max_digits=20, decimal_places=10)
+    version = models.PositiveIntegerField(verbose_name=ugettext_lazy("Version"))
+    created_at = models.DateTimeField(verbose_name=ugettext_lazy("Created at"), default=timezone.now)
+
+    # current rates of this process, (id of the last row, {(from_currency, to_currency): (rate, version)}),
+    # the tuple is replaced at once, so readers never see rates of different loads
+    _current = (None, {})
+    _checked_at = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def current(cls) -> Dict[Tuple[str, str], Tuple[Decimal, int]]:
+        """
+        Current rates and their versions by pairs of currencies. Rows are only added, so rates are loaded again,
+        when the id of the last row changes, that is checked with one query every FX_RATE_CHECK_INTERVAL seconds
+        """
+        checked_at = cls._checked_at
+        if checked_at is None or time.monotonic() - checked_at >= settings.FX_RATE_CHECK_INTERVAL:
+            with cls._lock:
+                if cls._checked_at == checked_at:
+                    last_id = cls.objects.aggregate(last=Max('pk'))['last']
+                    if last_id != cls._current[0]:
+                        cls._load(last_id)
+                    cls._checked_at = time.monotonic()
+        return cls._current[1]
+
+    @classmethod
+    def reload(cls):
+        """
+        Loads current rates at once, e.g. after a rate is set by this process
+        """
+        with cls._lock:
+            cls._load(cls.objects.aggregate(last=Max('pk'))['last'])
+            cls._checked_at = time.monotonic()
+
+    @classmethod
+    def _load(cls, last_id: Optional[int]):
+        rows = cls.objects.filter(pk__lte=last_id or 0)
+        latest = rows.filter(
+            from_currency=OuterRef('from_currency'), to_currency=OuterRef('to_currency'),
+        ).order_by('-version').values('version')[:1]
+        cls._current = (last_id, {
+            (from_currency, to_currency): (rate, version)
+            for from_currency, to_currency, rate, version in rows.filter(version=Subquery(latest)).values_list(
+                'from_currency', 'to_currency', 'rate', 'version',
+            )
+        })
+
+    @classmethod
+    def set_rate(cls, from_currency: str, to_currency: str, rate: Decimal) -> 'FxRate':
+        """
+        Saves the next version of the rate of the pair, rates of this process are loaded again when it is committed.
+        Raises ValidationError
+        """
+        if from_currency == to_currency:
+            raise ValidationError({'to_currency': ["Rates are set between different currencies."]})
+        if rate <= 0:
+            raise ValidationError({'rate': ["Ensure this value is greater than 0."]})
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            versions = cls.objects.filter(from_currency=from_currency, to_currency=to_currency).order_by('-version')
+            if connection.features.has_select_for_update:
+                versions = versions.select_for_update()
+            version = versions.values_list('version', flat=True).first() or 0
+            fx_rate = cls(from_currency=from_currency, to_currency=to_currency, rate=rate, version=version + 1)
+            fx_rate.full_clean(validate_unique=False)
+            fx_rate.save(force_insert=True)
+            transaction.on_commit(cls.reload, using=DEFAULT_DB_ALIAS)
+        return fx_rate
+
+    @classmethod
+    def convert(cls, amount: Decimal, from_currency: str, to_currency: str) -> dict:
+        """
+        Fields of `FxConversion` of the transfer of `amount` in `from_currency` to `to_currency`, with the current
+        rate, or an empty dict for the same currencies. The product is exact, and it is rounded down to decimal
+        places of amounts, so a conversion never credits more, than the amount is worth.
+        Raises UnknownFxRate, InvalidAmount if the converted amount does not fit amounts
+        """
+        if from_currency == to_currency:
+            return {}
+        try:
+            rate, version = cls.current()[(from_currency, to_currency)]
+        except KeyError:
+            raise UnknownFxRate()
+        amount_field = Payment._meta.get_field('amount')
+        context = decimal.Context(prec=amount_field.max_digits + cls._meta.get_field('rate').max_digits)
+        to_amount = context.multiply(amount, rate).quantize(
+            Decimal(1).scaleb(-amount_field.decimal_places), rounding=decimal.ROUND_DOWN, context=context,
+        )
+        if to_amount.adjusted() >= amount_field.max_digits - amount_field.decimal_places:
+            raise InvalidAmount()
+        return {'to_amount': to_amount, 'to_currency': to_currency, 'rate': rate, 'rate_version': version}
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Balance of the account after its ledger entry `sequence`, made at `created_at`.
+    The first entry of an account saves its opening balance with sequence 0, and the balance is saved again
+    every BALANCE_SNAPSHOT_INTERVAL entries, in transactions of payments, see `core.ledger`.
+    """
+    class Meta:
+        verbose_name = "Balance snapshot"
+        ordering = ['account', 'sequence']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'sequence'], name='balance_snapshot_sequence_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'created_at'], name='balance_snapshot_time_idx'),
+        ]
+
+    account = models.ForeignKey(
+        Account, verbose_name="Account", on_delete=models.PROTECT, related_name="balance_snapshots", db_index=False,
+    )
+    sequence = models.BigIntegerField(verbose_name=ugettext_lazy("Ledger sequence"))
+    balance = models.DecimalField(verbose_name=ugettext_lazy("Balance"), max_digits=20, decimal_places=4)
+    created_at = models.DateTimeField(verbose_name=ugettext_lazy("Created at"))
+
+    @classmethod
+    def due(
+        cls, account_id: str, sequence: int, balance: Decimal, entries: int, change: Decimal, created_at: datetime
+    ) -> List['BalanceSnapshot']:
+        """
+        Snapshots to save with the last `entries` ledger entries of the account, that changed its balance by `change`
+        and made it `balance` at `sequence`: the opening balance with the first entry, and the balance after
+        entries, that reach the next multiple of BALANCE_SNAPSHOT_INTERVAL
+        """
+        snapshots = []
+        previous_sequence = sequence - entries
+        if not previous_sequence:
+            snapshots.append(cls(account_id=account_id, sequence=0, balance=balance - change, created_at=created_at))
+        interval = settings.BALANCE_SNAPSHOT_INTERVAL
+        if sequence // interval > previous_sequence // interval:
+            snapshots.append(cls(account_id=account_id, sequence=sequence, balance=balance, created_at=created_at))
+        return snapshots
+
+
+class BalanceBucket(models.Model):
+    """
+    Part of the balance of a hot account, that credits of transfers to it are added to, see `Account.set_buckets`.
+    Every credit picks one of the buckets of the account at random, and locks that bucket instead of the account,
+    so concurrent credits of the account wait for each other only when they pick the same bucket.
+    Credits in buckets are pending: they are not entries of the ledger of the account yet, their `to_sequence`
+    is NULL, and the balance of the account is reported with them. They are consolidated into the balance,
+    when a debit of the account needs them, when buckets are changed and by `consolidate_buckets` command;
+    totals of owners get them at that time too.
+    """
+    class Meta:
+        verbose_name = "Balance bucket"
+        ordering = ['account', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'index'], name='balance_bucket_uniq'),
+        ]
+
+    account = models.ForeignKey(
+        Account, verbose_name="Account", on_delete=models.CASCADE, related_name="balance_buckets", db_index=False,
+    )
+    index = models.PositiveSmallIntegerField(verbose_name=ugettext_lazy("Index"))
+    balance = models.DecimalField(verbose_name=ugettext_lazy("Balance"), max_digits=20, decimal_places=4, default=0)
+
+    @classmethod
+    def balances(cls, account_ids: Iterable[str], using: str = DEFAULT_DB_ALIAS) -> Dict[str, Decimal]:
+        """
+        Sums of buckets of accounts by their ids, with one query
+        """
+        account_ids = list(account_ids)
+        if not account_ids:
+            return {}
+        return dict(
+            cls.objects.using(using).filter(account_id__in=account_ids).order_by().values_list('account_id')
+            .annotate(Sum('balance'))
+        )
+
+    @classmethod
+    def consolidate(cls, account_id: str, using: str = DEFAULT_DB_ALIAS) -> List['Payment']:
+        """
+        Moves credits pending in buckets of the account to its balance, and numbers them as its next ledger entries
+        in the order they were made. The account must be locked by the transaction, buckets are locked by it.
+        Returns the credits, they are not added to totals of owners, see `OwnerTotal.add_payments`
+        """
+        balance, sequence = Account.objects.using(using).values_list('balance', 'sequence').get(pk=account_id)
+        credits = cls.take(account_id, sequence, using)
+        if not credits:
+            return []
+
+        sequence += len(credits)
+        amount = sum((credit.credit_amount for credit in credits), Decimal(0))
+        Account.objects.using(using).filter(pk=account_id).update(
+            balance=F('balance') + amount, sequence=F('sequence') + len(credits),
+        )
+        snapshots = BalanceSnapshot.due(
+            account_id, sequence, balance + amount, len(credits), amount, timezone.now(),
+        )
+        if snapshots:
+            BalanceSnapshot.objects.using(using).bulk_create(snapshots)
+        return credits
+
+    @classmethod
+    def take(cls, account_id: str, sequence: int, using: str = DEFAULT_DB_ALIAS) -> List['Payment']:
+        """
+        Empties buckets of the account, and numbers credits pending in them as its ledger entries after `sequence`,
+        in the order they were made. The balance, the sequence and snapshots of the account are left to the caller,
+        that can have entries of the account not saved yet, see `consolidate`
+        """
+        buckets = cls.objects.using(using).filter(account_id=account_id).order_by('index')
+        if connections[using].features.has_select_for_update:
+            buckets = buckets.select_for_update()
+        list(buckets.values_list('pk', flat=True))
+        credits = list(
+            Payment.objects.using(using).filter(to_account_id=account_id, to_sequence__isnull=True)
+            .order_by('created_at', 'pk')
+        )
+        if not credits:
+            return []
+
+        for credit in credits:
+            sequence += 1
+            credit.to_sequence = sequence
+        Payment.objects.using(using).bulk_update(credits, ('to_sequence',), batch_size=500)
+        cls.objects.using(using).filter(account_id=account_id).update(balance=0)
+        return credits
+
+
+class OwnerTotal(models.Model):
+    """
+    Sum of balances and number of accounts of the owner in the currency.
+    Totals are changed by payments in their transactions, and are computed again from accounts of the owner,
+    when any of them is saved or deleted. Totals of accounts, that were created with `bulk_create`, are computed
+    by their first payments or by `refresh_owner_totals` command.
+    With several shards, every shard has totals of its own accounts, and they are summed when they are read.
+    """
+    class Meta:
+        verbose_name = "Owner total"
+        ordering = ['owner', 'currency']
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'currency'], name='owner_total_uniq'),
+        ]
+
+    owner = models.CharField(verbose_name=ugettext_lazy("Account owner ID"), max_length=200)
+    currency = models.CharField(verbose_name=ugettext_lazy("Currency"), max_length=5, choices=CURRENCY_CHOICES)
+    balance = models.DecimalField(verbose_name=ugettext_lazy("Balance"), max_digits=24, decimal_places=4, default=0)
+    accounts = models.PositiveIntegerField(verbose_name=ugettext_lazy("Number of accounts"), default=0)
+
+    @classmethod
+    def refresh(cls, owners: Optional[Iterable[str]] = None, using: str = DEFAULT_DB_ALIAS) -> int:
+        """
+        Computes totals of `owners`, all of them by default, from their accounts with one grouped query.
+        Returns the number of totals
+        """
+        accounts = Account.objects.using(using).order_by()
+        totals = cls.objects.using(using).all()
+        if owners is not None:
+            owners = list(owners)
+            accounts = accounts.filter(owner__in=owners)
+            totals = totals.filter(owner__in=owners)
+        rows = [
+            cls(owner=owner, currency=currency, balance=balance, accounts=count)
+            for owner, currency, balance, count in accounts.values_list('owner', 'currency').annotate(
+                Sum('balance'), Count('pk'),
+            )
+        ]
+        totals.delete()
+        cls.objects.using(using).bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+    @classmethod
+    def add_payments(
+        cls, payments: List['Payment'], owners: Dict[str, str], using: str = DEFAULT_DB_ALIAS,
+        credits: Iterable['Payment'] = (),
+    ):
+        """
+        Adds payments to totals and volumes of owners of their accounts, in the transaction of the payments.
+        Rows are locked in the order of their keys after accounts, so transactions can not deadlock on them.
+        :param owners: owners of accounts of payments by their ids, payments are added to totals of these
+            accounts only, e.g. of the shard of a cross-shard transfer
+        :param credits: payments, whose incoming sides only are added, e.g. credits of balance buckets,
+            when they are consolidated, see `BalanceBucket`
+        """
+        balances = defaultdict(Decimal)
+        volumes = defaultdict(lambda: defaultdict(int))
+        sides = [(payment, True) for payment in payments] + [(payment, False) for payment in credits]
+        for payment, outgoing in sides:
+            day = timezone.localdate(payment.created_at)
+            for account_id, sign, amount, currency, direction in (
+                (payment.from_account_id if outgoing else None, -1, payment.amount, payment.currency, 'outgoing'),
+                (payment.to_account_id, 1, payment.credit_amount, payment.credit_currency, 'incoming'),
+            ):
+                if account_id not in owners:
+                    continue
+                key = (owners[account_id], currency)
+                balances[key] += sign * amount
+                volumes[key + (day,)][direction] += amount
+                volumes[key + (day,)][direction + '_payments'] += 1
+
+        changes = {key: {'balance': balance} for key, balance in balances.items() if balance}
+        if changes and len(_lock_rows(cls, ('owner', 'currency'), changes, using)) < len(changes):
+            # totals of accounts, that were not counted yet, include this change already
+            cls.refresh({owner for owner, _ in changes}, using)
+        else:
+            _add_to_rows(cls, ('owner', 'currency'), changes, using)
+
+        missing_keys = set(volumes) - _lock_rows(OwnerVolume, ('owner', 'currency', 'day'), volumes, using)
+        if missing_keys:
+            OwnerVolume.objects.using(using).bulk_create(
+                [OwnerVolume(owner=owner, currency=currency, day=day) for owner, currency, day in missing_keys],
+                ignore_conflicts=True,
+            )
+            if connections[using].features.has_select_for_update:
+                # rows, that were created by concurrent transactions, are locked too
+                _lock_rows(OwnerVolume, ('owner', 'currency', 'day'), missing_keys, using)
+        _add_to_rows(OwnerVolume, ('owner', 'currency', 'day'), volumes, using)
+
+    @staticmethod
+    def combine(totals: List['OwnerTotal']) -> 'OwnerTotal':
+        """
+        Total of the owner in the currency, that is summed from totals of shards, see `sharding.fan_out`
+        """
+        total = totals[0]
+        for other in totals[1:]:
+            total.balance += other.balance
+            total.accounts += other.accounts
+        return total
+
+
+class OwnerVolume(models.Model):
+    """
+    Volumes of outgoing and incoming payments of the owner in the currency during the day, see `OwnerTotal`
+    """
+    class Meta:
+        verbose_name = "Owner volume"
+        ordering = ['owner', 'currency', 'day']
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'currency', 'day'], name='owner_volume_uniq'),
+        ]
+
+    owner = models.CharField(verbose_name=ugettext_lazy("Account owner ID"), max_length=200)
+    currency = models.CharField(verbose_name=ugettext_lazy("Currency"), max_length=5, choices=CURRENCY_CHOICES)
+    day = models.DateField(verbose_name=ugettext_lazy("Day"))
+    outgoing = models.DecimalField(
+        verbose_name=ugettext_lazy("Outgoing volume"), max_digits=24, decimal_places=4, default=0,
+    )
+    outgoing_payments = models.PositiveIntegerField(verbose_name=ugettext_lazy("Outgoing payments"), default=0)
+    incoming = models.DecimalField(
+        verbose_name=ugettext_lazy("Incoming volume"), max_digits=24, decimal_places=4, default=0,
+    )
+    incoming_payments = models.PositiveIntegerField(verbose_name=ugettext_lazy("Incoming payments"), default=0)
+
+
+def _key_filter(key_fields: Tuple[str, ...], keys: Iterable[tuple]) -> Q:
+    return reduce(operator.or_, (Q(**dict(zip(key_fields, key))) for key in keys))
+
+
+def _lock_rows(model, key_fields: Tuple[str, ...], keys: Iterable[tuple], using: str) -> Set[tuple]:
+    """
+    Keys of existing rows with `keys`, that are locked for update in the order of keys,
+    where the database supports row locks
+    """
+    rows = model.objects.using(using).filter(_key_filter(key_fields, keys)).order_by(*key_fields)
+    if connections[using].features.has_select_for_update:
+        rows = rows.select_for_update()
+    return set(rows.values_list(*key_fields))
+
+
+def _add_to_rows(
+    model, key_fields: Tuple[str, ...], changes: Dict[tuple, Dict[str, Union[Decimal, int]]], using: str,
+):
+    """
+    Adds values of `changes`, that are {key: {field: value}}, to fields of rows with the keys, with one query
+    """
+    if not changes:
+        return
+    fields = {field for change in changes.values() for field in change}
+    model.objects.using(using).filter(_key_filter(key_fields, changes)).update(**{
+        field: F(field) + Case(
+            *[
+                When(Q(**dict(zip(key_fields, key))), then=Value(change[field]))
+                for key, change in changes.items() if field in change
+            ],
+            default=Value(0), output_field=model._meta.get_field(field),
+        )
+        for field in fields
+    })
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response to the payment request, made with the `Idempotency-Key` header.
+    Requests with the same key and body are answered with this response instead of making a new payment.
+    It is stored in the shard of the source account of the payment.
+    """
+    class Meta:
+        verbose_name = "Idempotency key"
+
+    key = models.CharField(verbose_name=ugettext_lazy("Key"), max_length=255, unique=True)
+    # the key of a cross-shard transfer is saved when it is prepared, before its payment
+    payment = models.ForeignKey(
+        Payment, verbose_name="Payment made by the request", on_delete=models.CASCADE, related_name="+",
+        db_constraint=False,
+    )
+    # hash of the body of the request, requests with the same key and other bodies are rejected
+    request_fingerprint = models.CharField(verbose_name=ugettext_lazy("Request fingerprint"), max_length=64)
+    response_status = models.PositiveSmallIntegerField(verbose_name=ugettext_lazy("Response status"))
+    response_body = models.TextField(verbose_name=ugettext_lazy("Response body"))
+    created_at = models.DateTimeField(verbose_name=ugettext_lazy("Created at"), default=timezone.now, db_index=True)
+
+
+class ChangeCounter(models.Model):
+    """
+    Version of accounts, whose keys hash to the slot of the counter, in the database of the counter.
+    It is incremented in transactions of transfers and of other changes of accounts, so caches of every process
+    check their entries against committed versions, see `core.balances`.
+    Changes are counted in SLOTS rows, so concurrent transfers of different accounts seldom wait for the same row.
+    """
+    class Meta:
+        verbose_name = "Change counter"
+        ordering = ['slot']
+
+    SLOTS = 64
+
+    slot = models.PositiveSmallIntegerField(verbose_name=ugettext_lazy("Slot"), primary_key=True)
+    version = models.BigIntegerField(verbose_name=ugettext_lazy("Version"), default=0)
+    changed_at = models.DateTimeField(verbose_name=ugettext_lazy("Changed at"), default=timezone.now)
+
+    @classmethod
+    def slot_for(cls, key: str) -> int:
+        return zlib.crc32(key.encode('utf-8')) % cls.SLOTS
+
+    @staticmethod
+    def owner_key(owner: str) -> str:
+        """
+        Key of the list of accounts of the owner, it changes with creations and deletions of them
+        """
+        return 'owner:' + owner
+
+    @classmethod
+    def versions(
+        cls, using: str = DEFAULT_DB_ALIAS, slots: Optional[Iterable[int]] = None,
+    ) -> Dict[int, Tuple[int, datetime]]:
+        """
+        Versions and times of changes of slots, that were changed in the database, of the given ones only if any
+        """
+        counters = cls.objects.using(using)
+        if slots is not None:
+            counters = counters.filter(slot__in=sorted(slots))
+        return {
+            slot: (version, changed_at)
+            for slot, version, changed_at in counters.values_list('slot', 'version', 'changed_at')
+        }
+
+    @classmethod
+    def bump(cls, keys: Iterable[str], using: str = DEFAULT_DB_ALIAS):
+        """
+        Increments versions of slots of keys. It is the last write of the transaction of the change:
+        counters are locked in the order of slots after anything else, so transactions can not deadlock on them.
+        """
+        slots = sorted({cls.slot_for(key) for key in keys})
+        counters = cls.objects.using(using).filter(slot__in=slots)
+        if connections[using].features.has_select_for_update:
+            list(counters.select_for_update().values_list('pk', flat=True))
+        changes = {'version': F('version') + 1, 'changed_at': timezone.now()}
+        if counters.update(**changes) < len(slots):
+            # counters are created by their first changes, e.g. after tables are flushed
+            cls.objects.using(using).bulk_create([cls(slot=slot) for slot in slots], ignore_conflicts=True)
+            counters.update(**changes)
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def _refresh_owner_totals(sender, instance, using, **kwargs):
+    # a changed owner of the account is counted by `refresh_owner_totals` command
+    OwnerTotal.refresh([instance.owner], using)
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def _forget_cached_account(sender, instance, **kwargs):
+    Account._cached.delete(instance.pk)
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def _bump_account_counters(sender, instance, using, **kwargs):
+    # receivers of account changes, that write, are connected before this one
+    ChangeCounter.bump([instance.pk, ChangeCounter.owner_key(instance.owner)], using=using)
+
+
+class QueuedTransfer(models.Model):
+    """
+    Transfer submitted for asynchronous processing, it is made later by the queue worker, see `core.transfer_queue`.
+    The queue is stored in the default database, whatever the shards of accounts are.
+    """
+    class Meta:
+        verbose_name = "Queued transfer"
+        ordering = ['pk']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='queued_transfer_status_idx'),
+        ]
+
+    STATUS_QUEUED = 'QUEUED'
+    # taken by a worker, that makes it outside of the transaction of the queue, with several shards only
+    STATUS_PROCESSING = 'PROCESSING'
+    STATUS_CREATED = 'CREATED'
+    STATUS_ERROR = 'ERROR'
+    STATUSES = (STATUS_QUEUED, STATUS_PROCESSING, STATUS_CREATED, STATUS_ERROR)
+
+    to_account = models.ForeignKey(
+        Account, verbose_name="Transfer destination account", on_delete=models.PROTECT,
+        related_name="+", db_index=False, db_constraint=False,
+    )
+    from_account = models.ForeignKey(
+        Account, verbose_name="Transfer source account", on_delete=models.PROTECT,
+        related_name="+", db_index=False, db_constraint=False,
+    )
+    amount = models.DecimalField(verbose_name=ugettext_lazy("Amount"), max_digits=20, decimal_places=4)
+    currency = models.CharField(verbose_name=ugettext_lazy("Currency"), max_length=5, choices=CURRENCY_CHOICES)
+    # currency of the destination account, if the amount is converted to it, see `Account.pay`
+    to_currency = models.CharField(
+        verbose_name=ugettext_lazy("Destination currency"), max_length=5, choices=CURRENCY_CHOICES, blank=True,
+        default='',
+    )
+
+    status = models.CharField(
+        verbose_name=ugettext_lazy("Status"), max_length=10, choices=tuple((_s, _s) for _s in STATUSES),
+        default=STATUS_QUEUED,
+    )
+    payment = models.ForeignKey(
+        Payment, verbose_name="Payment made by the transfer", on_delete=models.SET_NULL, related_name="+",
+        null=True, blank=True, db_constraint=False,
+    )
+    error = models.CharField(verbose_name=ugettext_lazy("Error code"), max_length=50, blank=True, default='')
+    created_at = models.DateTimeField(verbose_name=ugettext_lazy("Created at"), default=timezone.now)
+    processed_at = models.DateTimeField(verbose_name=ugettext_lazy("Processed at"), null=True, blank=True)
+
+
+class PaymentIdBlock(models.Model):
+    """
+    The first id of payments, that is not taken by any process yet, in the default database.
+    With several shards, processes take ids of payments from this row in blocks of PAYMENT_ID_BLOCK_SIZE,
+    so ids are unique across shards, and both rows of a cross-shard transfer have the same one.
+    With one shard ids are assigned by the database.
+    """
+    class Meta:
+        verbose_name = "Payment id block"
+
+    next_id = models.BigIntegerField(verbose_name=ugettext_lazy("Next ID"))
+
+    # ids of the block of this process, that are not taken yet
+    _free_ids = range(0)
+    _lock = threading.Lock()
+
+    @classmethod
+    def take(cls, count: int) -> List[Optional[int]]:
+        """
+        `count` new ids of payments, or Nones, if ids are assigned by the database
+        """
+        if not sharding.is_sharded():
+            return [None] * count
+        ids = []
+        with cls._lock:
+            while len(ids) < count:
+                if not cls._free_ids:
+                    cls._free_ids = cls._take_block(max(settings.PAYMENT_ID_BLOCK_SIZE, count - len(ids)))
+                taken = cls._free_ids[:count - len(ids)]
+                cls._free_ids = cls._free_ids[len(taken):]
+                ids.extend(taken)
+        return ids
+
+    @classmethod
+    def _take_block(cls, size: int) -> range:
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            blocks = cls.objects.filter(pk=1)
+            if connection.features.has_select_for_update:
+                blocks = blocks.select_for_update()
+            next_id = blocks.values_list('next_id', flat=True).first()
+            if next_id is None:
+                # the row is created by the first block, after payments, that were made before shards were added
+                next_id = 1 + max(
+                    Payment.objects.using(alias).aggregate(last=Max('pk'))['last'] or 0 for alias in sharding.shards()
+                )
+                cls.objects.create(pk=1, next_id=next_id + size)
+            else:
+                blocks.update(next_id=F('next_id') + size)
+        return range(next_id, next_id + size)
+
+
+class PaymentFeedSequence(models.Model):
+    """
+    The last position of transfers in the change feed, in the default database, see `core.feed`.
+    Transfers are committed without positions, so writers do not wait for each other on this row. Committed ones
+    are given positions by readers of the feed, see `assign`, under the lock of this row, so a transfer committed
+    after an assignment is given a position after all of its ones, whatever the order of ids is: a transfer,
+    that gets a lower id, but is committed after one with a higher id, is not left behind cursors of consumers.
+    """
+    class Meta:
+        verbose_name = "Payment feed sequence"
+
+    last = models.BigIntegerField(verbose_name=ugettext_lazy("Last position"), default=0)
+
+    @classmethod
+    def assign(cls) -> int:
+        """
+        Gives positions to committed transfers of every shard, that have none yet, returns their number.
+        Transfers of a shard are numbered in the order of their ids, after positions of the ones numbered before.
+        """
+        aliases = sharding.shards()
+        pending = Payment.objects.filter(feed_sequence__isnull=True)
+        if not any(pending.using(alias).exists() for alias in aliases):
+            return 0
+        count = 0
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            # the row is locked by the write until the commit, on backends without row locks the database is
+            locked = cls.objects.filter(pk=1)
+            created = not locked.update(last=F('last'))
+            if created:
+                # the row is created by the first assignment, e.g. after tables are flushed or migrated
+                cls.objects.bulk_create([cls(pk=1)], ignore_conflicts=True)
+                locked.update(last=F('last'))
+            last = locked.values_list('last', flat=True).get()
+            if created or sharding.is_sharded():
+                # positions of shards are committed before this row, so ones of an assignment, that stopped
+                # between them, are not given again
+                last = max(last, *(
+                    Payment.objects.using(alias).aggregate(last=Max('feed_sequence'))['last'] or 0
+                    for alias in aliases
+                ))
+            for alias in aliases:
+                with transaction.atomic(using=alias):
+                    ids = pending.using(alias).aggregate(first=Min('pk'), last=Max('pk'))
+                    if ids['first'] is None:
+                        continue
+                    # transfers committed meanwhile with ids between these ones are numbered too, ones with lower
+                    # ids are left to the next assignment, so every position is greater than the ones given before
+                    count += pending.using(alias).filter(pk__gte=ids['first'], pk__lte=ids['last']).update(
+                        feed_sequence=F('pk') + (last + 1 - ids['first']),
+                    )
+                    last += ids['last'] - ids['first'] + 1
+            locked.update(last=last)
+        return count
+
+
+class CrossShardTransfer(FxConversion):
+    """
+    Recovery log of a transfer between accounts of different shards, in the default database,
+    its id is the id of the payment. The transfer is made with two-phase commit: the shard of each account prepares
+    its side in a local transaction, see `PreparedTransfer`, then the decision is logged, and both sides are
+    committed or aborted. Every state is changed from the expected one only, so the transfer is decided once,
+    by its coordinator or by `recover_transfers` command, that finishes transfers left by coordinators.
+    """
+    class Meta:
+        verbose_name = "Cross-shard transfer"
+        ordering = ['pk']
+        indexes = [
+            models.Index(fields=['state', 'id'], name='cross_shard_state_idx'),
+        ]
+
+    STATE_PREPARING = 'PREPARING'
+    STATE_COMMITTING = 'COMMITTING'
+    STATE_COMMITTED = 'COMMITTED'
+    STATE_ABORTING = 'ABORTING'
+    STATE_ABORTED = 'ABORTED'
+    STATES = (STATE_PREPARING, STATE_COMMITTING, STATE_COMMITTED, STATE_ABORTING, STATE_ABORTED)
+
+    id = models.BigIntegerField(verbose_name=ugettext_lazy("Payment ID"), primary_key=True)
+    from_account = models.CharField(verbose_name=ugettext_lazy("Source account ID"), max_length=200)
+    to_account = models.CharField(verbose_name=ugettext_lazy("Destination account ID"), max_length=200)
+    amount = models.DecimalField(verbose_name=ugettext_lazy("Amount"), max_digits=20, decimal_places=4)
+    currency = models.CharField(verbose_name=ugettext_lazy("Currency"), max_length=5, choices=CURRENCY_CHOICES)
+    state = models.CharField(
+        verbose_name=ugettext_lazy("State"), max_length=10, choices=tuple((_s, _s) for _s in STATES),
+        default=STATE_PREPARING,
+    )
+    created_at = models.DateTimeField(verbose_name=ugettext_lazy("Created at"), default=timezone.now)
+    changed_at = models.DateTimeField(verbose_name=ugettext_lazy("Changed at"), default=timezone.now)
+
+    @classmethod
+    def transfer(
+        cls, from_account_id: str, to_account_id: str, amount: Decimal, currency: str,
+        idempotency_key: Optional['IdempotencyKey'] = None, to_currency: Optional[str] = None,
+    ) -> 'Payment':
+        """
+        Makes the transfer between accounts of different shards, returns its payment in the shard of the source
+        account. Every step is committed on its own, so it is made outside of transactions of these databases.
+        If a side can not be prepared, the transfer is aborted and the error is raised; if the coordinator stops
+        after that, the transfer is finished by `recover_transfers` command.
+        Raises UnknownAccount, InvalidAccountCurrency, InvalidAmount, InsufficientBalance, TransferAborted,
+        UnknownFxRate
+        :param idempotency_key: not saved record of the request, it is saved together with the prepared debit,
+            so IntegrityError is raised and nothing is paid if the key is already used
+        :param to_currency: currency of the destination account, see `Account.pay`
+        """
+        if amount < 0:
+            raise InvalidAmount()
+        conversion = FxRate.convert(amount, currency, to_currency or currency)
+        aliases = {DEFAULT_DB_ALIAS, sharding.shard_for(from_account_id), sharding.shard_for(to_account_id)}
+        if any(connections[alias].in_atomic_block for alias in aliases):
+            raise TransactionManagementError("Cross-shard transfers can not be made inside of transactions.")
+
+        log = cls.objects.create(
+            id=PaymentIdBlock.take(1)[0], from_account=from_account_id, to_account=to_account_id, amount=amount,
+            currency=currency, **conversion
+        )
+        try:
+            log._prepare_side(PreparedTransfer.SIDE_DEBIT, idempotency_key)
+            log._prepare_side(PreparedTransfer.SIDE_CREDIT)
+        except Exception:
+            log.abort()
+            raise
+        if not log._change_state(cls.STATE_PREPARING, cls.STATE_COMMITTING):
+            # the transfer was prepared for too long, and it is aborted by recovery
+            log.abort()
+            raise TransferAborted()
+        return log.commit()
+
+    def commit(self) -> 'Payment':
+        """
+        Commits both sides of the transfer, that is decided to be committed, returns its payment in the shard
+        of the source account
+        """
+        payment = self._commit_side(PreparedTransfer.SIDE_DEBIT)
+        self._commit_side(PreparedTransfer.SIDE_CREDIT)
+        self._change_state(self.STATE_COMMITTING, self.STATE_COMMITTED)
+        return payment
+
+    def abort(self):
+        """
+        Aborts both sides of the transfer, unless it is decided to be committed
+        """
+        if self.state == self.STATE_PREPARING and not self._change_state(self.STATE_PREPARING, self.STATE_ABORTING):
+            self.refresh_from_db(fields=('state',))
+        if self.state != self.STATE_ABORTING:
+            return
+        for side in PreparedTransfer.SIDES:
+            self._abort_side(side)
+        self._change_state(self.STATE_ABORTING, self.STATE_ABORTED)
+
+    @classmethod
+    def recover(cls, prepared_before: datetime) -> int:
+        """
+        Finishes transfers, that were left by their coordinators: decided ones are committed or aborted, and ones,
+        that are not decided since before `prepared_before`, are aborted. Returns the number of transfers
+        """
+        transfers = cls.objects.filter(
+            state__in=(cls.STATE_PREPARING, cls.STATE_COMMITTING, cls.STATE_ABORTING),
+        ).exclude(state=cls.STATE_PREPARING, created_at__gte=prepared_before).order_by('pk')
+        count = 0
+        for log in transfers.iterator():
+            if log.state == cls.STATE_COMMITTING:
+                log.commit()
+            else:
+                log.abort()
+            count += 1
+        return count
+
+    def _change_state(self, expected: str, state: str) -> bool:
+        changed = CrossShardTransfer.objects.filter(pk=self.pk, state=expected).update(
+            state=state, changed_at=timezone.now(),
+        )
+        if changed:
+            self.state = state
+        return bool(changed)
+
+    def _side(self, side: str) -> Tuple[str, str, Decimal, str]:
+        """
+        Account of the side, its shard, the change of its balance and its currency
+        """
+        if side == PreparedTransfer.SIDE_DEBIT:
+            return self.from_account, sharding.shard_for(self.from_account), -self.amount, self.currency
+        return self.to_account, sharding.shard_for(self.to_account), self.credit_amount, self.credit_currency
+
+    def _prepare_side(self, side: str, idempotency_key: Optional['IdempotencyKey'] = None):
+        account_id, using, _, side_currency = self._side(side)
+        with transaction.atomic(using=using):
+            currency = Account._select_for_transfer([account_id], using).values_list('currency', flat=True).first()
+            if currency is None:
+                raise UnknownAccount([account_id])
+            if currency != side_currency:
+                raise InvalidAccountCurrency([account_id])
+            if side == PreparedTransfer.SIDE_DEBIT:
+                hold = Account.objects.using(using).filter(pk=account_id, balance__gte=F('held') + self.amount)
+                held = hold.update(held=F('held') + self.amount)
+                if not held and Account._consolidate_buckets(account_id, using):
+                    held = hold.update(held=F('held') + self.amount)
+                if not held:
+                    raise InsufficientBalance()
+            PreparedTransfer(transfer_id=self.pk, side=side, account=account_id).save(using=using, force_insert=True)
+            if idempotency_key is not None:
+                idempotency_key.payment_id = self.pk
+                idempotency_key.save(using=using, force_insert=True)
+
+    def _commit_side(self, side: str) -> 'Payment':
+        account_id, using, change, _ = self._side(side)
+        debit = side == PreparedTransfer.SIDE_DEBIT
+        with transaction.atomic(using=using):
+            list(Account._select_for_transfer([account_id], using).values_list('pk', flat=True))
+            prepared = PreparedTransfer.locked(self.pk, side, using)
+            if prepared.state == PreparedTransfer.STATE_COMMITTED:
+                return Payment.objects.using(using).get(pk=self.pk)
+
+            changes = {'balance': F('balance') + change, 'sequence': F('sequence') + 1}
+            if debit:
+                changes['held'] = F('held') - self.amount
+            accounts = Account.objects.using(using).filter(pk=account_id)
+            accounts.update(**changes)
+            balance, sequence, owner = accounts.values_list('balance', 'sequence', 'owner').get()
+
+            # the row is an entry of the ledger of this account only
+            payment = Payment(
+                pk=self.pk, from_account_id=self.from_account, to_account_id=self.to_account, amount=self.amount,
+                currency=self.currency, **self.conversion()
+            )
+            setattr(payment, 'from_sequence' if debit else 'to_sequence', sequence)
+            if not debit:
+                payment.feed_sequence = 0
+            payment.save(using=using, force_insert=True)
+            snapshots = BalanceSnapshot.due(account_id, sequence, balance, 1, change, payment.created_at)
+            if snapshots:
+                BalanceSnapshot.objects.using(using).bulk_create(snapshots)
+            OwnerTotal.add_payments([payment], {account_id: owner}, using)
+            prepared.state = PreparedTransfer.STATE_COMMITTED
+            prepared.save(update_fields=('state',))
+            ChangeCounter.bump([account_id], using)
+
+            transaction.on_commit(
+                lambda: balances_changed.send(sender=Account, account_ids=[account_id]), using=using,
+            )
+        return payment
+
+    def _abort_side(self, side: str):
+        account_id, using, _, _ = self._side(side)
+        with transaction.atomic(using=using):
+            list(Account._select_for_transfer([account_id], using).values_list('pk', flat=True))
+            prepared = PreparedTransfer.locked(self.pk, side, using)
+            if prepared is None:
+                # the side can not be prepared after it is aborted
+                PreparedTransfer(
+                    transfer_id=self.pk, side=side, account=account_id, state=PreparedTransfer.STATE_ABORTED,
+                ).save(using=using, force_insert=True)
+                return
+            if prepared.state != PreparedTransfer.STATE_PREPARED:
+                return
+            if side == PreparedTransfer.SIDE_DEBIT:
+                Account.objects.using(using).filter(pk=account_id).update(held=F('held') - self.amount)
+                IdempotencyKey.objects.using(using).filter(payment_id=self.pk).delete()
+            prepared.state = PreparedTransfer.STATE_ABORTED
+            prepared.save(update_fields=('state',))
+
+
+class PreparedTransfer(models.Model):
+    """
+    Side of a cross-shard transfer in the shard of its account, see `CrossShardTransfer`.
+    A prepared debit holds the amount on the source account, so it can not be spent by other transfers,
+    and neither side is a ledger entry until it is committed. A side, that is aborted before it is prepared,
+    is stored as aborted, so it can not be prepared after that.
+    """
+    class Meta:
+        verbose_name = "Prepared transfer"
+        ordering = ['transfer_id', 'side']
+        constraints = [
+            models.UniqueConstraint(fields=['transfer_id', 'side'], name='prepared_transfer_side_uniq'),
+        ]
+
+    SIDE_DEBIT = 'DEBIT'
+    SIDE_CREDIT = 'CREDIT'
+    SIDES = (SIDE_DEBIT, SIDE_CREDIT)
+
+    STATE_PREPARED = 'PREPARED'
+    STATE_COMMITTED = 'COMMITTED'
+    STATE_ABORTED = 'ABORTED'
+    STATES = (STATE_PREPARED, STATE_COMMITTED, STATE_ABORTED)
+
+    transfer_id = models.BigIntegerField(verbose_name=ugettext_lazy("Transfer ID"))
+    side = models.CharField(
+        verbose_name=ugettext_lazy("Side"), max_length=6, choices=tuple((_s, _s) for _s in SIDES),
+    )
+    account = models.CharField(verbose_name=ugettext_lazy("Account ID"), max_length=200)
+    state = models.CharField(
+        verbose_name=ugettext_lazy("State"), max_length=9, choices=tuple((_s, _s) for _s in STATES),
+        default=STATE_PREPARED,
+    )
+    created_at = models.DateTimeField(verbose_name=ugettext_lazy("Created at"), default=timezone.now)
+
+    @classmethod
+    def locked(cls, transfer_id: int, side: str, using: str) -> Optional['PreparedTransfer']:
+        """
+        The side of the transfer, locked for update where the database supports row locks
+        """
+        sides = cls.objects.using(using).filter(transfer_id=transfer_id, side=side)
+        if connections[using].features.has_select_for_update:
+            sides = sides.select_for_update()
+        return sides.first()
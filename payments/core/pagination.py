@@ -0,0 +1,54 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Opaque cursor pagination, keyed on the model's default `Meta.ordering`.
+    Every page is fetched with an indexed `WHERE pk < cursor ... LIMIT n` query,
+    so its cost does not depend on how deep in the list the page is.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        return tuple(queryset.model._meta.ordering)
+
+
+class LegsPagination(KeysetPagination):
+    """
+    Keyset pagination of transfers, that are listed as their legs, see `get_legs` of the view.
+    `page_size` counts legs, as it did when every leg was stored as a row, so a page ends with the last transfer,
+    whose legs fit in it, and the next page starts with the transfer after it. A page holds one transfer at least.
+    Legs of the page are built once, and they are kept as `legs`.
+    """
+    legs = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = super().paginate_queryset(queryset, request, view)
+        if page is None:
+            return None
+        # pages before the cursor are read backwards, so they are filled from their ends
+        reverse = self.cursor is not None and self.cursor.reverse
+        rows = page[::-1] if reverse else page
+        transfer_legs = view.get_legs(rows)
+        count = legs = 0
+        for matching in transfer_legs:
+            legs += len(matching)
+            if count and legs > self.page_size:
+                break
+            count += 1
+        transfer_legs = transfer_legs[:count]
+        self.legs = [leg for matching in (transfer_legs[::-1] if reverse else transfer_legs) for leg in matching]
+        if count == len(rows):
+            return page
+
+        position = self._get_position_from_instance(rows[count], self.ordering)
+        if reverse:
+            self.page = rows[:count][::-1]
+            self.has_previous, self.previous_position = True, position
+        else:
+            self.page = rows[:count]
+            self.has_next, self.next_position = True, position
+        if self.template is not None:
+            self.display_page_controls = True
+        return self.page
@@ -0,0 +1,117 @@
+"""
+Bulk provisioning of accounts with opening balances, e.g. when a partner is onboarded.
+
+Rows are read as a stream and are processed in batches, so memory used by an import does not depend on its size.
+Every row is validated by `NewAccountSerializer`, ids of a batch are checked against accounts of their shards
+with one query per shard, and new accounts are inserted with one `bulk_create` per shard, in a transaction
+together with totals of their owners. Invalid rows and rows with ids, that are already used, are rejected
+one by one, and the rest of the import goes on.
+"""
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple, Union
+
+from django.db import IntegrityError, transaction
+
+from core import sharding
+from core.errors import DuplicateAccount, InvalidAccount
+from core.models import Account, ChangeCounter, OwnerTotal
+from core.serializers import NewAccountSerializer
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# number of the row, counted from 1, id of its account, if it is known, and the error of the row
+Rejection = Tuple[int, Optional[str], Exception]
+
+
+def read_rows(stream: TextIO, input_format: str) -> Iterator[Union[dict, Exception]]:
+    """
+    Rows of CSV with a header or of newline delimited JSON objects, blank lines of the latter are skipped.
+    Rows, that can not be read, are InvalidAccount errors
+    """
+    if input_format == FORMAT_CSV:
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield InvalidAccount({'non_field_errors': ['Invalid JSON: {}'.format(e)]})
+
+
+def import_accounts(
+    rows: Iterable[Union[dict, Exception]], batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Iterator[Tuple[int, List[Rejection]]]:
+    """
+    Creates accounts of `rows`, that are data of `NewAccountSerializer`, or errors of rows, that could not be read.
+    Yields the number of created accounts and rejected rows of every batch, as it is done
+    """
+    numbered = enumerate(rows, 1)
+    while True:
+        batch = list(islice(numbered, batch_size))
+        if not batch:
+            return
+        yield _import_batch(batch, batch_size)
+
+
+def _import_batch(batch: List[Tuple[int, Union[dict, Exception]]], batch_size: int) -> Tuple[int, List[Rejection]]:
+    accounts = {}  # type: Dict[str, Tuple[int, Account]]
+    rejections = []
+    for number, row in batch:
+        if isinstance(row, Exception):
+            rejections.append((number, None, row))
+            continue
+        serializer = NewAccountSerializer(data=row)
+        if not serializer.is_valid():
+            account_id = row.get('id') if isinstance(row, dict) else None
+            rejections.append((number, account_id, InvalidAccount(serializer.errors)))
+            continue
+        account = Account(**serializer.validated_data)
+        if account.pk in accounts:
+            rejections.append((number, account.pk, DuplicateAccount([account.pk])))
+            continue
+        accounts[account.pk] = (number, account)
+
+    shards = defaultdict(list)
+    for number, account in accounts.values():
+        shards[sharding.shard_for(account.pk)].append(account)
+    created = 0
+    for alias, shard_accounts in shards.items():
+        try:
+            existing_ids = _create(shard_accounts, batch_size, alias)
+        except IntegrityError:
+            # accounts with the same ids were created after they were checked
+            existing_ids = _create(shard_accounts, batch_size, alias)
+        created += len(shard_accounts) - len(existing_ids)
+        rejections.extend(
+            (accounts[account_id][0], account_id, DuplicateAccount([account_id])) for account_id in existing_ids
+        )
+    rejections.sort(key=lambda rejection: rejection[0])
+    return created, rejections
+
+
+def _create(accounts: List[Account], batch_size: int, using: str) -> Set[str]:
+    """
+    Inserts accounts of the shard, whose ids are not used yet, returns the used ones
+    """
+    with transaction.atomic(using=using):
+        existing_ids = set(
+            Account.objects.using(using).filter(pk__in=[account.pk for account in accounts])
+            .values_list('pk', flat=True)
+        )
+        new_accounts = [account for account in accounts if account.pk not in existing_ids]
+        if new_accounts:
+            Account.objects.using(using).bulk_create(new_accounts, batch_size=batch_size)
+            # `bulk_create` sends no signals, so totals and cached account lists of owners are updated here
+            owners = {account.owner for account in new_accounts}
+            OwnerTotal.refresh(owners, using)
+            ChangeCounter.bump([ChangeCounter.owner_key(owner) for owner in owners], using)
+    return existing_ids
@@ -0,0 +1,248 @@
+"""
+Compact binary format of lists for bulk consumers, negotiated with `Accept: application/vnd.payments.columns`
+or `?format=columns`.
+
+Rows of a list are stored by columns, whose types come from fields of the serializer of the view: decimal values
+are 64-bit integers scaled by 10 ** decimal_places of their fields, integers are 64-bit integers, and other values
+are strings, that are dictionary encoded, so account ids, currencies and directions, which repeat across rows,
+are stored once per response. Integers are little-endian:
+
+    document: MAGIC, version: u8, kind: u8, body
+    kind 'P' (page of rows): next: str, previous: str, table
+    kind 'L' (list of rows): table
+    kind 'J' (any other data, e.g. errors): UTF-8 JSON
+    table: rows: u32, columns: u8, column * columns
+    column: name: str, type: u8, values
+        type 'D': scale: u8, rows * i64
+        type 'I': rows * i64
+        type 'S': entries: u32, entries * u32 lengths, UTF-8 of entries, rows * u32 indexes of entries
+    Decimal and integer columns, whose values do not fit i64, are string columns of the strings of JSON.
+    str: length: u32, UTF-8, the length is NULL_LENGTH for null
+"""
+import json
+import struct
+import sys
+from array import array
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from rest_framework import renderers, serializers
+from rest_framework.utils.encoders import JSONEncoder
+
+MEDIA_TYPE = 'application/vnd.payments.columns'
+MAGIC = b'PAYC'
+VERSION = 1
+
+KIND_PAGE = b'P'
+KIND_LIST = b'L'
+KIND_JSON = b'J'
+
+TYPE_DECIMAL = b'D'
+TYPE_INTEGER = b'I'
+TYPE_STRING = b'S'
+
+NULL_LENGTH = 0xFFFFFFFF
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# name, type and scale of decimal values
+Column = Tuple[str, bytes, int]
+
+# next and previous links of a page, or None for a list, values by columns, and scales of decimal columns,
+# whose values are scaled integers
+Table = Tuple[Optional[Tuple[Optional[str], Optional[str]]], Dict[str, list], Dict[str, int]]
+
+
+def columns(serializer: serializers.Serializer) -> List[Column]:
+    """
+    Columns of readable fields of the serializer
+    """
+    result = []
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.DecimalField):
+            result.append((name, TYPE_DECIMAL, field.decimal_places))
+        elif isinstance(field, serializers.IntegerField):
+            result.append((name, TYPE_INTEGER, 0))
+        else:
+            result.append((name, TYPE_STRING, 0))
+    return result
+
+
+def _integers(typecode: str, values: Iterable[int]) -> bytes:
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _string(value: Optional[str]) -> bytes:
+    if value is None:
+        return struct.pack('<I', NULL_LENGTH)
+    value = value.encode()
+    return struct.pack('<I', len(value)) + value
+
+
+def _scaled(values: list, scale: int) -> List[int]:
+    point = -scale - 1
+    # decimal strings of serializers have exactly `decimal_places` digits of fractions, they are scaled as they are
+    return [
+        int(value.replace('.', '')) if isinstance(value, str) and value[point:point + 1] == '.'
+        else int(Decimal(value).scaleb(scale))
+        for value in values
+    ]
+
+
+def encode(rows: List[dict], table_columns: List[Column], page: Optional[Tuple[str, str]] = None) -> bytes:
+    """
+    Document of rows, that are representations of the serializer of `table_columns`, `page` is next and previous links
+    """
+    parts = [MAGIC, struct.pack('<B', VERSION)]
+    if page is None:
+        parts.append(KIND_LIST)
+    else:
+        parts += [KIND_PAGE, _string(page[0]), _string(page[1])]
+    parts.append(struct.pack('<IB', len(rows), len(table_columns)))
+
+    for name, column_type, scale in table_columns:
+        values = [row[name] for row in rows]
+        if column_type == TYPE_DECIMAL:
+            integers = _scaled(values, scale)
+        elif column_type == TYPE_INTEGER:
+            integers = values
+        if column_type != TYPE_STRING and not all(INT64_MIN <= value <= INT64_MAX for value in integers):
+            # values, that do not fit 64 bits, e.g. amounts above 9.2e14 scaled by 10 ** 4, are stored as strings
+            column_type = TYPE_STRING
+        parts += [_string(name), column_type]
+        if column_type == TYPE_DECIMAL:
+            parts += [struct.pack('<B', scale), _integers('q', integers)]
+        elif column_type == TYPE_INTEGER:
+            parts.append(_integers('q', integers))
+        else:
+            indexes = {}
+            codes = [indexes.setdefault(value, len(indexes)) for value in values]
+            entries = [None if value is None else str(value).encode() for value in indexes]
+            parts += [
+                struct.pack('<I', len(entries)),
+                _integers('I', (NULL_LENGTH if entry is None else len(entry) for entry in entries)),
+                b''.join(entry for entry in entries if entry is not None),
+                _integers('I', codes),
+            ]
+    return b''.join(parts)
+
+
+class _Reader:
+    def __init__(self, content: bytes):
+        self.content = content
+        self.offset = 0
+
+    def take(self, size: int) -> bytes:
+        if self.offset + size > len(self.content):
+            raise ValueError('Truncated document')
+        chunk = self.content[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def unpack(self, fmt: str) -> tuple:
+        return struct.unpack(fmt, self.take(struct.calcsize(fmt)))
+
+    def integers(self, typecode: str, count: int) -> List[int]:
+        values = array(typecode)
+        values.frombytes(self.take(values.itemsize * count))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values.tolist()
+
+    def string(self) -> Optional[str]:
+        length, = self.unpack('<I')
+        return None if length == NULL_LENGTH else self.take(length).decode()
+
+
+def _read_kind(reader: _Reader) -> bytes:
+    if reader.take(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a columns document')
+    version, = reader.unpack('<B')
+    if version != VERSION:
+        raise ValueError('Unsupported version {}'.format(version))
+    kind = reader.take(1)
+    if kind not in (KIND_PAGE, KIND_LIST, KIND_JSON):
+        raise ValueError('Unknown kind {!r}'.format(kind))
+    return kind
+
+
+def _read_table(reader: _Reader, kind: bytes) -> Table:
+    links = (reader.string(), reader.string()) if kind == KIND_PAGE else None
+    count, column_count = reader.unpack('<IB')
+    values, scales = {}, {}
+    for _ in range(column_count):
+        name = reader.string()
+        column_type = reader.take(1)
+        if column_type == TYPE_DECIMAL:
+            scales[name], = reader.unpack('<B')
+            values[name] = reader.integers('q', count)
+        elif column_type == TYPE_INTEGER:
+            values[name] = reader.integers('q', count)
+        elif column_type == TYPE_STRING:
+            size, = reader.unpack('<I')
+            entries = [
+                None if length == NULL_LENGTH else reader.take(length).decode()
+                for length in reader.integers('I', size)
+            ]
+            values[name] = [entries[index] for index in reader.integers('I', count)]
+        else:
+            raise ValueError('Unknown column type {!r}'.format(column_type))
+    return links, values, scales
+
+
+def read_table(content: bytes) -> Table:
+    """
+    Columns of the document of a list, as bulk consumers read them, without building rows
+    """
+    reader = _Reader(content)
+    kind = _read_kind(reader)
+    if kind == KIND_JSON:
+        raise ValueError('Not a document of a list')
+    return _read_table(reader, kind)
+
+
+def decode(content: bytes):
+    """
+    Data of the document as JSON has it, but with values of decimal columns as Decimal
+    """
+    reader = _Reader(content)
+    kind = _read_kind(reader)
+    if kind == KIND_JSON:
+        return json.loads(content[reader.offset:].decode())
+
+    links, values, scales = _read_table(reader, kind)
+    for name, scale in scales.items():
+        values[name] = [Decimal(value).scaleb(-scale) for value in values[name]]
+    rows = [dict(zip(values, row)) for row in zip(*values.values())]
+    if links is None:
+        return rows
+    return {'next': links[0], 'previous': links[1], 'results': rows}
+
+
+class ColumnsRenderer(renderers.BaseRenderer):
+    """
+    Renders lists of the view in the compact binary format, rows are representations of its serializer.
+    Errors and any other data are rendered as JSON in the same envelope.
+    """
+    media_type = MEDIA_TYPE
+    format = 'columns'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        renderer_context = renderer_context or {}
+        view = renderer_context.get('view')
+        response = renderer_context.get('response')
+        if view is not None and not (response is not None and response.exception):
+            if isinstance(data, list):
+                return encode(data, columns(view.get_serializer_class()()))
+            if isinstance(data, dict) and isinstance(data.get('results'), list):
+                return encode(
+                    data['results'], columns(view.get_serializer_class()()), (data.get('next'), data.get('previous')),
+                )
+        body = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+        return MAGIC + struct.pack('<B', VERSION) + KIND_JSON + body.encode()
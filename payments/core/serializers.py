@@ -1,22 +1,243 @@
-from core.models import Account, Payment
+import decimal
+import functools
+from typing import Callable, Iterable, List
+
+from core.const import CURRENCIES, PAYMENT_DIRECTIONS_INCOMING, PAYMENT_DIRECTIONS_OUTGOING
+from core.models import Account, FxRate, OwnerTotal, Payment, QueuedTransfer
 from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+
+def decimal_formatter(field: serializers.DecimalField) -> Callable[[decimal.Decimal], str]:
+    """
+    Function, that formats Decimal values exactly as `field.to_representation` does, but faster
+    """
+    if field.localize or not getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING):
+        return field.to_representation
+
+    quantum = decimal.Decimal('.1') ** field.decimal_places
+    context = decimal.getcontext().copy()
+    context.prec = field.max_digits
+    rounding = field.rounding
+
+    def format_decimal(value: decimal.Decimal) -> str:
+        return '{:f}'.format(value.quantize(quantum, rounding=rounding, context=context))
+
+    return format_decimal
+
+
+@functools.lru_cache(maxsize=None)
+def field_formatter(serializer_class: type, name: str) -> Callable[[decimal.Decimal], str]:
+    """
+    `decimal_formatter` of the field of the serializer class, that is built once, not with a serializer per call
+    """
+    return decimal_formatter(serializer_class().fields[name])
 
 
 class AccountSerializer(serializers.ModelSerializer):
+    # columns of `values_list` rows, that are accepted by `fast_representation`
+    fast_columns = ('pk', 'owner', 'balance', 'currency')
+
+    class Meta:
+        model = Account
+        fields = ('id', 'owner', 'balance', 'currency')
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if isinstance(instance, Account) and instance.buckets:
+            # credits pending in balance buckets are a part of the balance, see `BalanceBucket`
+            data['balance'] = self.fields['balance'].to_representation(instance.balance + instance.pending_balance())
+        return data
+
+    @classmethod
+    def fast_representation(cls, rows: Iterable[tuple]) -> List[dict]:
+        """
+        Read-only fast path for lists: the same output as `to_representation` has,
+        but built directly from `values_list(*fast_columns)` rows instead of model instances
+        """
+        format_balance = field_formatter(cls, 'balance')
+        return [
+            {'id': pk, 'owner': owner, 'balance': format_balance(balance), 'currency': currency}
+            for pk, owner, balance, currency in rows
+        ]
+
+
+class NewAccountSerializer(serializers.ModelSerializer):
+    """
+    Account with its opening balance, that is created by bulk provisioning, see `core.provisioning`.
+    Uniqueness of ids is checked there, for many accounts at once.
+    """
     class Meta:
         model = Account
         fields = ('id', 'owner', 'balance', 'currency')
+        extra_kwargs = {
+            'id': {'validators': []},
+            'balance': {'min_value': decimal.Decimal(0)},
+        }
+
+
+class AccountsCreateSerializer(serializers.Serializer):
+    """
+    Accounts to create at once, every item is validated by `NewAccountSerializer`, and invalid ones are rejected
+    one by one
+    """
+    MAX_ACCOUNTS = 10000
+
+    accounts = serializers.ListField(child=serializers.DictField(), allow_empty=False, max_length=MAX_ACCOUNTS)
+
+
+class AccountField(serializers.PrimaryKeyRelatedField):
+    """
+    Account by its id, with its cached fields, that payments are validated with, see `Account.cached`.
+    An account deleted by another process may still be cached, so serializers check, that accounts exist,
+    see `PaymentSerializer.validate`
+    """
+    def to_internal_value(self, data):
+        if isinstance(data, bool) or not isinstance(data, (str, int)):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        account = Account.cached(str(data))
+        if account is None:
+            self.fail('does_not_exist', pk_value=data)
+        return account
+
+
+class AccountBalanceSerializer(serializers.Serializer):
+    """
+    Balance of the account at a point in time, `sequence` is the one of its last ledger entry made by then
+    """
+    id = serializers.CharField()
+    at = serializers.DateTimeField()
+    balance = serializers.DecimalField(max_digits=20, decimal_places=4)
+    sequence = serializers.IntegerField()
+
+
+class FxRateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FxRate
+        fields = ('from_currency', 'to_currency', 'rate', 'version')
+
+
+class OwnerTotalSerializer(serializers.ModelSerializer):
+    """
+    Totals of the owner in the currency, with volumes of payments during a window, that are set on instances
+    """
+    outgoing = serializers.DecimalField(max_digits=24, decimal_places=4, read_only=True)
+    outgoing_payments = serializers.IntegerField(read_only=True)
+    incoming = serializers.DecimalField(max_digits=24, decimal_places=4, read_only=True)
+    incoming_payments = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = OwnerTotal
+        fields = (
+            'owner', 'currency', 'accounts', 'balance', 'outgoing', 'outgoing_payments', 'incoming',
+            'incoming_payments',
+        )
 
 
 class PaymentSerializer(serializers.ModelSerializer):
+    to_account = AccountField(queryset=Account.objects.all())
+    from_account = AccountField(queryset=Account.objects.all())
     direction = serializers.CharField(required=False)
+    # currency of the destination account, if the amount is converted to it, see `Account.pay`
+    to_currency = serializers.ChoiceField(choices=CURRENCIES, required=False, write_only=True)
+
+    # columns of `values_list` rows, that are accepted by `fast_legs`
+    fast_columns = ('pk', 'to_account_id', 'from_account_id', 'amount', 'currency', 'to_amount', 'to_currency')
 
     class Meta:
         model = Payment
-        fields = ('to_account', 'from_account', 'direction', 'amount', 'currency')
+        fields = ('to_account', 'from_account', 'direction', 'amount', 'currency', 'to_currency')
+
+    def validate(self, attrs):
+        # currencies of accounts come from the cache, but their existence is checked in the database,
+        # with one query per shard of the accounts
+        names = ('from_account', 'to_account')
+        existing = set()
+        for alias in {attrs[name]._state.db for name in names}:
+            account_ids = [attrs[name].pk for name in names if attrs[name]._state.db == alias]
+            existing.update(Account.objects.using(alias).filter(pk__in=account_ids).values_list('pk', flat=True))
+        errors = {
+            name: [self.fields[name].error_messages['does_not_exist'].format(pk_value=attrs[name].pk)]
+            for name in names if attrs[name].pk not in existing
+        }
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    @classmethod
+    def fast_legs(cls, rows: Iterable[tuple]) -> List[dict]:
+        """
+        Read-only fast path for lists: the same output as `to_representation` of `Payment.legs()` has,
+        but built directly from `values_list(*fast_columns)` rows instead of model instances
+        """
+        format_amount = field_formatter(cls, 'amount')
+        legs = []
+        for _, to_account_id, from_account_id, amount, currency, to_amount, to_currency in rows:
+            amount = format_amount(amount)
+            legs.append({
+                'to_account': from_account_id, 'from_account': to_account_id,
+                'direction': PAYMENT_DIRECTIONS_INCOMING,
+                'amount': amount if to_amount is None else format_amount(to_amount),
+                'currency': to_currency or currency,
+            })
+            legs.append({
+                'to_account': to_account_id, 'from_account': from_account_id,
+                'direction': PAYMENT_DIRECTIONS_OUTGOING, 'amount': amount, 'currency': currency,
+            })
+        return legs
 
     def create(self, validated_data):
-        payments = validated_data['from_account'].pay(
-            validated_data['to_account'], validated_data['amount'], validated_data['currency']
+        return validated_data['from_account'].pay(
+            validated_data['to_account'], validated_data['amount'], validated_data['currency'],
+            idempotency_key=validated_data.get('idempotency_key'), to_currency=validated_data.get('to_currency'),
+        )
+
+
+class PaymentsFeedSerializer(serializers.Serializer):
+    """
+    Query of the change feed of payments: the cursor, the size of the batch and seconds to wait for new payments
+    """
+    MAX_LIMIT = 1000
+
+    since = serializers.IntegerField(min_value=0, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=MAX_LIMIT, required=False)
+    wait = serializers.FloatField(min_value=0, required=False)
+
+
+class QueuedTransferSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = QueuedTransfer
+        fields = (
+            'id', 'status', 'payment', 'error', 'to_account', 'from_account', 'amount', 'currency', 'to_currency',
+            'created_at', 'processed_at',
         )
-        return payments[0]
+
+
+class TransferSerializer(serializers.Serializer):
+    """
+    Transfer item of a batch. Accounts are not looked up here one by one,
+    all of them are loaded at once by `Account.pay_batch`.
+    """
+    to_account = serializers.CharField(max_length=200)
+    from_account = serializers.CharField(max_length=200)
+    amount = serializers.DecimalField(max_digits=20, decimal_places=4)
+    currency = serializers.ChoiceField(choices=CURRENCIES)
+    to_currency = serializers.ChoiceField(choices=CURRENCIES, required=False)
+
+
+class PaymentBatchSerializer(serializers.Serializer):
+    MODE_ALL_OR_NOTHING = 'all_or_nothing'
+    MODE_PER_ITEM = 'per_item'
+
+    mode = serializers.ChoiceField(choices=(MODE_ALL_OR_NOTHING, MODE_PER_ITEM), default=MODE_ALL_OR_NOTHING)
+    transfers = TransferSerializer(many=True, allow_empty=False)
+
+    def create(self, validated_data):
+        transfers = [
+            (
+                item['from_account'], item['to_account'], item['amount'], item['currency'],
+                item.get('to_currency', item['currency']),
+            )
+            for item in validated_data['transfers']
+        ]
+        return Account.pay_batch(transfers, atomic=validated_data['mode'] == self.MODE_ALL_OR_NOTHING)
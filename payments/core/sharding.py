@@ -0,0 +1,85 @@
+"""
+Sharding of accounts across databases.
+
+Accounts are placed into databases of ACCOUNT_SHARDS by hashes of their ids, and everything, that is written
+together with accounts, is stored in their shards: payments, balance snapshots, change counters, idempotency keys
+of payments and totals of owners. With one shard nothing is sharded, and it is the default database.
+
+Queries without instances are not routed, so sharded code chooses databases explicitly with `using`: the shard
+of the account (`shard_for`), or every shard with `fan_out`, whose rows are merged in the order of the query.
+A transfer between accounts of one shard is a local transaction of it, and a transfer between shards is made with
+two-phase commit, that is logged in the default database, see `CrossShardTransfer`. Payments of such transfers
+are stored in both shards, as ledger entries of the account of each of them. Ids of payments are unique across
+shards, see `PaymentIdBlock`, so both rows have the same id and the transfer is listed once.
+"""
+import zlib
+from typing import Callable, List, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from core.merging import MergedQuery
+
+# models, that are stored in the default database only, whatever the shards are
+DEFAULT_DB_MODELS = (
+    'core.CrossShardTransfer', 'core.FxRate', 'core.PaymentFeedSequence', 'core.PaymentIdBlock', 'core.QueuedTransfer',
+)
+
+
+def shards() -> List[str]:
+    return list(settings.ACCOUNT_SHARDS)
+
+
+def is_sharded() -> bool:
+    return len(settings.ACCOUNT_SHARDS) > 1
+
+
+def shard_for(account_id: str) -> str:
+    """
+    Alias of the database of the account
+    """
+    aliases = settings.ACCOUNT_SHARDS
+    if len(aliases) == 1:
+        return aliases[0]
+    return aliases[zlib.crc32(account_id.encode('utf-8')) % len(aliases)]
+
+
+def fan_out(queryset, combine: Optional[Callable[[list], object]] = None):
+    """
+    Query of the queryset in every shard, or the queryset itself if there is one shard.
+    Rows of shards are merged in the order of the queryset, that has to be ordered by a unique key: a row found in
+    several shards is returned once, e.g. a payment of a cross-shard transfer, or rows with equal keys are combined
+    into one by `combine`, if it is given. Querysets of a `MergedQuery` are merged with querysets of other shards.
+    """
+    if not is_sharded():
+        return queryset
+    querysets = queryset.querysets if isinstance(queryset, MergedQuery) else (queryset,)
+    return MergedQuery(
+        (queryset.using(alias) for alias in shards() for queryset in querysets),
+        distinct=combine is None, combine=combine,
+    )
+
+
+class ShardRouter:
+    """
+    Saves new accounts into their shards, and keeps models of the default database in it.
+    Relations between models of the app are allowed across databases: payments of cross-shard transfers
+    and queued transfers reference accounts of other databases, their foreign keys are not constrained.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.label in DEFAULT_DB_MODELS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.label in DEFAULT_DB_MODELS:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if model._meta.label == 'core.Account' and isinstance(instance, model) and instance._state.db is None:
+            return shard_for(instance.pk)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == obj2._meta.app_label == 'core':
+            return True
+        return None
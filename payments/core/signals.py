@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent after the commit of a transaction, that changed balances of accounts, in the process, that made it.
+# Arguments: `account_ids` of changed accounts.
+# Caches of accounts delete entries of changed accounts by it, and validate the rest by change counters,
+# see `core.balances`.
+balances_changed = Signal()
@@ -1,11 +1,59 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
 from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipIf, skipUnless
 
-from core.errors import InvalidAccountCurrency, InvalidAmount, InsufficientBalance
-from django.test import TestCase
-from rest_framework.test import APIClient
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from core.errors import (
+    CrossShardBatch, InvalidAccountCurrency, InvalidAmount, InsufficientBalance, UnknownAccount, UnknownFxRate,
+)
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, transaction
+from django.db.models import F, Q
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 
-from core.const import CURRENCY_PHP, PAYMENT_DIRECTIONS_INCOMING, CURRENCY_USD, PAYMENT_DIRECTIONS_OUTGOING
-from core.models import Account, Payment
+from core.const import (
+    CURRENCY_EUR, CURRENCY_PHP, PAYMENT_DIRECTIONS_INCOMING, CURRENCY_USD, PAYMENT_DIRECTIONS_OUTGOING,
+)
+from core.filters import AccountsFilter, PaymentsFilter
+from core.merging import MergedQuery
+from core import (
+    balances, benchmarks, export, feed, idempotency, ledger, metrics, provisioning, renderers, sharding, transfer_queue,
+    views,
+)
+from core.benchmarks import servers
+from core.backends.sqlite3 import base as sqlite_backend
+from core.cache import DjangoCache, LRUCache
+from core.middleware import MetricsMiddleware
+from core.models import (
+    Account, BalanceBucket, BalanceSnapshot, ChangeCounter, CrossShardTransfer, FxRate, IdempotencyKey, OwnerTotal,
+    OwnerVolume, Payment, PaymentIdBlock, PreparedTransfer, QueuedTransfer,
+)
+from core.pagination import KeysetPagination
+from core.serializers import AccountSerializer, PaymentSerializer
+from core.signals import balances_changed
+
+
+def _legs(payments):
+    return [leg for payment in payments for leg in payment.legs()]
 
 
 class AccountsTestCase(TestCase):
@@ -13,6 +61,7 @@ class AccountsTestCase(TestCase):
 
     def setUp(self):
         self.client = APIClient()
+        balances.clear()
 
         self.owner_1 = 'owner_1'
         self.owner_2 = 'owner_2'
@@ -31,8 +80,9 @@ class AccountsTestCase(TestCase):
         response = self.client.put(self.accounts_url, format='json')
         self.assertEqual(response.status_code, 405)
 
+        # accounts are created in bulk, see AccountsImportTestCase
         response = self.client.post(self.accounts_url, format='json')
-        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.status_code, 400)
 
         response = self.client.patch(self.accounts_url, format='json')
         self.assertEqual(response.status_code, 405)
@@ -56,11 +106,44 @@ class AccountsTestCase(TestCase):
     def test_accounts_api_list(self):
         response = self.client.get(self.accounts_url, format='json')
         self.assertEqual(response.status_code, 200)
-        result = response.json()
+        result = response.json()['results']
         self.assertEqual(len(result), 4)
         for item, orig_account in zip(result, self.accounts):
             self._check_result_item(item, orig_account)
 
+    def test_accounts_api_list_pagination(self):
+        response = self.client.get(self.accounts_url, data={'page_size': 3}, format='json')
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertIsNone(page['previous'])
+        self.assertEqual([item['id'] for item in page['results']], ['acc_1', 'acc_2', 'acc_3'])
+
+        response = self.client.get(page['next'], format='json')
+        page = response.json()
+        self.assertIsNone(page['next'])
+        self.assertEqual([item['id'] for item in page['results']], ['acc_4'])
+
+        response = self.client.get(page['previous'], format='json')
+        page = response.json()
+        self.assertEqual([item['id'] for item in page['results']], ['acc_1', 'acc_2', 'acc_3'])
+
+    def test_accounts_api_list_max_page_size(self):
+        with mock.patch.object(KeysetPagination, 'max_page_size', 2):
+            response = self.client.get(self.accounts_url, data={'page_size': 1000}, format='json')
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_accounts_api_list_filters(self):
+        response = self.client.get(self.accounts_url, data={'owner': self.owner_2}, format='json')
+        self.assertEqual([item['id'] for item in response.json()['results']], ['acc_3', 'acc_4'])
+
+        response = self.client.get(self.accounts_url, data={'currency': CURRENCY_PHP}, format='json')
+        self.assertEqual([item['id'] for item in response.json()['results']], ['acc_1', 'acc_2', 'acc_3'])
+
+        response = self.client.get(
+            self.accounts_url, data={'owner': self.owner_2, 'currency': CURRENCY_USD}, format='json'
+        )
+        self.assertEqual([item['id'] for item in response.json()['results']], ['acc_4'])
+
     def test_accounts_pay_validations(self):
         with self.assertRaises(InvalidAccountCurrency) as cm:
             self.from_account.pay(self.to_account, Decimal(1), CURRENCY_USD)
@@ -89,21 +172,178 @@ class AccountsTestCase(TestCase):
 
         self.assertEqual(self.from_account.balance, Decimal(190))
         self.assertEqual(self.to_account.balance, Decimal(110))
-        self.assertEqual(Payment.objects.count(), 2)
+        self.assertEqual(Payment.objects.count(), 1)
 
-        incoming_payment = Payment.objects.get(to_account=self.from_account)
+        incoming_payment, outgoing_payment = Payment.objects.get().legs()
         self.assertEqual(incoming_payment.amount, Decimal(10))
         self.assertEqual(incoming_payment.currency, CURRENCY_PHP)
         self.assertEqual(incoming_payment.from_account, self.to_account)
         self.assertEqual(incoming_payment.direction, PAYMENT_DIRECTIONS_INCOMING)
 
-        outgoing_payment = Payment.objects.get(to_account=self.to_account)
         self.assertEqual(outgoing_payment.amount, Decimal(10))
         self.assertEqual(outgoing_payment.currency, CURRENCY_PHP)
         self.assertEqual(outgoing_payment.from_account, self.from_account)
         self.assertEqual(outgoing_payment.direction, PAYMENT_DIRECTIONS_OUTGOING)
 
 
+class AccountsImportTestCase(TestCase):
+    accounts_url = '/v1/accounts'
+
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+        Account.objects.create(id='acc_1', owner='owner_1', balance=10, currency=CURRENCY_PHP)
+
+    def _import(self, name, content, *args):
+        with tempfile.TemporaryDirectory() as directory:
+            path = '{}/{}'.format(directory, name)
+            with open(path, 'w') as output:
+                output.write(content)
+            out, err = StringIO(), StringIO()
+            call_command('import_accounts', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_api(self):
+        accounts = [
+            {'id': 'acc_2', 'owner': 'owner_1', 'balance': '100.5', 'currency': CURRENCY_PHP},
+            {'id': 'acc_3', 'owner': 'owner_2', 'currency': CURRENCY_USD},
+            {'id': 'acc_1', 'owner': 'owner_2', 'balance': '1', 'currency': CURRENCY_PHP},
+            {'id': 'acc_4', 'owner': 'owner_2', 'balance': '-1', 'currency': 'XXX'},
+            {'id': 'acc_2', 'owner': 'owner_3', 'balance': '1', 'currency': CURRENCY_PHP},
+        ]
+        # accounts of the owner are cached, they are listed with new ones after the import
+        self.assertEqual(len(self.client.get('/v1/owners/owner_1/accounts').json()), 1)
+        response = self.client.post(self.accounts_url, {'accounts': accounts}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'status': 'PROCESSED', 'results': [
+            {'status': 'CREATED'},
+            {'status': 'CREATED'},
+            {'status': 'ERROR', 'error': 'duplicate_account', 'account_ids': ['acc_1']},
+            {'status': 'ERROR', 'error': 'invalid_account', 'errors': {
+                'balance': ['Ensure this value is greater than or equal to 0.'],
+                'currency': ['"XXX" is not a valid choice.'],
+            }},
+            {'status': 'ERROR', 'error': 'duplicate_account', 'account_ids': ['acc_2']},
+        ]})
+        self.assertEqual(
+            list(Account.objects.values_list('pk', 'owner', 'balance', 'currency')),
+            [('acc_1', 'owner_1', 10, CURRENCY_PHP), ('acc_2', 'owner_1', Decimal('100.5'), CURRENCY_PHP),
+             ('acc_3', 'owner_2', 0, CURRENCY_USD)],
+        )
+        self.assertEqual(
+            [account['id'] for account in self.client.get('/v1/owners/owner_1/accounts').json()], ['acc_1', 'acc_2'],
+        )
+        self.assertEqual(
+            list(OwnerTotal.objects.values_list('owner', 'currency', 'balance', 'accounts')),
+            [('owner_1', 'PHP', Decimal('110.5'), 2), ('owner_2', 'USD', 0, 1)],
+        )
+
+        for data in ({}, {'accounts': []}, {'accounts': ['acc_5']}):
+            response = self.client.post(self.accounts_url, data, format='json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_csv(self):
+        out, err = self._import(
+            'accounts.csv',
+            'id,owner,balance,currency\n'
+            'acc_2,owner_1,5,PHP\n'
+            'acc_3,owner_2,abc,PHP\n'
+            'acc_1,owner_1,5,PHP\n'
+            'acc_4,owner_2,7.25,EUR\n',
+            '--batch-size', '2',
+        )
+        self.assertRegex(out, r'^Created 2 accounts, rejected 2 rows in [0-9.]+s, [0-9]+ rows/s\n$')
+        self.assertEqual(err, (
+            'Row 2 (acc_3): invalid_account {"balance": ["A valid number is required."]}\n'
+            'Row 3 (acc_1): duplicate_account\n'
+        ))
+        self.assertEqual(
+            dict(Account.objects.values_list('pk', 'balance')), {'acc_1': 10, 'acc_2': 5, 'acc_4': Decimal('7.25')},
+        )
+
+    def test_ndjson(self):
+        out, err = self._import(
+            'accounts.ndjson',
+            '{"id": "acc_2", "owner": "owner_1", "balance": "5", "currency": "PHP"}\n'
+            '\n'
+            '{"id": "acc_3", "owner": \n'
+            '["acc_4"]\n'
+            '{"id": "acc_4", "owner": "owner_2", "currency": "USD"}\n',
+        )
+        self.assertTrue(out.startswith('Created 2 accounts, rejected 2 rows in '))
+        self.assertEqual(err.splitlines(), [
+            'Row 2: invalid_account {"non_field_errors": ["Invalid JSON: Expecting value: line 2 column 1 (char 26)"]}',
+            'Row 3: invalid_account {"non_field_errors": ["Invalid data. Expected a dictionary, but got list."]}',
+        ])
+        self.assertEqual(list(Account.objects.values_list('pk', flat=True)), ['acc_1', 'acc_2', 'acc_4'])
+
+        with self.assertRaises(CommandError):
+            call_command('import_accounts', '/nonexistent/accounts.csv')
+
+    def test_batches(self):
+        rows = [
+            {'id': 'acc_{}'.format(i), 'owner': 'owner_{}'.format(i % 3), 'balance': '1', 'currency': CURRENCY_PHP}
+            for i in range(2, 12)
+        ]
+        # every batch is checked, inserted and counted in totals of owners with the same number of queries
+        with CaptureQueriesContext(connection) as queries:
+            results = list(provisioning.import_accounts(rows, batch_size=4))
+        self.assertEqual(results, [(4, []), (4, []), (2, [])])
+        self.assertEqual(Account.objects.count(), 11)
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_0').accounts, 3)
+        self.assertLess(len(queries), 40)
+
+
+class ConcurrentPaymentsTestCase(TransactionTestCase):
+    threads_count = 4
+    transfers_per_thread = 500
+
+    def setUp(self):
+        self.accounts = [
+            Account(id='hot_{}'.format(i), owner='owner', balance=1000, currency=CURRENCY_PHP) for i in range(4)
+        ]
+        Account.objects.bulk_create(self.accounts)
+
+    def _transfer_worker(self, seed, succeeded):
+        rnd = random.Random(seed)
+        try:
+            for _ in range(self.transfers_per_thread):
+                from_account, to_account = rnd.sample(self.accounts, 2)
+                # stale instances are used on purpose, pay must not trust their balances
+                from_account = Account(pk=from_account.pk, balance=0, currency=CURRENCY_PHP)
+                amount = Decimal(rnd.randint(1, 400))
+                while True:
+                    try:
+                        from_account.pay(to_account, amount, CURRENCY_PHP)
+                        succeeded.append(amount)
+                    except InsufficientBalance:
+                        pass
+                    except OperationalError:
+                        # sqlite does not lock rows, it rejects concurrent writers instead; retry with a backoff
+                        time.sleep(rnd.random() / 200)
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    def test_concurrent_transfers_conserve_balance(self):
+        succeeded = []
+        threads = [
+            threading.Thread(target=self._transfer_worker, args=(seed, succeeded))
+            for seed in range(self.threads_count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        balances = list(Account.objects.values_list('balance', flat=True))
+        self.assertEqual(sum(balances), Decimal(1000) * len(self.accounts))
+        self.assertTrue(all(balance >= 0 for balance in balances))
+        self.assertTrue(succeeded)
+        self.assertEqual(Payment.objects.count(), len(succeeded))
+
+
 class PaymentsTestCase(TestCase):
     payments_url = '/v1/payments'
 
@@ -120,7 +360,7 @@ class PaymentsTestCase(TestCase):
         Account.objects.bulk_create(self.accounts)
 
         self.accounts[1].pay(self.accounts[0], Decimal(50), CURRENCY_PHP)
-        self.payments = list(Payment.objects.all())
+        self.payments = _legs(Payment.objects.all())
 
         self.creation_data_json = {
             'from_account': self.accounts[1].pk,
@@ -148,6 +388,24 @@ class PaymentsTestCase(TestCase):
         response = self.client.post(self.payments_url, data=self.creation_data_json, format='json')
         self.assertEqual(response.status_code, 201)
 
+    def test_payments_api_rejections(self):
+        idempotency._responses.clear()
+        for data, expected in (
+            ({'amount': '150.0001'}, {'status': 'ERROR', 'error': 'insufficient_balance'}),
+            (
+                {'currency': CURRENCY_USD},
+                {'status': 'ERROR', 'error': 'invalid_account_currency', 'account_ids': ['acc_2', 'acc_1']},
+            ),
+        ):
+            for headers in ({}, {'HTTP_IDEMPOTENCY_KEY': 'key_1'}):
+                response = self.client.post(
+                    self.payments_url, data=dict(self.creation_data_json, **data), format='json', **headers
+                )
+                self.assertEqual(response.status_code, 422)
+                self.assertEqual(response.json(), expected)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
     def _check_result_item(self, item, orig_payment):
         self.assertEqual(
             list(sorted(item.keys())),
@@ -162,31 +420,103 @@ class PaymentsTestCase(TestCase):
     def test_payments_api_list(self):
         response = self.client.get(self.payments_url, format='json')
         self.assertEqual(response.status_code, 200)
-        result = response.json()
+        result = response.json()['results']
         self.assertEqual(len(result), 2)
         for item, orig_payment in zip(result, self.payments):
             self._check_result_item(item, orig_payment)
 
+    def test_payments_api_list_pagination(self):
+        self.accounts[1].pay(self.accounts[0], Decimal(1), CURRENCY_PHP)
+        self.accounts[1].pay(self.accounts[0], Decimal(2), CURRENCY_PHP)
+        payments = _legs(Payment.objects.all())
+        self.assertEqual(len(payments), 6)
+
+        # page size is a number of payments, every transfer is listed as a pair of them and is not split by pages
+        for page_size, page_lengths in ((3, [2, 2, 2]), (4, [4, 2]), (1, [2, 2, 2])):
+            response = self.client.get(self.payments_url, data={'page_size': page_size}, format='json')
+            pages = [response.json()]
+            while pages[-1]['next'] is not None:
+                pages.append(self.client.get(pages[-1]['next'], format='json').json())
+            self.assertEqual([len(page['results']) for page in pages], page_lengths)
+            for item, orig_payment in zip([item for page in pages for item in page['results']], payments):
+                self._check_result_item(item, orig_payment)
+
+            # previous pages are filled from their ends
+            previous = self.client.get(pages[-1]['previous'], format='json').json()
+            self.assertEqual(previous['results'], pages[-2]['results'])
+
+        # legs of a page are built once, for all of its transfers
+        get_legs = views.PaymentsList.get_legs
+        with mock.patch.object(views.PaymentsList, 'get_legs', autospec=True, side_effect=get_legs) as mocked:
+            self.client.get(self.payments_url, data={'page_size': 4, 'direction': PAYMENT_DIRECTIONS_INCOMING})
+        self.assertEqual(mocked.call_count, 1)
+
+    def test_payments_api_list_filters(self):
+        self.accounts[0].pay(self.accounts[1], Decimal(1), CURRENCY_PHP)
+        payments = _legs(Payment.objects.all())
+        transfers = list(Payment.objects.all())
+
+        def _get_ids(**params):
+            response = self.client.get(self.payments_url, data=params, format='json')
+            self.assertEqual(response.status_code, 200)
+            # payments are identified by all their fields, because api does not expose their ids
+            return [
+                (item['to_account'], item['from_account'], item['direction'], Decimal(item['amount']))
+                for item in response.json()['results']
+            ]
+
+        def _expected_ids(payments_list):
+            return [(p.to_account_id, p.from_account_id, p.direction, p.amount) for p in payments_list]
+
+        self.assertEqual(
+            _get_ids(to_account=self.accounts[0].pk),
+            _expected_ids([p for p in payments if p.to_account_id == self.accounts[0].pk])
+        )
+        self.assertEqual(
+            _get_ids(from_account=self.accounts[0].pk, direction=PAYMENT_DIRECTIONS_OUTGOING),
+            _expected_ids(payments[1:2])
+        )
+        self.assertEqual(_get_ids(currency=CURRENCY_USD), [])
+        self.assertEqual(_get_ids(currency=CURRENCY_PHP), _expected_ids(payments))
+        self.assertEqual(
+            _get_ids(to_account=self.accounts[1].pk, direction=PAYMENT_DIRECTIONS_INCOMING),
+            _expected_ids(payments[2:3])
+        )
+        self.assertEqual(
+            _get_ids(to_account=self.accounts[1].pk, from_account=self.accounts[0].pk),
+            _expected_ids([payments[1], payments[2]])
+        )
+        self.assertEqual(_get_ids(direction=PAYMENT_DIRECTIONS_INCOMING), _expected_ids(payments[0::2]))
+        self.assertEqual(_get_ids(min_id=transfers[0].pk, max_id=transfers[0].pk), _expected_ids(payments[0:2]))
+        self.assertEqual(_get_ids(max_id=transfers[1].pk), _expected_ids(payments[2:4]))
+
+        # a transfer to the same account is found by queries of both legs, and is listed once
+        self.accounts[0].pay(self.accounts[0], Decimal(3), CURRENCY_PHP)
+        self_payments = _legs(Payment.objects.filter(amount=3))
+        self.assertEqual(_get_ids(to_account=self.accounts[0].pk, page_size=2), _expected_ids(self_payments))
+        self.assertEqual(
+            _get_ids(to_account=self.accounts[0].pk),
+            _expected_ids(self_payments + [p for p in payments if p.to_account_id == self.accounts[0].pk]),
+        )
+
+        response = self.client.get(self.payments_url, data={'min_id': 'abc'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
     def test_payment_creation_api(self):
         response = self.client.post(self.payments_url, data=self.creation_data_json, format='json')
         result = response.json()
         self.assertEqual(result, {'status': 'CREATED'})
 
-        # 2 payments were created at setUp
-        self.assertEqual(Payment.objects.count(), 4)
+        # 1 transfer was made at setUp
+        self.assertEqual(Payment.objects.count(), 2)
 
-        outgoing_payment = Payment.objects.filter(
-            from_account__pk=self.creation_data_json['from_account'],
-        ).first()  # default ordering is desc
+        incoming_payment, outgoing_payment = Payment.objects.first().legs()  # default ordering is desc
         self.assertEqual(outgoing_payment.to_account_id, self.creation_data_json['to_account'])
         self.assertEqual(outgoing_payment.from_account_id, self.creation_data_json['from_account'])
         self.assertEqual(outgoing_payment.direction, PAYMENT_DIRECTIONS_OUTGOING)
         self.assertEqual(outgoing_payment.amount, Decimal(self.creation_data_json['amount']))
         self.assertEqual(outgoing_payment.currency, self.creation_data_json['currency'])
 
-        incoming_payment = Payment.objects.filter(
-            from_account__pk=self.creation_data_json['to_account'],
-        ).first()  # default ordering is desc
         self.assertEqual(incoming_payment.to_account_id, self.creation_data_json['from_account'])
         self.assertEqual(incoming_payment.from_account_id, self.creation_data_json['to_account'])
         self.assertEqual(incoming_payment.direction, PAYMENT_DIRECTIONS_INCOMING)
@@ -195,3 +525,2101 @@ class PaymentsTestCase(TestCase):
 
         self.assertEqual(outgoing_payment.to_account.balance, Decimal('51.5005'))
         self.assertEqual(outgoing_payment.from_account.balance, Decimal('148.4995'))
+
+
+class PaymentsDryRunTestCase(TestCase):
+    url = '/v1/payments/dry-run'
+
+    def setUp(self):
+        self.client = APIClient()
+        Account.clear_cached()
+        FxRate.reload()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=100, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=0, currency=CURRENCY_PHP),
+            Account(id='acc_3', owner='owner_3', balance=0, currency=CURRENCY_USD),
+        ))
+
+    def _post(self, from_account, to_account, amount, currency=CURRENCY_PHP, **data):
+        data.update(from_account=from_account, to_account=to_account, amount=amount, currency=currency)
+        return self.client.post(self.url, data, format='json')
+
+    def test_dry_run(self):
+        response = self._post('acc_1', 'acc_2', '100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'VALID'})
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, 100)
+
+        for (from_account, to_account, amount, currency, data), expected in (
+            (('acc_1', 'acc_2', '100.0001', CURRENCY_PHP, {}), {'status': 'ERROR', 'error': 'insufficient_balance'}),
+            (('acc_1', 'acc_2', '-1', CURRENCY_PHP, {}), {'status': 'ERROR', 'error': 'invalid_amount'}),
+            (
+                ('acc_1', 'acc_3', '1', CURRENCY_PHP, {}),
+                {'status': 'ERROR', 'error': 'invalid_account_currency', 'account_ids': ['acc_3']},
+            ),
+            (
+                ('acc_1', 'acc_3', '1', CURRENCY_PHP, {'to_currency': CURRENCY_USD}),
+                {'status': 'ERROR', 'error': 'unknown_fx_rate'},
+            ),
+        ):
+            response = self._post(from_account, to_account, amount, currency, **data)
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(response.json(), expected)
+
+        response = self._post('acc_1', 'acc_404', '1')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('to_account', response.json())
+
+    def test_matches_payments(self):
+        # the dry run answers every body as the payment answers it
+        for from_account, to_account, amount, currency, data in (
+            ('acc_1', 'acc_2', '100.0001', CURRENCY_PHP, {}),
+            ('acc_1', 'acc_2', '-1', CURRENCY_PHP, {}),
+            ('acc_1', 'acc_3', '1', CURRENCY_PHP, {}),
+            ('acc_1', 'acc_3', '1', CURRENCY_PHP, {'to_currency': CURRENCY_USD}),
+            ('acc_1', 'acc_404', '1', CURRENCY_PHP, {}),
+            ('acc_1', 'acc_2', '1', 'XXX', {}),
+        ):
+            dry_run = self._post(from_account, to_account, amount, currency, **data)
+            data.update(from_account=from_account, to_account=to_account, amount=amount, currency=currency)
+            response = self.client.post('/v1/payments', data, format='json')
+            self.assertEqual(response.status_code, dry_run.status_code, msg=data)
+            self.assertEqual(response.json(), dry_run.json(), msg=data)
+        self.assertFalse(Payment.objects.exists())
+
+        self.assertEqual(self._post('acc_1', 'acc_2', '100').json(), {'status': 'VALID'})
+        response = self.client.post('/v1/payments', {
+            'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '100', 'currency': CURRENCY_PHP,
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_pending_credits(self):
+        Account.objects.get(pk='acc_2').set_buckets(2)
+        Account.objects.get(pk='acc_1').pay(Account.objects.get(pk='acc_2'), Decimal(60), CURRENCY_PHP)
+        self.assertEqual(self._post('acc_2', 'acc_1', '60').status_code, 200)
+        self.assertEqual(self._post('acc_2', 'acc_1', '61').status_code, 422)
+
+    def test_cached_accounts(self):
+        self._post('acc_1', 'acc_2', '1')
+        # accounts are validated with their cached currencies, only their existence and the balance are read
+        with self.assertNumQueries(2):
+            self.assertEqual(self._post('acc_1', 'acc_2', '1').status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._post('acc_2', 'acc_1', '1', CURRENCY_USD).status_code, 422)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(Account.cached('acc_2'))
+
+        # payments are made with cached accounts too
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/v1/payments', {
+                'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '1', 'currency': CURRENCY_PHP,
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse([query for query in queries if 'SELECT "core_account"."currency"' in query['sql']])
+        self.assertEqual(Account.objects.get(pk='acc_2').balance, 1)
+
+        # accounts deleted by other processes, that send no signals here, are still cached, but do not exist
+        self._post('acc_1', 'acc_3', '1', to_currency=CURRENCY_USD)
+        Account.objects.filter(pk='acc_3')._raw_delete(connection.alias)
+        self.assertIsNotNone(Account.cached('acc_3'))
+        response = self._post('acc_1', 'acc_3', '1', to_currency=CURRENCY_USD)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'to_account': ['Invalid pk "acc_3" - object does not exist.']})
+        Account.objects.create(id='acc_3', owner='owner_3', balance=0, currency=CURRENCY_USD)
+
+        # changes of accounts in this process remove them from the cache
+        Account.objects.get(pk='acc_3').delete()
+        self.assertIsNone(Account.cached('acc_3'))
+        Account.clear_cached()
+        with override_settings(ACCOUNT_CACHE_TTL=0), self.assertNumQueries(2):
+            Account.cached('acc_1')
+            Account.cached('acc_1')
+
+
+class PaymentsBatchTestCase(TestCase):
+    batch_url = '/v1/payments/batch'
+
+    def setUp(self):
+        self.client = APIClient()
+
+        self.accounts = (
+            Account(id='acc_1', owner='owner_1', balance=0, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=200, currency=CURRENCY_PHP),
+            Account(id='acc_3', owner='owner_2', balance=100, currency=CURRENCY_USD),
+        )
+        Account.objects.bulk_create(self.accounts)
+
+    def _transfer(self, from_account, to_account, amount, currency=CURRENCY_PHP):
+        return {'from_account': from_account, 'to_account': to_account, 'amount': amount, 'currency': currency}
+
+    def _balances(self):
+        return dict(Account.objects.values_list('pk', 'balance'))
+
+    def test_batch_creation_api(self):
+        transfers = [
+            self._transfer('acc_2', 'acc_1', '150'),
+            # acc_1 is able to pay only with money received from the previous transfer
+            self._transfer('acc_1', 'acc_2', '100.5'),
+            self._transfer('acc_2', 'acc_1', '0.0001'),
+        ]
+        response = self.client.post(self.batch_url, data={'transfers': transfers}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'status': 'PROCESSED', 'results': [{'status': 'CREATED'}] * 3})
+
+        self.assertEqual(
+            self._balances(),
+            {'acc_1': Decimal('49.5001'), 'acc_2': Decimal('150.4999'), 'acc_3': Decimal(100)}
+        )
+        self.assertEqual(Payment.objects.count(), 3)
+        outgoing_payment = Payment.objects.order_by('pk').first()
+        self.assertEqual(outgoing_payment.from_account_id, 'acc_2')
+        self.assertEqual(outgoing_payment.to_account_id, 'acc_1')
+        self.assertEqual(outgoing_payment.amount, Decimal(150))
+
+    def test_batch_all_or_nothing(self):
+        transfers = [
+            self._transfer('acc_2', 'acc_1', '10'),
+            self._transfer('acc_2', 'acc_3', '10'),
+            self._transfer('acc_1', 'acc_2', '-1'),
+            self._transfer('acc_1', 'acc_2', '1000'),
+            self._transfer('acc_2', 'acc_404', '1'),
+        ]
+        response = self.client.post(self.batch_url, data={'transfers': transfers}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {
+            'status': 'REJECTED',
+            'results': [
+                {'status': 'NOT_CREATED'},
+                {'status': 'ERROR', 'error': 'invalid_account_currency', 'account_ids': ['acc_3']},
+                {'status': 'ERROR', 'error': 'invalid_amount'},
+                {'status': 'ERROR', 'error': 'insufficient_balance'},
+                {'status': 'ERROR', 'error': 'unknown_account', 'account_ids': ['acc_404']},
+            ]
+        })
+        self.assertEqual(self._balances(), {'acc_1': Decimal(0), 'acc_2': Decimal(200), 'acc_3': Decimal(100)})
+        self.assertEqual(Payment.objects.count(), 0)
+
+    def test_batch_per_item(self):
+        transfers = [
+            self._transfer('acc_2', 'acc_1', '10'),
+            self._transfer('acc_1', 'acc_2', '20'),
+            self._transfer('acc_1', 'acc_2', '5'),
+        ]
+        response = self.client.post(
+            self.batch_url, data={'mode': 'per_item', 'transfers': transfers}, format='json'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['results'], [
+            {'status': 'CREATED'}, {'status': 'ERROR', 'error': 'insufficient_balance'}, {'status': 'CREATED'},
+        ])
+        self.assertEqual(self._balances(), {'acc_1': Decimal(5), 'acc_2': Decimal(195), 'acc_3': Decimal(100)})
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_batch_queries(self):
+        transfers = [('acc_2', 'acc_1', Decimal(1), CURRENCY_PHP) for _ in range(50)]
+        # counters are created by the first changes of their slots, totals of owners of bulk created accounts
+        # are computed by the first payments
+        ChangeCounter.bump(['acc_1', 'acc_2'])
+        OwnerTotal.refresh()
+        # savepoint, accounts select, balances update, payments insert, opening balance snapshots insert,
+        # owner totals select and update, owner volumes select, insert of the first ones of the day and update,
+        # change counters update, savepoint release
+        with self.assertNumQueries(12):
+            errors = Account.pay_batch(transfers)
+        self.assertEqual(errors, [None] * 50)
+        self.assertEqual(self._balances(), {'acc_1': Decimal(50), 'acc_2': Decimal(150), 'acc_3': Decimal(100)})
+
+    def test_batch_validation(self):
+        response = self.client.post(self.batch_url, data={'transfers': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(
+            self.batch_url, data={'mode': 'unknown', 'transfers': [self._transfer('acc_2', 'acc_1', '1')]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked for sqlite only')
+class ListQueryPlansTestCase(TestCase):
+    """
+    Every combination of list filters has to be served by an index search, ordered by the index as well
+    """
+    def _get_plan(self, filter_backend, queryset, params):
+        request = Request(APIRequestFactory().get('/', params))
+        queryset = filter_backend().filter_queryset(request, queryset, None)
+        # every one of merged queries is run on its own
+        querysets = queryset.querysets if isinstance(queryset, MergedQuery) else [queryset]
+        return '\n'.join(queryset[:100].explain() for queryset in querysets)
+
+    def _check_plans(self, filter_backend, queryset, values):
+        for size in range(1, len(values) + 1):
+            for params in itertools.combinations(values, size):
+                if params == ('direction',):
+                    # direction alone does not filter transfers, only their legs
+                    continue
+                plan = self._get_plan(filter_backend, queryset, {param: values[param] for param in params})
+                self.assertRegex(plan, r'SEARCH \w+ USING (INDEX|INTEGER PRIMARY KEY)', msg=params)
+                self.assertNotIn('SCAN', plan, msg=params)
+                self.assertNotIn('TEMP B-TREE', plan, msg=params)
+
+    def test_payments_plans(self):
+        self._check_plans(PaymentsFilter, Payment.objects.all(), {
+            'to_account': 'acc_1', 'from_account': 'acc_2', 'direction': PAYMENT_DIRECTIONS_INCOMING,
+            'currency': CURRENCY_PHP, 'min_id': '1', 'max_id': '100',
+        })
+
+    def test_accounts_plans(self):
+        self._check_plans(AccountsFilter, Account.objects.all(), {'owner': 'owner_1', 'currency': CURRENCY_PHP})
+
+
+class IdempotencyTestCase(TestCase):
+    payments_url = '/v1/payments'
+
+    def setUp(self):
+        self.client = APIClient()
+        idempotency._responses.clear()
+
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=0, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=200, currency=CURRENCY_PHP),
+        ))
+        self.creation_data_json = {
+            'from_account': 'acc_2',
+            'to_account': 'acc_1',
+            'amount': '10',
+            'currency': CURRENCY_PHP,
+        }
+
+    def _post(self, key):
+        return self.client.post(
+            self.payments_url, data=self.creation_data_json, format='json', HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_replayed_payment(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self._post('key_1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'status': 'CREATED'})
+        self.assertNotIn('Idempotent-Replayed', response)
+
+        # replay is answered from memory
+        with self.assertNumQueries(0):
+            response = self._post('key_1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'status': 'CREATED'})
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+
+        # and from the database by other processes
+        idempotency._responses.clear()
+        response = self._post('key_1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, Decimal(10))
+
+        response = self._post('key_2')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_concurrently_used_key(self):
+        response = self._post('key_1')
+        self.assertEqual(response.status_code, 201)
+
+        # a request, that has not seen the key yet, is rolled back when saving it
+        with mock.patch.object(idempotency, 'get_response', side_effect=[None, (201, {'status': 'CREATED'})]):
+            response = self._post('key_1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, Decimal(10))
+
+    def test_reused_key(self):
+        self.assertEqual(self._post('key_1').status_code, 201)
+        # the same body in another order of fields is the same request
+        response = self.client.post(
+            self.payments_url, data=dict(reversed(list(self.creation_data_json.items()))), format='json',
+            HTTP_IDEMPOTENCY_KEY='key_1',
+        )
+        self.assertEqual((response.status_code, response['Idempotent-Replayed']), (201, 'true'))
+
+        self.creation_data_json['amount'] = '20'
+        for cached in (True, False):
+            if not cached:
+                idempotency._responses.clear()
+            response = self._post('key_1')
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(response.json(), {'status': 'ERROR', 'error': 'idempotency_key_reused'})
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, Decimal(10))
+
+    def test_cached_responses_expire(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post('key_1')
+        with self.assertNumQueries(0):
+            self.assertEqual(self._post('key_1')['Idempotent-Replayed'], 'true')
+
+        # the key is purged from the database, and its response from the cache, once it expires
+        IdempotencyKey.objects.filter(key='key_1').update(created_at=timezone.now() - timedelta(days=2))
+        call_command('purge_idempotency_keys', stdout=StringIO())
+        with override_settings(IDEMPOTENCY_KEY_TTL=0):
+            response = self._post('key_1')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_purge_idempotency_keys(self):
+        self._post('key_1')
+        self._post('key_2')
+        IdempotencyKey.objects.filter(key='key_1').update(created_at=timezone.now() - timedelta(days=2))
+
+        call_command('purge_idempotency_keys', batch_size=1, stdout=StringIO())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['key_2'])
+
+
+class BalanceCacheTestCase(TestCase):
+    accounts_url = '/v1/accounts'
+
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+
+        self.accounts = (
+            Account(id='acc_1', owner='owner_1', balance=0, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_1', balance=100, currency=CURRENCY_PHP),
+            Account(id='acc_3', owner='owner_2', balance=200, currency=CURRENCY_PHP),
+        )
+        Account.objects.bulk_create(self.accounts)
+
+    def _get_balances(self, url):
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        if isinstance(result, dict):
+            result = result.get('results', [result])
+        return {item['id']: Decimal(item['balance']) for item in result}
+
+    def test_cached_reads(self):
+        expected = {'acc_1': Decimal(0), 'acc_2': Decimal(100), 'acc_3': Decimal(200)}
+        self.assertEqual(self._get_balances(self.accounts_url), expected)
+        # accounts are served from the cache, only their ids and change counters, that version entries
+        # of the cache, are queried
+        with self.assertNumQueries(2):
+            self.assertEqual(self._get_balances(self.accounts_url), expected)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get_balances(self.accounts_url + '/acc_2'), {'acc_2': Decimal(100)})
+
+        self.assertEqual(
+            self._get_balances('/v1/owners/owner_1/accounts'), {'acc_1': Decimal(0), 'acc_2': Decimal(100)}
+        )
+        # counters of the owner list and of its accounts
+        with self.assertNumQueries(2):
+            self._get_balances('/v1/owners/owner_1/accounts')
+        self.assertEqual(self._get_balances('/v1/owners/owner_3/accounts'), {})
+
+        response = self.client.get(self.accounts_url + '/acc_404', format='json')
+        self.assertEqual(response.status_code, 404)
+
+        stats = self.client.get('/v1/stats/balance-cache', format='json').json()
+        self.assertEqual(stats['hits'], 9)
+        self.assertEqual(stats['misses'], 6)
+        self.assertEqual(stats['evictions'], 0)
+
+    def test_invalidation_after_payment(self):
+        self.assertEqual(self._get_balances(self.accounts_url + '/acc_1'), {'acc_1': Decimal(0)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.accounts[2].pay(self.accounts[0], Decimal(10), CURRENCY_PHP)
+        # entries of changed accounts are deleted after the commit
+        self.assertEqual(len(balances._cache), 0)
+        self.assertEqual(
+            self._get_balances(self.accounts_url), {'acc_1': Decimal(10), 'acc_2': Decimal(100), 'acc_3': Decimal(190)}
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Account.pay_batch([('acc_2', 'acc_1', Decimal(5), CURRENCY_PHP)])
+        self.assertEqual(
+            self._get_balances(self.accounts_url), {'acc_1': Decimal(15), 'acc_2': Decimal(95), 'acc_3': Decimal(190)}
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Account.objects.create(id='acc_4', owner='owner_1', balance=1, currency=CURRENCY_PHP)
+        self.assertEqual(
+            self._get_balances('/v1/owners/owner_1/accounts'),
+            {'acc_1': Decimal(15), 'acc_2': Decimal(95), 'acc_4': Decimal(1)}
+        )
+
+    def test_writes_of_other_processes(self):
+        self.assertEqual(self._get_balances(self.accounts_url + '/acc_1'), {'acc_1': Decimal(0)})
+        self.assertEqual(self._get_balances('/v1/owners/owner_2/accounts'), {'acc_3': Decimal(200)})
+        # writes of other processes do not send signals to this one, and their commit callbacks are not run here
+        with mock.patch.object(balances_changed, 'send'):
+            self.accounts[2].pay(self.accounts[0], Decimal(10), CURRENCY_PHP)
+            Account.objects.create(id='acc_4', owner='owner_2', balance=0, currency=CURRENCY_PHP)
+        self.assertEqual(self._get_balances(self.accounts_url + '/acc_1'), {'acc_1': Decimal(10)})
+        self.assertEqual(
+            self._get_balances('/v1/owners/owner_2/accounts'), {'acc_3': Decimal(190), 'acc_4': Decimal(0)}
+        )
+
+    def test_value_read_before_change(self):
+        versions = balances._read_versions([(DEFAULT_DB_ALIAS, 'acc_1')])
+        stale_data = dict(balances.get_accounts(['acc_1'])[0], balance='-1.0000')
+        Account.objects.get(pk='acc_3').pay(Account.objects.get(pk='acc_1'), Decimal(10), CURRENCY_PHP)
+        # the value read from the database before the change is cached after it
+        stamp = balances._stamp(versions, [(DEFAULT_DB_ALIAS, 'acc_1')])
+        balances._cache.set(balances._account_key('acc_1'), (stamp, stale_data))
+        self.assertEqual(balances.get_accounts(['acc_1'])[0]['balance'], '10.0000')
+
+    def test_lru_eviction(self):
+        cache = LRUCache(max_size=2)
+        with mock.patch.object(balances, '_cache', cache):
+            balances.get_accounts(['acc_1', 'acc_2', 'acc_3'])
+            self.assertEqual(cache.stats()['size'], 2)
+            self.assertEqual(balances.stats()['evictions'], 1)
+
+    def test_django_cache_backend(self):
+        with mock.patch.object(balances, '_cache', DjangoCache(key_prefix='balances:')):
+            balances.clear()
+            self.assertEqual(self._get_balances(self.accounts_url + '/acc_3'), {'acc_3': Decimal(200)})
+            with self.assertNumQueries(1):
+                self.assertEqual(self._get_balances(self.accounts_url + '/acc_3'), {'acc_3': Decimal(200)})
+            Account.objects.get(pk='acc_3').pay(Account.objects.get(pk='acc_1'), Decimal(10), CURRENCY_PHP)
+            with self.assertNumQueries(2):
+                self.assertEqual(self._get_balances(self.accounts_url + '/acc_3'), {'acc_3': Decimal(190)})
+
+
+class FastSerializersTestCase(TestCase):
+    amounts = ('0', '1', '1.5', '0.0001', '123456789.1234', '-5.5')
+
+    def setUp(self):
+        Account.objects.bulk_create([
+            Account(id='acc_{}'.format(i), owner='owner_{}'.format(i % 2), balance=Decimal(amount), currency=currency)
+            for i, (amount, currency) in enumerate(itertools.product(self.amounts, (CURRENCY_PHP, CURRENCY_USD)))
+        ])
+        Payment.objects.bulk_create([
+            Payment(
+                to_account_id='acc_{}'.format(i), from_account_id='acc_{}'.format(i + 1),
+                amount=Decimal(amount), currency=CURRENCY_PHP,
+            )
+            for i, amount in enumerate(self.amounts)
+        ])
+
+    def test_accounts_representation(self):
+        queryset = Account.objects.all()
+        self.assertEqual(
+            JSONRenderer().render(AccountSerializer.fast_representation(
+                queryset.values_list(*AccountSerializer.fast_columns)
+            )),
+            JSONRenderer().render(AccountSerializer(queryset, many=True).data),
+        )
+
+    def test_payments_representation(self):
+        queryset = Payment.objects.all()
+        self.assertEqual(
+            JSONRenderer().render(PaymentSerializer.fast_legs(queryset.values_list(*PaymentSerializer.fast_columns))),
+            JSONRenderer().render(PaymentSerializer(_legs(queryset), many=True).data),
+        )
+
+    def test_no_serializers_built(self):
+        AccountSerializer.fast_representation([])
+        PaymentSerializer.fast_legs([])
+        rows = list(Payment.objects.values_list(*PaymentSerializer.fast_columns))
+        # formatters of fields are built once, not with a serializer per call
+        with mock.patch.object(PaymentSerializer, 'get_fields') as get_fields:
+            for row in rows:
+                PaymentSerializer.fast_legs([row])
+        get_fields.assert_not_called()
+
+
+class ColumnsRendererTestCase(TestCase):
+    def setUp(self):
+        balances.clear()
+        Account.objects.bulk_create([
+            Account(
+                id='acc_{}'.format(i), owner='owner_{}'.format(i % 2), balance=Decimal(amount), currency=CURRENCY_PHP,
+            )
+            for i, amount in enumerate(('100', '-5.5', '0.0001', '123456789.1234'))
+        ])
+        for from_id, to_id, amount in (('acc_0', 'acc_1', '10'), ('acc_3', 'acc_2', '0.25'), ('acc_0', 'acc_3', '1')):
+            Account.objects.get(pk=from_id).pay(Account.objects.get(pk=to_id), Decimal(amount), CURRENCY_PHP)
+        self.client = APIClient()
+
+    @staticmethod
+    def _json_data(data):
+        # decimal values of decoded documents are Decimal, and JSON has them as strings
+        return json.loads(json.dumps(data, default=str))
+
+    def test_lists(self):
+        for path in ('/v1/accounts', '/v1/payments?page_size=4', '/v1/payments?from_account=acc_0'):
+            expected = self.client.get(path).json()
+            response = self.client.get(path, HTTP_ACCEPT=renderers.MEDIA_TYPE)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], renderers.MEDIA_TYPE)
+            self.assertEqual(self._json_data(renderers.decode(response.content)), expected)
+
+            # links of pages keep the format
+            response = self.client.get(path + ('&' if '?' in path else '?') + 'format=columns')
+            self.assertEqual(response['Content-Type'], renderers.MEDIA_TYPE)
+            self.assertEqual(self._json_data(renderers.decode(response.content)['results']), expected['results'])
+
+        response = self.client.get('/v1/payments?page_size=4', HTTP_ACCEPT=renderers.MEDIA_TYPE)
+        links, values, scales = renderers.read_table(response.content)
+        self.assertIsNotNone(links[0])
+        self.assertIsNone(links[1])
+        self.assertEqual(scales, {'amount': 4})
+        self.assertEqual(values['amount'], [10000, 10000, 2500, 2500])
+        self.assertEqual(values['direction'], [
+            PAYMENT_DIRECTIONS_INCOMING, PAYMENT_DIRECTIONS_OUTGOING, PAYMENT_DIRECTIONS_INCOMING,
+            PAYMENT_DIRECTIONS_OUTGOING,
+        ])
+        self.assertLess(len(response.content), len(self.client.get('/v1/payments?page_size=4').content))
+
+    def test_errors(self):
+        response = self.client.get('/v1/accounts?cursor=invalid', HTTP_ACCEPT=renderers.MEDIA_TYPE)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(renderers.decode(response.content), {'detail': 'Invalid cursor'})
+        with self.assertRaises(ValueError):
+            renderers.read_table(response.content)
+        with self.assertRaises(ValueError):
+            renderers.decode(b'{"detail": "Invalid cursor"}')
+
+    def test_encode(self):
+        table_columns = [
+            ('id', renderers.TYPE_INTEGER, 0), ('name', renderers.TYPE_STRING, 0),
+            ('amount', renderers.TYPE_DECIMAL, 2),
+        ]
+        rows = [
+            {'id': 1, 'name': 'a', 'amount': '-0.50'},
+            {'id': -2, 'name': None, 'amount': Decimal('1.5')},
+            {'id': 3, 'name': 'a', 'amount': '7'},
+            {'id': 2 ** 40, 'name': '\u20b1', 'amount': '99999999.99'},
+        ]
+        content = renderers.encode(rows, table_columns)
+        self.assertEqual(renderers.decode(content), [
+            {'id': 1, 'name': 'a', 'amount': Decimal('-0.50')},
+            {'id': -2, 'name': None, 'amount': Decimal('1.50')},
+            {'id': 3, 'name': 'a', 'amount': Decimal('7.00')},
+            {'id': 2 ** 40, 'name': '\u20b1', 'amount': Decimal('99999999.99')},
+        ])
+        self.assertEqual(renderers.read_table(content)[1]['amount'], [-50, 150, 700, 9999999999])
+        self.assertEqual(renderers.decode(renderers.encode([], table_columns, (None, None))), {
+            'next': None, 'previous': None, 'results': [],
+        })
+        with self.assertRaises(ValueError):
+            renderers.decode(content[:-1])
+
+    def test_values_out_of_range(self):
+        # balances, that fit max_digits, may not fit i64, when they are scaled by 10 ** decimal_places
+        Account.objects.create(id='acc_max', owner='owner_0', balance=Decimal('1E15'), currency='PHP')
+        response = self.client.get('/v1/accounts', HTTP_ACCEPT=renderers.MEDIA_TYPE)
+        self.assertEqual(response.status_code, 200)
+        _, values, scales = renderers.read_table(response.content)
+        self.assertNotIn('balance', scales)
+        self.assertIn('1000000000000000.0000', values['balance'])
+        self.assertEqual(renderers.decode(response.content), self.client.get('/v1/accounts').json())
+
+        content = renderers.encode([{'id': 2 ** 63}, {'id': 1}], [('id', renderers.TYPE_INTEGER, 0)])
+        self.assertEqual(renderers.decode(content), [{'id': str(2 ** 63)}, {'id': '1'}])
+
+
+class PaymentsExportTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=0, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=200, currency=CURRENCY_PHP),
+        ))
+        for amount in ('1', '2.5', '3'):
+            Account.objects.get(pk='acc_2').pay(Account.objects.get(pk='acc_1'), Decimal(amount), CURRENCY_PHP)
+        self.expected = [
+            {'id': payment.pk, 'from_account': 'acc_2', 'to_account': 'acc_1', 'amount': amount, 'currency': 'PHP'}
+            for payment, amount in zip(Payment.objects.order_by('pk'), ('1.0000', '2.5000', '3.0000'))
+        ]
+
+    def _get(self, url, **params):
+        response = self.client.get(url, data=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_ndjson_export(self):
+        response, content = self._get('/v1/payments/export.ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in content.splitlines()], self.expected)
+
+        _, content = self._get('/v1/payments/export.ndjson', after=self.expected[0]['id'])
+        self.assertEqual([json.loads(line) for line in content.splitlines()], self.expected[1:])
+
+        _, content = self._get('/v1/payments/export.ndjson', after=self.expected[-1]['id'])
+        self.assertEqual(content, '')
+
+    def test_json_export(self):
+        response, content = self._get('/v1/payments/export.json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(content), self.expected)
+
+        _, content = self._get('/v1/payments/export.json', after=self.expected[-1]['id'])
+        self.assertEqual(json.loads(content), [])
+
+        response = self.client.get('/v1/payments/export.json', data={'after': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_chunks(self):
+        for chunk_size in (1, 2, 3, 4):
+            content = ''.join(export.export_payments(export.FORMAT_JSON, chunk_size=chunk_size))
+            self.assertEqual(json.loads(content), self.expected)
+            content = ''.join(export.export_payments(export.FORMAT_NDJSON, chunk_size=chunk_size))
+            self.assertEqual([json.loads(line) for line in content.splitlines()], self.expected)
+
+    def test_export_command(self):
+        stdout = StringIO()
+        call_command('export_payments', after=self.expected[0]['id'], stdout=stdout)
+        self.assertEqual([json.loads(line) for line in stdout.getvalue().splitlines()], self.expected[1:])
+
+        with tempfile.NamedTemporaryFile('r') as output:
+            call_command('export_payments', export_format='json', chunk_size=2, output=output.name)
+            self.assertEqual(json.load(output), self.expected)
+
+
+class PaymentsFeedTestCase(TransactionTestCase):
+    def setUp(self):
+        self.client = APIClient()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=100, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=0, currency=CURRENCY_PHP),
+        ))
+        for amount in ('1', '2.5', '3'):
+            Account.objects.get(pk='acc_1').pay(Account.objects.get(pk='acc_2'), Decimal(amount), CURRENCY_PHP)
+        self.ids = list(Payment.objects.order_by('pk').values_list('pk', flat=True))
+
+    @staticmethod
+    def _pay(from_id, to_id, amount):
+        while True:
+            try:
+                return Account.objects.get(pk=from_id).pay(Account.objects.get(pk=to_id), amount, CURRENCY_PHP)
+            except OperationalError:
+                # tables of the in-memory test database are locked, while the feed reads them in another thread
+                time.sleep(0.01)
+
+    def _get(self, **params):
+        response = self.client.get('/v1/payments/feed', data=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    @staticmethod
+    def _position(payment_id):
+        return Payment.objects.values_list('feed_sequence', flat=True).get(pk=payment_id)
+
+    def test_batches(self):
+        data = self._get(limit=2)
+        self.assertEqual([payment['id'] for payment in data['payments']], self.ids[:2])
+        self.assertEqual(data['payments'][1], {
+            'id': self.ids[1], 'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '2.5000', 'currency': 'PHP',
+        })
+        # cursors are positions of transfers in the feed, that are given after their commits
+        self.assertEqual(data['next'], self._position(self.ids[1]))
+
+        data = self._get(since=data['next'], limit=2)
+        self.assertEqual([payment['id'] for payment in data['payments']], self.ids[2:])
+        self.assertEqual(self._get(since=data['next']), {'payments': [], 'next': self._position(self.ids[2])})
+
+        for params in ({'since': 'abc'}, {'since': -1}, {'limit': 0}, {'limit': 1001}, {'wait': -1}):
+            response = self.client.get('/v1/payments/feed', data=params)
+            self.assertEqual(response.status_code, 400, msg=params)
+
+    def test_wait(self):
+        since = self._get()['next']
+        started = time.monotonic()
+        self.assertEqual(self._get(since=since, wait=0.2)['payments'], [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+        results = []
+
+        def read():
+            try:
+                results.append(self._get(since=since, wait=10))
+            finally:
+                connection.close()
+
+        reader = threading.Thread(target=read)
+        started = time.monotonic()
+        reader.start()
+        time.sleep(0.1)
+        self._pay('acc_2', 'acc_1', Decimal(1))
+        reader.join()
+        # the read is woken up by the commit, it does not wait for the check of the database
+        self.assertLess(time.monotonic() - started, settings.PAYMENT_FEED_CHECK_INTERVAL)
+        payment = Payment.objects.order_by('pk').last()
+        self.assertEqual(results, [{
+            'payments': [{'id': payment.pk, 'from_account': 'acc_2', 'to_account': 'acc_1', 'amount': '1.0000',
+                          'currency': 'PHP'}],
+            'next': payment.feed_sequence,
+        }])
+
+    def test_check_interval(self):
+        read_payments = feed.read_payments
+        reads = []
+
+        def paying_read_payments(since, limit):
+            reads.append(since)
+            result = read_payments(since, limit)
+            if len(reads) == 1:
+                # the payment is committed, while the read waits
+                self._pay('acc_2', 'acc_1', Decimal(1))
+            return result
+
+        _, since = feed.read_payments()
+        # commits of other processes send no signal, they are found by checks of the database
+        with override_settings(PAYMENT_FEED_CHECK_INTERVAL=0.05), mock.patch.object(balances_changed, 'send'):
+            with mock.patch.object(feed, 'read_payments', paying_read_payments):
+                payments, cursor = feed.wait_for_payments(since, timeout=10)
+        self.assertEqual(len(payments), 1)
+        self.assertEqual(cursor, self._position(payments[0]['id']))
+        self.assertEqual(len(reads), 2)
+
+    def test_commits_out_of_id_order(self):
+        cursor = self._get()['next']
+        # two transactions take ids in one order and are committed in the other one, as ones of processes
+        # with different blocks of ids are, see `PaymentIdBlock`: the first one is committed after a read
+        # of the feed, that has the second one
+        first_id, second_id = self.ids[-1] + 1, self.ids[-1] + 1000
+        with mock.patch.object(PaymentIdBlock, 'take', side_effect=[[second_id], [first_id]]):
+            self._pay('acc_1', 'acc_2', Decimal(1))
+            data = self._get(since=cursor)
+            self.assertEqual([payment['id'] for payment in data['payments']], [second_id])
+            self._pay('acc_1', 'acc_2', Decimal(2))
+
+        # the transfer with the lower id is after the cursor, it is not lost
+        data = self._get(since=data['next'])
+        self.assertEqual([payment['id'] for payment in data['payments']], [first_id])
+        self.assertGreater(self._position(first_id), self._position(second_id))
+        self.assertEqual(self._get(since=data['next'])['payments'], [])
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=100, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=0, currency=CURRENCY_PHP),
+        ))
+        Account.objects.get(pk='acc_1').pay(Account.objects.get(pk='acc_2'), Decimal(10), CURRENCY_PHP)
+
+    def test_not_modified(self):
+        for path in ('/v1/accounts', '/v1/payments', '/v1/payments?from_account=acc_1'):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Last-Modified', response)
+            # only counters are read, rows are neither queried nor serialized
+            with self.assertNumQueries(1):
+                not_modified = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.content, b'')
+            self.assertEqual(not_modified['ETag'], response['ETag'])
+
+            not_modified = self.client.get(path, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(not_modified.status_code, 304)
+
+            response = self.client.get(path, HTTP_IF_NONE_MATCH='"other"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_etags(self):
+        etags = {
+            self.client.get(path, **headers)['ETag']
+            for path in ('/v1/accounts', '/v1/payments', '/v1/payments?from_account=acc_1')
+            for headers in ({}, {'HTTP_ACCEPT': renderers.MEDIA_TYPE})
+        }
+        self.assertEqual(len(etags), 6)
+
+        for path, change in (
+            ('/v1/payments', lambda: Account.objects.get(pk='acc_2').pay(
+                Account.objects.get(pk='acc_1'), Decimal(1), CURRENCY_PHP,
+            )),
+            ('/v1/accounts', lambda: list(provisioning.import_accounts(
+                [{'id': 'acc_3', 'owner': 'owner_3', 'balance': '0', 'currency': CURRENCY_PHP}],
+            ))),
+        ):
+            etag = self.client.get(path)['ETag']
+            change()
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+
+class SqliteBackendTestCase(TestCase):
+    def _connection(self, path, **options):
+        settings_dict = dict(connection.settings_dict, NAME=path, OPTIONS=options, CONN_MAX_AGE=0)
+        return sqlite_backend.DatabaseWrapper(settings_dict, alias='tuned')
+
+    def test_options(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = '{}/tuned.sqlite3'.format(directory)
+            tuned = self._connection(
+                path, transaction_mode='IMMEDIATE', pragmas={'journal_mode': 'WAL', 'busy_timeout': 0},
+            )
+            plain = self._connection(path, timeout=0)
+            try:
+                with tuned.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone(), ('wal',))
+                    cursor.execute('PRAGMA busy_timeout')
+                    self.assertEqual(cursor.fetchone(), (0,))
+                    cursor.execute('CREATE TABLE item (id integer)')
+
+                # the transaction of an atomic block takes the write lock when it begins, before it writes
+                tuned._start_transaction_under_autocommit()
+                try:
+                    with self.assertRaisesMessage(OperationalError, 'database is locked'):
+                        with plain.cursor() as cursor:
+                            cursor.execute('INSERT INTO item VALUES (1)')
+                    # readers are not blocked by the writer in WAL mode
+                    with plain.cursor() as cursor:
+                        cursor.execute('SELECT count(*) FROM item')
+                        self.assertEqual(cursor.fetchone(), (0,))
+                finally:
+                    tuned.cursor().execute('COMMIT')
+            finally:
+                tuned.close()
+                plain.close()
+
+
+class ApiSettingsTestCase(TestCase):
+    script = """
+import django
+django.setup()
+from django.conf import settings
+from django.test import Client
+from django.test.utils import setup_test_environment
+setup_test_environment()
+print(' '.join(app for app in settings.INSTALLED_APPS if app.startswith('django.')))
+response = Client().get('/v1/fx-rates', HTTP_ACCEPT='text/html')
+print(response.status_code, response['Content-Type'])
+response = Client().post('/v1/payments', 'amount=1', content_type='application/x-www-form-urlencoded')
+print(response.status_code)
+"""
+
+    def test_api_only(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c', self.script], cwd=settings.BASE_DIR, universal_newlines=True,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE='payments.settings_api'), stderr=subprocess.DEVNULL,
+        )
+        # no Django apps, the browsable API is not rendered, and only JSON is parsed
+        self.assertEqual(output.splitlines(), ['', '406 application/json', '415'])
+
+
+class BenchmarksTestCase(TestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(benchmarks.percentile(values, 50), 50)
+        self.assertEqual(benchmarks.percentile(values, 99), 99)
+        self.assertEqual(benchmarks.percentile(values, 100), 100)
+        self.assertEqual(benchmarks.percentile([7.0], 95), 7)
+
+    def test_drive(self):
+        def request(client, i):
+            return client.get('/v1/accounts' if i % 2 else '/v1/unknown')
+
+        result = benchmarks.drive(request, requests=10)
+        self.assertEqual(result['requests'], 10)
+        self.assertEqual(result['errors'], 5)
+        self.assertEqual(result['threads'], 1)
+        self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+        self.assertLessEqual(result['p95_ms'], result['p99_ms'])
+
+    def test_unsupported_option(self):
+        with self.assertRaises(CommandError):
+            call_command('bench', 'serializers', requests=10)
+
+    @skipIf(connection.features.has_select_for_update, "Writes are serialized by backends without row locks only")
+    def test_contention_without_row_locks(self):
+        with self.assertRaisesMessage(CommandError, "needs a database with row-level locks"):
+            call_command('bench', 'contention', requests=10)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        metrics.reset()
+        balances.clear()
+        Account.clear_cached()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=100, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=0, currency=CURRENCY_PHP),
+        ))
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 5))
+        for value in (0, 1, 2, 5, 7):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.cumulative_counts()), [('1', 2), ('5', 4), ('+Inf', 5)])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 15)
+
+    def test_request_metrics(self):
+        response = self.client.get('/v1/accounts')
+        self.assertEqual(response.status_code, 200)
+        server_timing = [metric.strip().split(';')[0] for metric in response['Server-Timing'].split(',')]
+        self.assertEqual(server_timing, ['db', 'render', 'total'])
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+
+        queries = metrics.get_histogram('http_request_db_queries', endpoint='AccountsList', method='GET')
+        self.assertEqual(queries.count, 1)
+        self.assertEqual(queries.sum, 3)
+        render = metrics.get_histogram('http_request_render_duration_seconds', endpoint='AccountsList', method='GET')
+        self.assertGreater(render.sum, 0)
+
+        self.client.get('/v1/unknown')
+        unresolved = metrics.get_histogram('http_request_duration_seconds', endpoint='unresolved', method='GET')
+        self.assertEqual(unresolved.count, 1)
+
+    # the thread of sync code reads data of the test in its transaction, threads of the pool of async views can not
+    @override_settings(ASYNC_READ_THREADS=0)
+    def test_async_request_metrics(self):
+        # the whole chain of middleware is async, it is not wrapped into the thread of sync code
+        handler = ASGIHandler()
+        self.assertIsInstance(handler._middleware_chain.__wrapped__, MetricsMiddleware)
+        self.assertTrue(asyncio.iscoroutinefunction(handler._middleware_chain.__wrapped__))
+
+        async def request():
+            return await AsyncClient().get('/v1/accounts')
+        response = async_to_sync(request)()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+        queries = metrics.get_histogram('http_request_db_queries', endpoint='AccountsList', method='GET')
+        self.assertEqual((queries.count, queries.sum), (1, 3))
+
+    def test_pay_metrics(self):
+        response = self.client.post(
+            '/v1/payments',
+            {'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '10', 'currency': CURRENCY_PHP},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 201)
+        request_queries = metrics.get_histogram('http_request_db_queries', endpoint='PaymentsList', method='POST')
+        pay_queries = metrics.get_histogram('account_pay_db_queries')
+        self.assertEqual(pay_queries.count, 1)
+        # queries of the request include the ones of the payment, and are counted once
+        self.assertGreater(request_queries.sum, pay_queries.sum)
+
+        from_account, to_account = Account.objects.get(pk='acc_1'), Account.objects.get(pk='acc_2')
+        paid_queries = pay_queries.sum
+        with CaptureQueriesContext(connection) as queries:
+            from_account.pay(to_account, Decimal(10), CURRENCY_PHP)
+        self.assertEqual(pay_queries.count, 2)
+        self.assertEqual(pay_queries.sum - paid_queries, len(queries))
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn('# TYPE account_pay_duration_seconds histogram', text)
+        self.assertIn('account_pay_duration_seconds_count 2', text)
+        self.assertIn('account_pay_db_queries_bucket{le="+Inf"} 2', text)
+        self.assertIn('http_request_duration_seconds_count{endpoint="PaymentsList",method="POST"} 1', text)
+
+
+class AsyncViewsTestCase(TransactionTestCase):
+    def setUp(self):
+        balances.clear()
+        metrics.reset()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=100, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=0, currency=CURRENCY_PHP),
+        ))
+        Account.objects.get(pk='acc_1').pay(Account.objects.get(pk='acc_2'), Decimal(10), CURRENCY_PHP)
+
+    @staticmethod
+    def _async_request(method, path, *args, **kwargs):
+        async def request():
+            return await getattr(AsyncClient(), method)(path, *args, **kwargs)
+        return async_to_sync(request)()
+
+    def test_reads(self):
+        client = APIClient()
+        for path in ('/v1/accounts', '/v1/payments', '/v1/payments?direction=incoming'):
+            response = self._async_request('get', path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), client.get(path).json())
+
+        # lists are read and rendered in threads of the pool, rendering time is observed
+        threads = []
+        get_legs = views.PaymentsList.get_legs
+
+        def recording_get_legs(view, rows):
+            threads.append(threading.current_thread().name)
+            return get_legs(view, rows)
+
+        with mock.patch.object(views.PaymentsList, 'get_legs', recording_get_legs):
+            response = self._async_request('get', '/v1/payments')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(threads[0].startswith('async-read'), threads)
+        render = metrics.get_histogram('http_request_render_duration_seconds', endpoint='PaymentsList', method='GET')
+        self.assertGreater(render.sum, 0)
+        queries = metrics.get_histogram('http_request_db_queries', endpoint='PaymentsList', method='GET')
+        self.assertGreater(queries.sum, 0)
+
+    def test_concurrent_reads(self):
+        # both reads have to be in progress at once to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        get_legs = views.PaymentsList.get_legs
+
+        def waiting_get_legs(view, rows):
+            barrier.wait()
+            return get_legs(view, rows)
+
+        async def requests():
+            client = AsyncClient()
+            return await asyncio.gather(client.get('/v1/payments'), client.get('/v1/payments'))
+
+        with mock.patch.object(views.PaymentsList, 'get_legs', waiting_get_legs):
+            responses = async_to_sync(requests)()
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+
+    @override_settings(ASYNC_READ_THREADS=1)
+    def test_long_poll(self):
+        _, since = feed.read_payments()
+        started = time.monotonic()
+        finished = {}
+
+        async def get(name, path):
+            response = await AsyncClient().get(path)
+            finished[name] = time.monotonic() - started
+            return response
+
+        async def requests():
+            poll = asyncio.ensure_future(get('feed', '/v1/payments/feed?since={}&wait=10'.format(since)))
+            await asyncio.sleep(0.2)
+            # the only thread of the pool is not held by the pending long-poll
+            accounts = await get('accounts', '/v1/accounts')
+            self.assertFalse(poll.done())
+            payment = await AsyncClient().post(
+                '/v1/payments',
+                {'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '5', 'currency': CURRENCY_PHP},
+                content_type='application/json',
+            )
+            return accounts, payment, await poll
+
+        accounts, payment, poll = async_to_sync(requests)()
+        self.assertEqual((accounts.status_code, payment.status_code, poll.status_code), (200, 201, 200))
+        self.assertLess(finished['accounts'], 1)
+        # the long-poll is woken up on the event loop by the commit of the payment
+        self.assertLess(finished['feed'], settings.PAYMENT_FEED_CHECK_INTERVAL + 1)
+        self.assertEqual([item['amount'] for item in json.loads(poll.content)['payments']], ['5.0000'])
+
+    def test_writes(self):
+        response = self._async_request(
+            'post', '/v1/payments',
+            {'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '5', 'currency': CURRENCY_PHP},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            dict(Account.objects.values_list('pk', 'balance')), {'acc_1': Decimal(85), 'acc_2': Decimal(15)},
+        )
+        response = self._async_request('get', '/v1/accounts')
+        accounts = json.loads(response.content)['results']
+        self.assertEqual([account['balance'] for account in accounts], ['85.0000', '15.0000'])
+
+    def test_servers_benchmark(self):
+        wsgi = servers.wsgi_clients(servers.PATHS, requests=6, clients=3, workers=2, slow_ms=1)
+        asgi = servers.asgi_clients(servers.PATHS, requests=6, clients=3, slow_ms=1)
+        for result in (wsgi, asgi):
+            self.assertEqual((result['requests'], result['errors']), (6, 0))
+
+
+class TransferQueueTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+        idempotency._responses.clear()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=10, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=0, currency=CURRENCY_PHP),
+            Account(id='acc_3', owner='owner_3', balance=0, currency=CURRENCY_USD),
+        ))
+
+    def _post(self, from_account, to_account, amount, currency=CURRENCY_PHP, **headers):
+        return self.client.post(
+            '/v1/payments',
+            {'from_account': from_account, 'to_account': to_account, 'amount': amount, 'currency': currency},
+            format='json', HTTP_PREFER='respond-async', **headers
+        )
+
+    def _get_status(self, queued_id):
+        response = self.client.get('/v1/payments/queue/{}'.format(queued_id))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_enqueue(self):
+        response = self._post('acc_1', 'acc_2', '5')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'QUEUED')
+        self.assertEqual(response['Location'], '/v1/payments/queue/{}'.format(response.data['id']))
+        self.assertEqual(response['Preference-Applied'], 'respond-async')
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, 10)
+
+        queued = self._get_status(response.data['id'])
+        self.assertEqual(queued['status'], 'QUEUED')
+        self.assertIsNone(queued['payment'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(transfer_queue.process_batch(), 1)
+        queued = self._get_status(response.data['id'])
+        self.assertEqual(queued['status'], 'CREATED')
+        self.assertEqual(queued['payment'], Payment.objects.get().pk)
+        self.assertIsNotNone(queued['processed_at'])
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, 5)
+        self.assertEqual(self.client.get('/v1/accounts/acc_2').data['balance'], '5.0000')
+
+        self.assertEqual(transfer_queue.process_batch(), 0)
+        self.assertEqual(self.client.get('/v1/payments/queue/0').status_code, 404)
+
+    def test_synchronous_requests(self):
+        # invalid requests are rejected at once, and requests with idempotency keys are never queued
+        self.assertEqual(self._post('acc_1', 'acc_unknown', '5').status_code, 400)
+        response = self._post('acc_1', 'acc_2', '5', HTTP_IDEMPOTENCY_KEY='key_1')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post(
+            '/v1/payments', {'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '1', 'currency': CURRENCY_PHP},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(QueuedTransfer.objects.exists())
+
+    def test_order_and_netting(self):
+        queued_ids = [
+            self._post(from_account, to_account, amount, currency).data['id']
+            for from_account, to_account, amount, currency in (
+                ('acc_1', 'acc_2', '10', CURRENCY_PHP),
+                ('acc_1', 'acc_2', '5', CURRENCY_PHP),
+                ('acc_2', 'acc_1', '5', CURRENCY_PHP),
+                ('acc_1', 'acc_3', '1', CURRENCY_PHP),
+                ('acc_1', 'acc_2', '5', CURRENCY_PHP),
+            )
+        ]
+        # counters are created by the first changes of their slots
+        ChangeCounter.bump(['acc_1', 'acc_2'])
+        OwnerTotal.refresh()
+        # the queue and accounts are read once, net changes of balances are written with one update,
+        # every payment is inserted, opening balance snapshots are inserted at once, owner totals and volumes
+        # are read and written at once, change counters and statuses are written with one update each,
+        # inside two savepoints
+        with self.assertNumQueries(1 + 1 + 1 + 3 + 1 + 2 + 3 + 1 + 1 + 4):
+            self.assertEqual(transfer_queue.process_batch(), 5)
+
+        statuses = [self._get_status(queued_id) for queued_id in queued_ids]
+        self.assertEqual(
+            [(queued['status'], queued['error']) for queued in statuses],
+            [
+                ('CREATED', ''), ('ERROR', 'insufficient_balance'), ('CREATED', ''),
+                ('ERROR', 'invalid_account_currency'), ('CREATED', ''),
+            ],
+        )
+        payments = Payment.objects.order_by('pk')
+        self.assertEqual([queued['payment'] for queued in statuses if queued['payment']], [p.pk for p in payments])
+        self.assertEqual(
+            [(p.from_account_id, p.to_account_id, p.amount) for p in payments],
+            [('acc_1', 'acc_2', 10), ('acc_2', 'acc_1', 5), ('acc_1', 'acc_2', 5)],
+        )
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, 0)
+        self.assertEqual(Account.objects.get(pk='acc_2').balance, 10)
+
+    def test_worker(self):
+        for _ in range(5):
+            self._post('acc_1', 'acc_2', '1')
+        self.assertEqual(transfer_queue.process_batch(batch_size=2), 2)
+        self.assertEqual(QueuedTransfer.objects.filter(status=QueuedTransfer.STATUS_QUEUED).count(), 3)
+
+        stdout = StringIO()
+        call_command('process_transfer_queue', once=True, batch_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), "Processed 3 transfers")
+        self.assertEqual(Payment.objects.count(), 5)
+        self.assertEqual(Account.objects.get(pk='acc_1').balance, 5)
+
+
+@override_settings(BALANCE_SNAPSHOT_INTERVAL=2)
+class LedgerTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+        Account.objects.bulk_create((
+            Account(id='acc_1', owner='owner_1', balance=100, currency=CURRENCY_PHP),
+            Account(id='acc_2', owner='owner_2', balance=0, currency=CURRENCY_PHP),
+            Account(id='acc_3', owner='owner_3', balance=7, currency=CURRENCY_PHP),
+        ))
+        self.started_at = timezone.now()
+        # time after every transfer, with the balances of accounts acc_1 and acc_2 by then
+        self.history = []
+        for transfers in (
+            [('acc_1', 'acc_2', Decimal(10), CURRENCY_PHP)],
+            [('acc_1', 'acc_2', Decimal(20), CURRENCY_PHP), ('acc_2', 'acc_1', Decimal(5), CURRENCY_PHP)],
+            [('acc_2', 'acc_2', Decimal(1), CURRENCY_PHP)],
+            [('acc_2', 'acc_1', Decimal(15), CURRENCY_PHP)],
+        ):
+            if len(transfers) == 1:
+                from_account_id, to_account_id, amount, currency = transfers[0]
+                Account.objects.get(pk=from_account_id).pay(Account.objects.get(pk=to_account_id), amount, currency)
+            else:
+                self.assertEqual(Account.pay_batch(transfers), [None] * len(transfers))
+            self.history.append((timezone.now(), dict(Account.objects.values_list('pk', 'balance'))))
+
+    def test_sequences(self):
+        payments = Payment.objects.order_by('pk')
+        self.assertEqual(
+            [(p.from_account_id, p.from_sequence, p.to_account_id, p.to_sequence) for p in payments],
+            [('acc_1', 1, 'acc_2', 1), ('acc_1', 2, 'acc_2', 2), ('acc_2', 3, 'acc_1', 3), ('acc_2', 4, 'acc_2', 5),
+             ('acc_2', 6, 'acc_1', 4)],
+        )
+        self.assertEqual(dict(Account.objects.values_list('pk', 'sequence')), {'acc_1': 4, 'acc_2': 6, 'acc_3': 0})
+        # opening balances and balances after every 2 entries, the transfer to the same account is 2 entries
+        self.assertEqual(
+            list(BalanceSnapshot.objects.values_list('account_id', 'sequence', 'balance')),
+            [('acc_1', 0, 100), ('acc_1', 2, 70), ('acc_1', 4, 90), ('acc_2', 0, 0), ('acc_2', 2, 30),
+             ('acc_2', 5, 25), ('acc_2', 6, 10)],
+        )
+
+    def test_balance_at(self):
+        self.assertEqual(ledger.balance_at('acc_1', self.started_at), (100, 0))
+        self.assertEqual(ledger.balance_at('acc_2', self.started_at), (0, 0))
+        for at, expected in self.history:
+            self.assertEqual(ledger.balance_at('acc_1', at)[0], expected['acc_1'])
+            self.assertEqual(ledger.balance_at('acc_2', at)[0], expected['acc_2'])
+        self.assertEqual(ledger.balance_at('acc_2', self.history[2][0]), (25, 5))
+        self.assertEqual(ledger.balance_at('acc_3', self.history[-1][0]), (7, 0))
+        with self.assertRaises(UnknownAccount):
+            ledger.balance_at('acc_unknown', self.started_at)
+
+        # the latest snapshot before the time and the payments after it are read
+        with self.assertNumQueries(2):
+            ledger.balance_at('acc_1', self.history[1][0])
+
+    def test_balance_api(self):
+        response = self.client.get('/v1/accounts/acc_2/balance', {'at': self.history[1][0].isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {'id': 'acc_2', 'at': self.history[1][0].isoformat().replace('+00:00', 'Z'), 'balance': '25.0000',
+             'sequence': 3},
+        )
+        response = self.client.get('/v1/accounts/acc_2/balance')
+        self.assertEqual((response.json()['balance'], response.json()['sequence']), ('10.0000', 6))
+
+        self.assertEqual(self.client.get('/v1/accounts/acc_unknown/balance').status_code, 404)
+        response = self.client.get('/v1/accounts/acc_2/balance', {'at': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('at', response.json())
+
+    def test_check_ledger(self):
+        self.assertEqual(list(ledger.check_accounts()), [])
+        self.assertEqual(list(ledger.check_snapshots()), [])
+        stdout = StringIO()
+        call_command('check_ledger', stdout=stdout)
+        last_snapshot_id = BalanceSnapshot.objects.order_by('pk').last().pk
+        self.assertEqual(stdout.getvalue().strip(), 'Checked snapshots up to id {}'.format(last_snapshot_id))
+
+        # changes of balances without payments are found against the latest snapshots of accounts,
+        # accounts without entries have no ledger to check against
+        Account.objects.filter(pk='acc_3').update(balance=8)
+        Account.objects.filter(pk='acc_1').update(balance=F('balance') + 1)
+        self.assertEqual(list(ledger.check_accounts(chunk_size=1)), [('acc_1', None, 4, 4, 91, 90)])
+
+        # a changed snapshot differs from the previous one, and the next one differs from it
+        snapshot, next_snapshot = BalanceSnapshot.objects.filter(account_id='acc_2', sequence__gte=5)
+        BalanceSnapshot.objects.filter(pk=snapshot.pk).update(balance=26)
+        self.assertEqual(
+            list(ledger.check_snapshots(chunk_size=1)),
+            [('acc_2', snapshot.pk, 5, 5, 26, 25), ('acc_2', next_snapshot.pk, 6, 6, 10, 11)],
+        )
+        # snapshots are checked once, runs go on after the last checked one
+        self.assertEqual(list(ledger.check_snapshots(after_id=next_snapshot.pk)), [])
+        self.assertEqual(list(ledger.check_snapshots(upto_id=snapshot.pk - 1)), [])
+
+        stdout = StringIO()
+        with self.assertRaisesMessage(CommandError, 'Found 3 discrepancies'):
+            call_command('check_ledger', stdout=stdout)
+        self.assertIn(
+            'Account acc_2 snapshot {}: sequence 5, expected 5; balance 26'.format(snapshot.pk), stdout.getvalue(),
+        )
+        with self.assertRaisesMessage(CommandError, 'Found 1 discrepancies'):
+            call_command('check_ledger', after_snapshot=next_snapshot.pk, stdout=StringIO())
+
+
+    def test_check_sequences(self):
+        # batches debit hot accounts, consolidating credits pending in their buckets, and credit them
+        hot = Account.objects.get(pk='acc_2')
+        hot.set_buckets(2)
+        Account.objects.get(pk='acc_1').pay(hot, Decimal(30), CURRENCY_PHP)
+        transfers = [
+            ('acc_2', 'acc_1', Decimal(10), CURRENCY_PHP), ('acc_2', 'acc_3', Decimal(25), CURRENCY_PHP),
+            ('acc_1', 'acc_2', Decimal(5), CURRENCY_PHP),
+        ]
+        self.assertEqual(Account.pay_batch(transfers), [None, None, None])
+        self.assertEqual(dict(Account.objects.values_list('pk', 'sequence')), {'acc_1': 7, 'acc_2': 10, 'acc_3': 1})
+        self.assertEqual(list(ledger.check_accounts()), [])
+        self.assertEqual(list(ledger.check_snapshots()), [])
+
+        # a duplicated sequence is found, though the balance agrees with the latest snapshot
+        payment = Payment.objects.get(from_account_id='acc_1', from_sequence=5)
+        Payment.objects.filter(pk=payment.pk).update(from_sequence=6)
+        self.assertEqual(list(ledger.check_accounts()), [('acc_1', None, 7, 6, 65, 65)])
+        # and an entry after the sequence of the account
+        Payment.objects.filter(pk=payment.pk).update(from_sequence=8)
+        self.assertEqual(list(ledger.check_accounts()), [('acc_1', None, 7, 8, 65, 65)])
+
+
+class OwnerTotalsTestCase(TestCase):
+    owners_url = '/v1/owners'
+
+    def setUp(self):
+        self.client = APIClient()
+        for account_id, owner, balance, currency in (
+            ('acc_1', 'owner_1', 100, CURRENCY_PHP),
+            ('acc_2', 'owner_1', 50, CURRENCY_PHP),
+            ('acc_3', 'owner_1', 10, CURRENCY_USD),
+            ('acc_4', 'owner_2', 0, CURRENCY_PHP),
+        ):
+            Account.objects.create(id=account_id, owner=owner, balance=balance, currency=currency)
+
+    def _totals(self):
+        return list(OwnerTotal.objects.values_list('owner', 'currency', 'balance', 'accounts'))
+
+    def test_totals(self):
+        expected = [('owner_1', 'PHP', 150, 2), ('owner_1', 'USD', 10, 1), ('owner_2', 'PHP', 0, 1)]
+        self.assertEqual(self._totals(), expected)
+
+        Account.objects.get(pk='acc_1').pay(Account.objects.get(pk='acc_4'), Decimal(30), CURRENCY_PHP)
+        Account.pay_batch([
+            ('acc_4', 'acc_2', Decimal(5), CURRENCY_PHP), ('acc_1', 'acc_2', Decimal(7), CURRENCY_PHP),
+        ])
+        expected = [('owner_1', 'PHP', 125, 2), ('owner_1', 'USD', 10, 1), ('owner_2', 'PHP', 25, 1)]
+        self.assertEqual(self._totals(), expected)
+        OwnerTotal.refresh()
+        self.assertEqual(self._totals(), expected)
+
+        # accounts of bulk created owners are counted by their first payments
+        Account.objects.bulk_create([Account(id='acc_5', owner='owner_3', balance=20, currency=CURRENCY_PHP)])
+        Account.objects.get(pk='acc_5').pay(Account.objects.get(pk='acc_4'), Decimal(1), CURRENCY_PHP)
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_3').balance, 19)
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_2').balance, 26)
+
+        Account.objects.get(pk='acc_3').delete()
+        self.assertFalse(OwnerTotal.objects.filter(owner='owner_1', currency=CURRENCY_USD).exists())
+
+    def test_volumes(self):
+        Account.objects.get(pk='acc_1').pay(Account.objects.get(pk='acc_4'), Decimal(30), CURRENCY_PHP)
+        Account.pay_batch([
+            ('acc_4', 'acc_2', Decimal(5), CURRENCY_PHP), ('acc_1', 'acc_2', Decimal(7), CURRENCY_PHP),
+        ])
+        today = timezone.localdate()
+        self.assertEqual(
+            list(OwnerVolume.objects.values_list(
+                'owner', 'currency', 'day', 'outgoing', 'outgoing_payments', 'incoming', 'incoming_payments',
+            )),
+            [('owner_1', 'PHP', today, 37, 2, 12, 2), ('owner_2', 'PHP', today, 5, 1, 30, 1)],
+        )
+
+    def test_owners_api(self):
+        Account.objects.get(pk='acc_1').pay(Account.objects.get(pk='acc_4'), Decimal(30), CURRENCY_PHP)
+        OwnerVolume.objects.create(
+            owner='owner_2', currency=CURRENCY_PHP, day=timezone.localdate() - timedelta(days=40),
+            outgoing=Decimal(1), outgoing_payments=1,
+        )
+
+        # a page of totals and volumes of its owners
+        with self.assertNumQueries(2):
+            response = self.client.get(self.owners_url, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {
+                'owner': 'owner_1', 'currency': 'PHP', 'accounts': 2, 'balance': '120.0000',
+                'outgoing': '30.0000', 'outgoing_payments': 1, 'incoming': '0.0000', 'incoming_payments': 0,
+            },
+            {
+                'owner': 'owner_1', 'currency': 'USD', 'accounts': 1, 'balance': '10.0000',
+                'outgoing': '0.0000', 'outgoing_payments': 0, 'incoming': '0.0000', 'incoming_payments': 0,
+            },
+            {
+                'owner': 'owner_2', 'currency': 'PHP', 'accounts': 1, 'balance': '30.0000',
+                'outgoing': '0.0000', 'outgoing_payments': 0, 'incoming': '30.0000', 'incoming_payments': 1,
+            },
+        ])
+
+        response = self.client.get(self.owners_url, {'owner': 'owner_2', 'days': 60}, format='json')
+        self.assertEqual(
+            [(item['owner'], item['outgoing'], item['incoming']) for item in response.json()['results']],
+            [('owner_2', '1.0000', '30.0000')],
+        )
+        response = self.client.get(self.owners_url, {'currency': CURRENCY_USD}, format='json')
+        self.assertEqual([item['owner'] for item in response.json()['results']], ['owner_1'])
+
+        response = self.client.get(self.owners_url, {'page_size': 2}, format='json')
+        page = response.json()
+        self.assertEqual([item['currency'] for item in page['results']], ['PHP', 'USD'])
+        page = self.client.get(page['next'], format='json').json()
+        self.assertEqual([item['owner'] for item in page['results']], ['owner_2'])
+
+        for days in ('abc', '0'):
+            response = self.client.get(self.owners_url, {'days': days}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('days', response.json())
+
+    def test_refresh_command(self):
+        Account.objects.bulk_create([Account(id='acc_5', owner='owner_3', balance=20, currency=CURRENCY_PHP)])
+        OwnerTotal.objects.filter(owner='owner_1').update(balance=0)
+
+        stdout = StringIO()
+        call_command('refresh_owner_totals', 'owner_3', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), "Computed 1 owner totals")
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_3').balance, 20)
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_1', currency=CURRENCY_PHP).balance, 0)
+
+        stdout = StringIO()
+        call_command('refresh_owner_totals', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), "Computed 4 owner totals")
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_1', currency=CURRENCY_PHP).balance, 150)
+
+
+class BalanceBucketsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+        for account_id, owner, balance in (
+            ('acc_hot', 'merchant', 10), ('acc_1', 'owner_1', 100), ('acc_2', 'owner_2', 100),
+        ):
+            Account.objects.create(id=account_id, owner=owner, balance=balance, currency=CURRENCY_PHP)
+        self.hot = Account.objects.get(pk='acc_hot')
+        self.hot.set_buckets(4)
+
+    def _credit(self, amounts):
+        # credits go to buckets round robin
+        buckets = itertools.count()
+        with mock.patch('core.models.random.randrange', side_effect=lambda n: next(buckets) % n):
+            for i, amount in enumerate(amounts):
+                payer = Account.objects.get(pk='acc_{}'.format(i % 2 + 1))
+                payer.pay(Account.objects.get(pk='acc_hot'), Decimal(amount), CURRENCY_PHP)
+
+    def _buckets(self):
+        return list(BalanceBucket.objects.filter(account_id='acc_hot').values_list('index', 'balance'))
+
+    def test_credits(self):
+        self._credit([1, 2, 3, 4, 5])
+        self.assertEqual(self._buckets(), [(0, 6), (1, 2), (2, 3), (3, 4)])
+        # credits are pending: the stored balance and owner totals are not changed, nor is the ledger of the account
+        self.hot.refresh_from_db()
+        self.assertEqual((self.hot.balance, self.hot.sequence), (10, 0))
+        self.assertEqual(OwnerTotal.objects.get(owner='merchant').balance, 10)
+        self.assertEqual(Payment.objects.filter(to_sequence__isnull=True).count(), 5)
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_1').balance, 91)
+
+        # reported balances include pending credits, and are not cached
+        self.assertEqual(AccountSerializer(self.hot).data['balance'], '25.0000')
+        self.assertEqual(self.client.get('/v1/accounts/acc_hot').json()['balance'], '25.0000')
+        self._credit([5])
+        self.assertEqual(self.client.get('/v1/accounts/acc_hot').json()['balance'], '30.0000')
+        self.assertEqual(ledger.balance_at('acc_hot', timezone.now()), (30, 0))
+        self.assertEqual(list(ledger.check_accounts()), [])
+
+    def test_debit_consolidates(self):
+        self._credit([1, 2, 3, 4, 5])
+        hot = Account.objects.get(pk='acc_hot')
+        # the stored balance is enough
+        hot.pay(Account.objects.get(pk='acc_1'), Decimal(4), CURRENCY_PHP)
+        self.assertEqual((hot.balance, hot.sequence), (6, 1))
+        self.assertEqual(Payment.objects.filter(to_sequence__isnull=True).count(), 5)
+
+        with self.assertRaises(InsufficientBalance):
+            hot.pay(Account.objects.get(pk='acc_1'), Decimal(22), CURRENCY_PHP)
+        # consolidation is rolled back with the payment
+        self.assertEqual(Payment.objects.filter(to_sequence__isnull=True).count(), 5)
+
+        hot.pay(Account.objects.get(pk='acc_1'), Decimal(20), CURRENCY_PHP)
+        self.assertEqual((hot.balance, hot.sequence), (1, 7))
+        self.assertEqual(self._buckets(), [(0, 0), (1, 0), (2, 0), (3, 0)])
+        # credits are numbered in the order they were made, before the debit, that needed them
+        entries = Payment.objects.filter(Q(to_account_id='acc_hot') | Q(from_account_id='acc_hot')).order_by('pk')
+        self.assertEqual(
+            [(p.amount, p.from_sequence if p.from_account_id == 'acc_hot' else p.to_sequence) for p in entries],
+            [(1, 2), (2, 3), (3, 4), (4, 5), (5, 6), (4, 1), (20, 7)],
+        )
+        self.assertEqual(OwnerTotal.objects.get(owner='merchant').balance, 1)
+        self.assertEqual(OwnerVolume.objects.get(owner='merchant').incoming, 15)
+        self.assertEqual(list(ledger.check_accounts()), [])
+        self.assertEqual(list(ledger.check_snapshots()), [])
+
+    def test_batch_consolidates(self):
+        self._credit([10, 20])
+        transfers = [('acc_hot', 'acc_1', Decimal(25), CURRENCY_PHP), ('acc_hot', 'acc_2', Decimal(50), CURRENCY_PHP)]
+        self.assertEqual(
+            [type(error) for error in Account.pay_batch(transfers)], [type(None), InsufficientBalance],
+        )
+        # nothing is paid by the atomic batch, so credits are left pending
+        self.assertEqual(self._buckets(), [(0, 10), (1, 20), (2, 0), (3, 0)])
+
+        self.assertEqual(
+            [type(error) for error in Account.pay_batch(transfers, atomic=False)], [type(None), InsufficientBalance],
+        )
+        self.hot.refresh_from_db()
+        self.assertEqual((self.hot.balance, self.hot.sequence), (15, 3))
+        self.assertEqual(self._buckets(), [(0, 0), (1, 0), (2, 0), (3, 0)])
+        self.assertEqual(OwnerTotal.objects.get(owner='merchant').balance, 15)
+        self.assertEqual(list(ledger.check_accounts()), [])
+
+    @override_settings(BALANCE_SNAPSHOT_INTERVAL=2)
+    def test_batch_consolidates_between_debits(self):
+        def sequences():
+            entries = Payment.objects.filter(Q(to_account_id='acc_hot') | Q(from_account_id='acc_hot'))
+            return sorted(
+                p.from_sequence if p.from_account_id == 'acc_hot' else p.to_sequence for p in entries
+            )
+
+        # the first debit of the batch is the first entry of the account, credits are consolidated after it
+        self._credit([50])
+        transfers = [('acc_hot', 'acc_1', Decimal(8), CURRENCY_PHP), ('acc_hot', 'acc_2', Decimal(30), CURRENCY_PHP)]
+        self.assertEqual(Account.pay_batch(transfers, atomic=False), [None, None])
+        self.assertEqual(sequences(), [1, 2, 3])
+        self.hot.refresh_from_db()
+        self.assertEqual((self.hot.balance, self.hot.sequence), (22, 3))
+
+        self._credit([20, 30])
+        transfers = [('acc_hot', 'acc_1', Decimal(22), CURRENCY_PHP), ('acc_hot', 'acc_2', Decimal(40), CURRENCY_PHP)]
+        self.assertEqual(Account.pay_batch(transfers, atomic=False), [None, None])
+        self.assertEqual(sequences(), [1, 2, 3, 4, 5, 6, 7])
+        self.hot.refresh_from_db()
+        self.assertEqual((self.hot.balance, self.hot.sequence), (10, 7))
+        self.assertEqual(
+            list(BalanceSnapshot.objects.filter(account_id='acc_hot').values_list('sequence', 'balance')),
+            [(0, 10), (2, 52), (4, 0), (6, 50)],
+        )
+        self.assertEqual(OwnerTotal.objects.get(owner='merchant').balance, 10)
+        self.assertEqual(list(ledger.check_accounts()), [])
+        self.assertEqual(list(ledger.check_snapshots()), [])
+
+    def test_set_buckets(self):
+        self._credit([1, 2, 3])
+        stale = Account.objects.get(pk='acc_hot')
+        self.hot.set_buckets(2)
+        self.assertEqual((self.hot.balance, self.hot.sequence, self.hot.buckets), (16, 3, 2))
+        self.assertEqual(self._buckets(), [(0, 0), (1, 0)])
+
+        # the stale instance has 4 buckets, the credit is retried with the current ones
+        self.hot.set_buckets(0)
+        Account.objects.get(pk='acc_1').pay(stale, Decimal(4), CURRENCY_PHP)
+        self.assertEqual((stale.balance, stale.sequence), (20, 4))
+        self.assertEqual(self._buckets(), [])
+        self.assertEqual(list(ledger.check_accounts()), [])
+        with self.assertRaises(ValueError):
+            self.hot.set_buckets(-1)
+
+    def test_commands(self):
+        out = StringIO()
+        call_command('set_account_buckets', 'acc_1', '3', stdout=out)
+        self.assertEqual(out.getvalue(), "Set 3 balance buckets of account acc_1\n")
+        with self.assertRaises(CommandError):
+            call_command('set_account_buckets', 'acc_unknown', '3')
+
+        self._credit([1, 2])
+        out = StringIO()
+        call_command('consolidate_buckets', stdout=out)
+        self.assertEqual(out.getvalue(), "Consolidated 2 credits of 2 accounts\n")
+        self.hot.refresh_from_db()
+        self.assertEqual((self.hot.balance, self.hot.sequence), (13, 2))
+
+        # buckets are checked against pending credits
+        self._credit([5])
+        BalanceBucket.objects.filter(account_id='acc_hot', index=0).update(balance=F('balance') + 1)
+        self.assertEqual(list(ledger.check_accounts()), [('acc_hot', None, 2, 2, Decimal(19), Decimal(18))])
+
+
+class FxTransfersTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+        for account_id, owner, balance, currency in (
+            ('acc_1', 'owner_1', 1000, CURRENCY_PHP),
+            ('acc_2', 'owner_2', 0, CURRENCY_USD),
+            ('acc_3', 'owner_2', 0, CURRENCY_EUR),
+        ):
+            Account.objects.create(id=account_id, owner=owner, balance=balance, currency=currency)
+        with self.captureOnCommitCallbacks(execute=True):
+            FxRate.set_rate(CURRENCY_PHP, CURRENCY_USD, Decimal('0.0175'))
+            FxRate.set_rate(CURRENCY_USD, CURRENCY_PHP, Decimal('56.25'))
+
+    def _account(self, account_id):
+        return Account.objects.get(pk=account_id)
+
+    def test_pay(self):
+        from_account, to_account = self._account('acc_1'), self._account('acc_2')
+        payment = from_account.pay(to_account, Decimal('100.0001'), CURRENCY_PHP, to_currency=CURRENCY_USD)
+        # 1.75000175 is rounded down
+        self.assertEqual(
+            (payment.to_amount, payment.to_currency, payment.rate, payment.rate_version),
+            (Decimal('1.75'), CURRENCY_USD, Decimal('0.0175'), 1),
+        )
+        self.assertEqual((from_account.balance, to_account.balance), (Decimal('899.9999'), Decimal('1.75')))
+        self.assertEqual(
+            Payment.objects.values_list('amount', 'currency', 'to_amount', 'to_currency', 'rate', 'rate_version').get(),
+            (Decimal('100.0001'), CURRENCY_PHP, Decimal('1.75'), CURRENCY_USD, Decimal('0.0175'), 1),
+        )
+        incoming, outgoing = payment.legs()
+        self.assertEqual((incoming.amount, incoming.currency), (Decimal('1.75'), CURRENCY_USD))
+        self.assertEqual((outgoing.amount, outgoing.currency), (Decimal('100.0001'), CURRENCY_PHP))
+
+        # the ledger and totals of the destination account are in its currency
+        self.assertEqual(list(ledger.check_accounts()), [])
+        self.assertEqual(ledger.balance_at('acc_2', timezone.now()), (Decimal('1.75'), 1))
+        self.assertEqual(OwnerTotal.objects.get(owner='owner_2', currency=CURRENCY_USD).balance, Decimal('1.75'))
+        self.assertEqual(
+            OwnerVolume.objects.values_list('owner', 'currency', 'outgoing', 'incoming').order_by('owner').get(
+                owner='owner_2',
+            ),
+            ('owner_2', CURRENCY_USD, 0, Decimal('1.75')),
+        )
+
+        # the next version of the rate is used as soon as it is set in this process
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(FxRate.set_rate(CURRENCY_PHP, CURRENCY_USD, Decimal('0.02')).version, 2)
+        payment = from_account.pay(to_account, Decimal(100), CURRENCY_PHP, to_currency=CURRENCY_USD)
+        self.assertEqual((payment.to_amount, payment.rate_version), (Decimal(2), 2))
+        self.assertEqual(to_account.balance, Decimal('3.75'))
+
+    def test_validations(self):
+        from_account, to_account = self._account('acc_1'), self._account('acc_2')
+        with self.assertRaises(InvalidAccountCurrency) as cm:
+            from_account.pay(to_account, Decimal(1), CURRENCY_PHP)
+        self.assertEqual(cm.exception.account_ids, ['acc_2'])
+        with self.assertRaises(InvalidAccountCurrency) as cm:
+            from_account.pay(to_account, Decimal(1), CURRENCY_PHP, to_currency=CURRENCY_EUR)
+        self.assertEqual(cm.exception.account_ids, ['acc_2'])
+        with self.assertRaises(UnknownFxRate):
+            from_account.pay(self._account('acc_3'), Decimal(1), CURRENCY_PHP, to_currency=CURRENCY_EUR)
+        with self.assertRaises(InsufficientBalance):
+            from_account.pay(to_account, Decimal(1001), CURRENCY_PHP, to_currency=CURRENCY_USD)
+        # converted amounts have to fit amounts
+        Account.objects.filter(pk='acc_2').update(balance=Decimal('1E15'))
+        with self.assertRaises(InvalidAmount):
+            self._account('acc_2').pay(from_account, Decimal('1E15'), CURRENCY_USD, to_currency=CURRENCY_PHP)
+        self.assertFalse(Payment.objects.exists())
+
+        for from_currency, to_currency, rate in (
+            (CURRENCY_PHP, CURRENCY_PHP, Decimal(1)), (CURRENCY_PHP, CURRENCY_EUR, Decimal(0)),
+            (CURRENCY_PHP, CURRENCY_EUR, Decimal('0.00000000001')), (CURRENCY_PHP, 'XXX', Decimal(1)),
+        ):
+            with self.assertRaises(ValidationError):
+                FxRate.set_rate(from_currency, to_currency, rate)
+
+    def test_rates_of_other_processes(self):
+        # rows added by other processes are seen after the check interval
+        FxRate.objects.create(from_currency=CURRENCY_PHP, to_currency=CURRENCY_EUR, rate=Decimal('0.016'), version=1)
+        with override_settings(FX_RATE_CHECK_INTERVAL=3600):
+            self.assertNotIn((CURRENCY_PHP, CURRENCY_EUR), FxRate.current())
+        with override_settings(FX_RATE_CHECK_INTERVAL=0), self.assertNumQueries(2):
+            rates = FxRate.current()
+        self.assertEqual(rates, {
+            (CURRENCY_PHP, CURRENCY_USD): (Decimal('0.0175'), 1),
+            (CURRENCY_USD, CURRENCY_PHP): (Decimal('56.25'), 1),
+            (CURRENCY_PHP, CURRENCY_EUR): (Decimal('0.016'), 1),
+        })
+        with override_settings(FX_RATE_CHECK_INTERVAL=0), self.assertNumQueries(1):
+            self.assertIs(FxRate.current(), rates)
+
+    def test_api(self):
+        response = self.client.post('/v1/payments', {
+            'from_account': 'acc_1', 'to_account': 'acc_3', 'amount': '1', 'currency': CURRENCY_PHP,
+            'to_currency': CURRENCY_EUR,
+        }, format='json')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json(), {'status': 'ERROR', 'error': 'unknown_fx_rate'})
+
+        response = self.client.post('/v1/payments', {
+            'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '100', 'currency': CURRENCY_PHP,
+            'to_currency': CURRENCY_USD,
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/v1/payments/batch', {'transfers': [
+            {'from_account': 'acc_2', 'to_account': 'acc_1', 'amount': '1', 'currency': CURRENCY_USD,
+             'to_currency': CURRENCY_PHP},
+            {'from_account': 'acc_1', 'to_account': 'acc_3', 'amount': '1', 'currency': CURRENCY_PHP,
+             'to_currency': CURRENCY_EUR},
+        ], 'mode': 'per_item'}, format='json')
+        self.assertEqual(
+            [item['status'] for item in response.json()['results']], ['CREATED', 'ERROR'],
+        )
+        self.assertEqual(response.json()['results'][1]['error'], 'unknown_fx_rate')
+        self.assertEqual(self.client.get('/v1/accounts/acc_1').data['balance'], '956.2500')
+        self.assertEqual(self.client.get('/v1/accounts/acc_2').data['balance'], '0.7500')
+
+        # legs are listed and filtered in their own currencies
+        response = self.client.get('/v1/payments', {'currency': CURRENCY_USD}, format='json')
+        self.assertEqual(
+            [(item['direction'], item['to_account'], item['amount']) for item in response.json()['results']],
+            [(PAYMENT_DIRECTIONS_OUTGOING, 'acc_1', '1.0000'), (PAYMENT_DIRECTIONS_INCOMING, 'acc_1', '1.7500')],
+        )
+        response = self.client.get('/v1/payments', {'currency': CURRENCY_PHP, 'from_account': 'acc_1'}, format='json')
+        self.assertEqual(
+            [(item['direction'], item['to_account'], item['amount']) for item in response.json()['results']],
+            [(PAYMENT_DIRECTIONS_INCOMING, 'acc_2', '56.2500'), (PAYMENT_DIRECTIONS_OUTGOING, 'acc_2', '100.0000')],
+        )
+        response = self.client.get('/v1/payments/export.ndjson')
+        first = json.loads(b''.join(response.streaming_content).decode().splitlines()[0])
+        self.assertEqual(
+            (first['amount'], first['to_amount'], first['to_currency'], first['rate']),
+            ('100.0000', '1.7500', CURRENCY_USD, '0.0175000000'),
+        )
+
+        response = self.client.get('/v1/fx-rates', format='json')
+        self.assertEqual(response.json(), [
+            {'from_currency': CURRENCY_PHP, 'to_currency': CURRENCY_USD, 'rate': '0.0175000000', 'version': 1},
+            {'from_currency': CURRENCY_USD, 'to_currency': CURRENCY_PHP, 'rate': '56.2500000000', 'version': 1},
+        ])
+
+        response = self.client.post('/v1/payments', {
+            'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '40', 'currency': CURRENCY_PHP,
+            'to_currency': CURRENCY_USD,
+        }, format='json', HTTP_PREFER='respond-async')
+        self.assertEqual(self.client.get(response['Location']).data['to_currency'], CURRENCY_USD)
+        self.assertEqual(transfer_queue.process_batch(), 1)
+        self.assertEqual(self.client.get('/v1/accounts/acc_2').data['balance'], '1.4500')
+
+    def test_set_fx_rate_command(self):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('set_fx_rate', CURRENCY_EUR, CURRENCY_USD, '1.08', stdout=out)
+        self.assertEqual(out.getvalue(), "Set EUR USD rate 1.08 version 1\n")
+        self.assertEqual(FxRate.current()[(CURRENCY_EUR, CURRENCY_USD)], (Decimal('1.08'), 1))
+        with self.assertRaises(CommandError):
+            call_command('set_fx_rate', CURRENCY_EUR, CURRENCY_USD, 'abc')
+        with self.assertRaises(CommandError):
+            call_command('set_fx_rate', CURRENCY_EUR, CURRENCY_USD, '-1')
+
+
+@skipUnless(
+    {'shard_1', 'shard_2'} <= set(settings.DATABASES), "Shard databases are configured with PAYMENTS_SHARDS=3",
+)
+@override_settings(ACCOUNT_SHARDS=['default', 'shard_1', 'shard_2'])
+class ShardingTestCase(TransactionTestCase):
+    """
+    Shards are local SQLite databases of settings, accounts are placed so that `acc_1` is in `shard_2`,
+    `acc_2` and `acc_3` are in `shard_1` and `acc_5` is in the default database
+    """
+    # the test database of a shard is created only, if the shard is configured
+    databases = {'default', 'shard_1', 'shard_2'} & set(settings.DATABASES)
+
+    def setUp(self):
+        self.client = APIClient()
+        balances.clear()
+        idempotency._responses.clear()
+        for account_id, owner, balance, currency in (
+            ('acc_1', 'owner_1', 100, CURRENCY_PHP),
+            ('acc_2', 'owner_1', 50, CURRENCY_PHP),
+            ('acc_3', 'owner_2', 0, CURRENCY_PHP),
+            ('acc_5', 'owner_2', 20, CURRENCY_PHP),
+        ):
+            # new accounts are saved into their shards by the router
+            Account(id=account_id, owner=owner, balance=balance, currency=currency).save()
+
+    def _account(self, account_id):
+        return Account.objects.using(sharding.shard_for(account_id)).get(pk=account_id)
+
+    def _balances(self):
+        return {
+            account_id: (account.balance, account.sequence, account.held)
+            for account_id, account in ((account_id, self._account(account_id)) for account_id in (
+                'acc_1', 'acc_2', 'acc_3', 'acc_5',
+            ))
+        }
+
+    def _start_transfer(self, transfer_id, from_account_id, to_account_id, amount):
+        # a transfer, whose coordinator stopped after preparing both of its sides
+        transfer = CrossShardTransfer.objects.create(
+            id=transfer_id, from_account=from_account_id, to_account=to_account_id, amount=amount,
+            currency=CURRENCY_PHP,
+        )
+        transfer._prepare_side(PreparedTransfer.SIDE_DEBIT)
+        transfer._prepare_side(PreparedTransfer.SIDE_CREDIT)
+        return transfer
+
+    def test_router(self):
+        placement = {
+            alias: set(Account.objects.using(alias).values_list('pk', flat=True))
+            for alias in sharding.shards()
+        }
+        self.assertEqual(placement, {'default': {'acc_5'}, 'shard_1': {'acc_2', 'acc_3'}, 'shard_2': {'acc_1'}})
+        self.assertEqual(OwnerTotal.objects.using('shard_1').get(owner='owner_1').balance, 50)
+
+    def test_same_shard_pay(self):
+        self._account('acc_2').pay(self._account('acc_3'), Decimal(20), CURRENCY_PHP)
+        payment = Payment.objects.using('shard_1').get()
+        self.assertEqual((payment.from_sequence, payment.to_sequence), (1, 1))
+        self.assertFalse(CrossShardTransfer.objects.exists())
+        self.assertFalse(Payment.objects.using('shard_2').exists())
+        self.assertEqual(self._balances()['acc_3'], (20, 1, 0))
+
+    def test_cross_shard_pay(self):
+        from_account, to_account = self._account('acc_1'), self._account('acc_2')
+        payment = from_account.pay(to_account, Decimal(30), CURRENCY_PHP)
+        self.assertEqual((from_account.balance, from_account.sequence), (70, 1))
+        self.assertEqual((to_account.balance, to_account.sequence), (80, 1))
+        self.assertEqual(self._balances(), {
+            'acc_1': (70, 1, 0), 'acc_2': (80, 1, 0), 'acc_3': (0, 0, 0), 'acc_5': (20, 0, 0),
+        })
+
+        # both shards store the payment with the same id, as an entry of the ledger of their account only
+        self.assertEqual(
+            list(Payment.objects.using('shard_2').values_list('pk', 'from_sequence', 'to_sequence')),
+            [(payment.pk, 1, 0)],
+        )
+        self.assertEqual(
+            list(Payment.objects.using('shard_1').values_list('pk', 'from_sequence', 'to_sequence')),
+            [(payment.pk, 0, 1)],
+        )
+        self.assertEqual(CrossShardTransfer.objects.get().state, CrossShardTransfer.STATE_COMMITTED)
+        for alias in ('shard_1', 'shard_2'):
+            self.assertEqual(PreparedTransfer.objects.using(alias).get().state, PreparedTransfer.STATE_COMMITTED)
+            self.assertEqual(list(ledger.check_accounts(using=alias)), [])
+        self.assertEqual(ledger.balance_at('acc_1', timezone.now()), (70, 1))
+        self.assertEqual(ledger.balance_at('acc_2', timezone.now()), (80, 1))
+        self.assertEqual(OwnerTotal.objects.using('shard_2').get(owner='owner_1').balance, 70)
+        self.assertEqual(OwnerTotal.objects.using('shard_1').get(owner='owner_1').balance, 80)
+
+        # an invalid transfer is aborted in both shards, and nothing is held
+        with self.assertRaises(InsufficientBalance):
+            self._account('acc_3').pay(self._account('acc_5'), Decimal(1), CURRENCY_PHP)
+        aborted = CrossShardTransfer.objects.exclude(pk=payment.pk).get()
+        self.assertEqual(aborted.state, CrossShardTransfer.STATE_ABORTED)
+        self.assertEqual(
+            set(PreparedTransfer.objects.using('default').values_list('transfer_id', 'state')),
+            {(aborted.pk, PreparedTransfer.STATE_ABORTED)},
+        )
+        with self.assertRaises(UnknownAccount):
+            CrossShardTransfer.transfer('acc_1', 'acc_4', Decimal(1), CURRENCY_PHP)
+        self.assertEqual(self._balances()['acc_1'], (70, 1, 0))
+
+        # every step of a cross-shard transfer is committed on its own
+        with transaction.atomic(), self.assertRaises(transaction.TransactionManagementError):
+            self._account('acc_1').pay(self._account('acc_5'), Decimal(1), CURRENCY_PHP)
+
+    def test_recovery(self):
+        # a prepared debit holds the amount, so it can not be spent by local transfers
+        self._start_transfer(9000, 'acc_1', 'acc_2', Decimal(80))
+        self.assertEqual(self._balances()['acc_1'], (100, 0, 80))
+        Account(id='acc_8', owner='owner_3', currency=CURRENCY_PHP).save()
+        with self.assertRaises(InsufficientBalance):
+            self._account('acc_1').pay(self._account('acc_8'), Decimal(30), CURRENCY_PHP)
+        results = Account.pay_batch([('acc_1', 'acc_8', Decimal(30), CURRENCY_PHP)])
+        self.assertEqual(results[0].code, 'insufficient_balance')
+
+        # undecided transfers are aborted after the timeout only
+        call_command('recover_transfers', stdout=StringIO())
+        self.assertEqual(CrossShardTransfer.objects.get().state, CrossShardTransfer.STATE_PREPARING)
+        out = StringIO()
+        call_command('recover_transfers', timeout=-1, stdout=out)
+        self.assertEqual(out.getvalue(), "Finished 1 transfers\n")
+        self.assertEqual(CrossShardTransfer.objects.get().state, CrossShardTransfer.STATE_ABORTED)
+        self.assertEqual(self._balances()['acc_1'], (100, 0, 0))
+        self.assertEqual(self._balances()['acc_2'], (50, 0, 0))
+
+        # decided transfers are committed
+        transfer = self._start_transfer(9001, 'acc_1', 'acc_2', Decimal(80))
+        self.assertTrue(transfer._change_state(CrossShardTransfer.STATE_PREPARING, CrossShardTransfer.STATE_COMMITTING))
+        self.assertEqual(CrossShardTransfer.recover(timezone.now()), 1)
+        self.assertEqual(CrossShardTransfer.objects.get(pk=9001).state, CrossShardTransfer.STATE_COMMITTED)
+        self.assertEqual(self._balances()['acc_1'], (20, 1, 0))
+        self.assertEqual(self._balances()['acc_2'], (130, 1, 0))
+        # committing again changes nothing
+        self.assertEqual(transfer.commit().pk, 9001)
+        self.assertEqual(self._balances()['acc_1'], (20, 1, 0))
+        self.assertEqual(CrossShardTransfer.recover(timezone.now()), 0)
+
+    def test_aborted_transfer_api(self):
+        prepare_side = CrossShardTransfer._prepare_side
+
+        def recovering_prepare_side(transfer, side, idempotency_key=None):
+            prepare_side(transfer, side, idempotency_key)
+            if side == PreparedTransfer.SIDE_CREDIT:
+                # recovery aborts the transfer, that is prepared for too long, before its coordinator decides it
+                CrossShardTransfer.recover(timezone.now() + timedelta(minutes=1))
+
+        body = {'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '10', 'currency': CURRENCY_PHP}
+        with mock.patch.object(CrossShardTransfer, '_prepare_side', recovering_prepare_side):
+            response = self.client.post('/v1/payments', body, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'status': 'ERROR', 'error': 'transfer_aborted'})
+        self.assertEqual(CrossShardTransfer.objects.get().state, CrossShardTransfer.STATE_ABORTED)
+        self.assertEqual(self._balances()['acc_1'], (100, 0, 0))
+
+        # the request is retried
+        self.assertEqual(self.client.post('/v1/payments', body, format='json').status_code, 201)
+        self.assertEqual(self._balances()['acc_1'], (90, 1, 0))
+
+    def test_converted_cross_shard_pay(self):
+        FxRate.set_rate(CURRENCY_PHP, CURRENCY_USD, Decimal('0.02'))
+        Account(id='acc_4', owner='owner_2', currency=CURRENCY_USD).save()
+        from_account, to_account = self._account('acc_1'), self._account('acc_4')
+        payment = from_account.pay(to_account, Decimal(50), CURRENCY_PHP, to_currency=CURRENCY_USD)
+        self.assertEqual((payment.to_amount, payment.rate_version), (1, 1))
+        self.assertEqual((from_account.balance, to_account.balance), (50, 1))
+        self.assertEqual(
+            Payment.objects.using('shard_1').values_list('pk', 'amount', 'to_amount', 'to_currency').get(),
+            (payment.pk, 50, 1, CURRENCY_USD),
+        )
+        self.assertEqual(list(ledger.check_accounts(using='shard_1')), [])
+        self.assertEqual(OwnerTotal.objects.using('shard_1').get(owner='owner_2', currency=CURRENCY_USD).balance, 1)
+
+        # the credit side is prepared in the currency of the destination account
+        with self.assertRaises(InvalidAccountCurrency):
+            from_account.pay(to_account, Decimal(1), CURRENCY_PHP)
+        self.assertEqual(self._balances()['acc_1'], (50, 1, 0))
+
+    def test_batches(self):
+        results = Account.pay_batch([
+            ('acc_2', 'acc_3', Decimal(5), CURRENCY_PHP), ('acc_1', 'acc_2', Decimal(5), CURRENCY_PHP),
+        ])
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], CrossShardBatch)
+        self.assertFalse(Payment.objects.using('shard_1').exists())
+
+        results = Account.pay_batch([
+            ('acc_2', 'acc_3', Decimal(5), CURRENCY_PHP),
+            ('acc_3', 'acc_1', Decimal(10), CURRENCY_PHP),
+            ('acc_1', 'acc_5', Decimal(10), CURRENCY_PHP),
+            ('acc_3', 'acc_2', Decimal(5), CURRENCY_PHP),
+        ], atomic=False)
+        self.assertEqual([error and error.code for error in results], [None, 'insufficient_balance', None, None])
+        self.assertEqual(self._balances(), {
+            'acc_1': (90, 1, 0), 'acc_2': (50, 2, 0), 'acc_3': (0, 2, 0), 'acc_5': (30, 1, 0),
+        })
+
+    def test_queue_order_after_stopped_worker(self):
+        first, second, _ = (
+            transfer_queue.enqueue(self._account(from_id), self._account(to_id), Decimal(amount), CURRENCY_PHP)
+            for from_id, to_id, amount in (('acc_1', 'acc_2', 60), ('acc_1', 'acc_3', 50), ('acc_2', 'acc_3', 5))
+        )
+        # the worker of the first transfer stopped just now, before making it
+        QueuedTransfer.objects.filter(pk=first.pk).update(
+            status=QueuedTransfer.STATUS_PROCESSING, processed_at=timezone.now(),
+        )
+        # the second transfer is not made before it, transfers of other accounts are
+        self.assertEqual(transfer_queue.process_batch(), 1)
+        self.assertEqual(
+            list(QueuedTransfer.objects.values_list('status', flat=True)),
+            [QueuedTransfer.STATUS_PROCESSING, QueuedTransfer.STATUS_QUEUED, QueuedTransfer.STATUS_CREATED],
+        )
+        self.assertEqual(transfer_queue.process_batch(), 0)
+
+        # both are made in their order, once the first one is taken again
+        QueuedTransfer.objects.filter(pk=first.pk).update(processed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(transfer_queue.process_batch(), 2)
+        self.assertEqual(
+            list(QueuedTransfer.objects.filter(pk__in=(first.pk, second.pk)).values_list('status', 'error')),
+            [(QueuedTransfer.STATUS_CREATED, ''), (QueuedTransfer.STATUS_ERROR, 'insufficient_balance')],
+        )
+        self.assertEqual(self._balances()['acc_1'], (40, 1, 0))
+
+    def test_lists(self):
+        self._account('acc_1').pay(self._account('acc_2'), Decimal(30), CURRENCY_PHP)
+        self._account('acc_2').pay(self._account('acc_3'), Decimal(10), CURRENCY_PHP)
+        self._account('acc_5').pay(self._account('acc_1'), Decimal(5), CURRENCY_PHP)
+        payment_ids = list(CrossShardTransfer.objects.values_list('pk', flat=True))
+        payment_ids.extend(Payment.objects.using('shard_1').filter(from_account='acc_2').values_list('pk', flat=True))
+        payment_ids.sort()
+
+        response = self.client.get('/v1/accounts', {'page_size': 3}, format='json')
+        self.assertEqual([item['id'] for item in response.json()['results']], ['acc_1', 'acc_2', 'acc_3'])
+        response = self.client.get(response.json()['next'], format='json')
+        self.assertEqual(response.json()['results'], [
+            {'id': 'acc_5', 'owner': 'owner_2', 'balance': '15.0000', 'currency': CURRENCY_PHP},
+        ])
+        response = self.client.get('/v1/owners/owner_1/accounts', format='json')
+        self.assertEqual([(item['id'], item['balance']) for item in response.json()], [
+            ('acc_1', '75.0000'), ('acc_2', '70.0000'),
+        ])
+
+        # transfers between shards are listed once
+        response = self.client.get('/v1/payments', format='json')
+        self.assertEqual(
+            [(item['direction'], item['from_account'], item['to_account']) for item in response.json()['results']],
+            [
+                (PAYMENT_DIRECTIONS_INCOMING, 'acc_1', 'acc_5'), (PAYMENT_DIRECTIONS_OUTGOING, 'acc_5', 'acc_1'),
+                (PAYMENT_DIRECTIONS_INCOMING, 'acc_3', 'acc_2'), (PAYMENT_DIRECTIONS_OUTGOING, 'acc_2', 'acc_3'),
+                (PAYMENT_DIRECTIONS_INCOMING, 'acc_2', 'acc_1'), (PAYMENT_DIRECTIONS_OUTGOING, 'acc_1', 'acc_2'),
+            ],
+        )
+        response = self.client.get('/v1/payments', {'to_account': 'acc_1'}, format='json')
+        self.assertEqual(
+            [(item['from_account'], item['amount']) for item in response.json()['results']],
+            [('acc_5', '5.0000'), ('acc_2', '30.0000')],
+        )
+        response = self.client.get('/v1/payments/export.ndjson')
+        self.assertEqual(
+            [json.loads(line)['id'] for line in b''.join(response.streaming_content).decode().splitlines()],
+            payment_ids,
+        )
+
+        # totals of owners are summed from totals of shards
+        response = self.client.get('/v1/owners', format='json')
+        self.assertEqual(
+            [
+                (item['owner'], item['accounts'], item['balance'], item['incoming'])
+                for item in response.json()['results']
+            ],
+            [('owner_1', 2, '145.0000', '35.0000'), ('owner_2', 2, '25.0000', '10.0000')],
+        )
+
+    def test_feed(self):
+        with mock.patch.object(PaymentIdBlock, 'take', side_effect=[[100], [50]]):
+            self._account('acc_1').pay(self._account('acc_2'), Decimal(30), CURRENCY_PHP)
+            # transfers between shards are listed once
+            data = self.client.get('/v1/payments/feed', format='json').json()
+            self.assertEqual([payment['id'] for payment in data['payments']], [100])
+            # a transfer of another shard with a lower id, that is committed after the read
+            self._account('acc_2').pay(self._account('acc_3'), Decimal(10), CURRENCY_PHP)
+        payment = self._account('acc_5').pay(self._account('acc_1'), Decimal(5), CURRENCY_PHP)
+
+        data = self.client.get('/v1/payments/feed', {'since': data['next']}, format='json').json()
+        # transfers committed before one read are in the order of shards
+        self.assertCountEqual([payment['id'] for payment in data['payments']], [50, payment.pk])
+        self.assertEqual(self.client.get('/v1/payments/feed', {'since': data['next']}).json()['payments'], [])
+
+    def test_idempotency_and_queue(self):
+        body = {'from_account': 'acc_1', 'to_account': 'acc_2', 'amount': '10', 'currency': CURRENCY_PHP}
+        for _ in range(2):
+            response = self.client.post('/v1/payments', body, format='json', HTTP_IDEMPOTENCY_KEY='key_1')
+            self.assertEqual(response.status_code, 201)
+            idempotency._responses.clear()
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(IdempotencyKey.objects.using('shard_2').get().payment_id, CrossShardTransfer.objects.get().pk)
+        self.assertEqual(self._balances()['acc_1'], (90, 1, 0))
+
+        queued_ids = [
+            self.client.post('/v1/payments', body, format='json', HTTP_PREFER='respond-async').data['id']
+            for body in (
+                body, {'from_account': 'acc_2', 'to_account': 'acc_3', 'amount': '5', 'currency': CURRENCY_PHP},
+            )
+        ]
+        self.assertEqual(transfer_queue.process_batch(), 2)
+        self.assertEqual(
+            list(QueuedTransfer.objects.values_list('status', flat=True)),
+            [QueuedTransfer.STATUS_CREATED, QueuedTransfer.STATUS_CREATED],
+        )
+        self.assertEqual(self._balances()['acc_1'], (80, 2, 0))
+        self.assertEqual(self._balances()['acc_3'], (5, 1, 0))
+
+        # transfers of a stopped worker are taken again, but they are not made twice
+        QueuedTransfer.objects.filter(pk__in=queued_ids).update(
+            status=QueuedTransfer.STATUS_PROCESSING, processed_at=timezone.now() - timedelta(hours=1),
+        )
+        self.assertEqual(transfer_queue.process_batch(), 2)
+        self.assertEqual(
+            list(QueuedTransfer.objects.values_list('status', 'payment_id')),
+            [
+                (QueuedTransfer.STATUS_CREATED, Payment.objects.using('shard_2').get(amount=10, from_sequence=2).pk),
+                (QueuedTransfer.STATUS_CREATED, Payment.objects.using('shard_1').get(from_account='acc_2').pk),
+            ],
+        )
+        self.assertEqual(self._balances()['acc_1'], (80, 2, 0))
+        self.assertEqual(self._balances()['acc_3'], (5, 1, 0))
@@ -0,0 +1,150 @@
+"""
+Asynchronous transfers.
+
+Transfers submitted with `Prefer: respond-async` header are only stored as `QueuedTransfer` rows, that is one insert
+without any locks of accounts. The worker (`manage.py process_transfer_queue`) makes them in group commits:
+many transfers in one transaction, with one update of every changed balance, see `Account.pay_group`.
+Transfers are made strictly in the order of submission, so the order of transfers from every source account
+is preserved too. Concurrent workers are serialized by row locks of the queue, where the database has them.
+
+With several shards, payments are not written in the database of the queue, so transfers are taken by the worker
+in one transaction, made in transactions of their shards, and marked processed in another one. Every transfer
+is made with an idempotency key of its own, so a transfer, whose worker stopped before marking it, is taken again
+after PROCESSING_TIMEOUT and is not made twice. Until then newer transfers from its source account are left queued,
+as are ones, whose older transfers are made by other workers, so the order of every source account is preserved.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from http import HTTPStatus
+from typing import Dict, List, Optional, Union
+
+from django.db import connection, transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from core import idempotency, sharding
+from core.models import Account, IdempotencyKey, Payment, QueuedTransfer
+
+DEFAULT_BATCH_SIZE = 500
+PROCESSING_TIMEOUT = timedelta(minutes=1)
+
+
+def prefers_async(request) -> bool:
+    preferences = request.META.get('HTTP_PREFER', '').split(',')
+    return any(preference.split(';')[0].strip().lower() == 'respond-async' for preference in preferences)
+
+
+def enqueue(
+    from_account: Account, to_account: Account, amount: Decimal, currency: str, to_currency: Optional[str] = None,
+) -> QueuedTransfer:
+    return QueuedTransfer.objects.create(
+        from_account=from_account, to_account=to_account, amount=amount, currency=currency,
+        to_currency=to_currency if to_currency not in (None, currency) else '',
+    )
+
+
+def process_batch(batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Makes up to `batch_size` oldest queued transfers in one transaction, returns their number
+    """
+    if sharding.is_sharded():
+        return _process_sharded_batch(batch_size)
+
+    with transaction.atomic():
+        queued = QueuedTransfer.objects.filter(status=QueuedTransfer.STATUS_QUEUED).order_by('pk')
+        if connection.features.has_select_for_update:
+            queued = queued.select_for_update()
+        queued = list(queued[:batch_size])
+        if not queued:
+            return 0
+
+        results = Account.pay_group([_transfer(item) for item in queued])
+        _save_results(queued, results)
+    return len(queued)
+
+
+def _process_sharded_batch(batch_size: int) -> int:
+    now = timezone.now()
+    with transaction.atomic():
+        stale = Q(status=QueuedTransfer.STATUS_PROCESSING, processed_at__lt=now - PROCESSING_TIMEOUT)
+        queued = QueuedTransfer.objects.filter(Q(status=QueuedTransfer.STATUS_QUEUED) | stale).order_by('pk')
+        if connection.features.has_select_for_update:
+            queued = queued.select_for_update()
+        queued = _in_order(list(queued[:batch_size]))
+        if not queued:
+            return 0
+        QueuedTransfer.objects.filter(pk__in=[item.pk for item in queued]).update(
+            status=QueuedTransfer.STATUS_PROCESSING, processed_at=now,
+        )
+
+    keys = {_key(item): item for item in queued}
+    made = _made_payments(keys)
+    # transfers, whose payments are neither made nor aborted yet, are taken again after recovery of them
+    pending = [item for item in queued if _key(item) not in made]
+    results = Account.pay_group(
+        [_transfer(item) for item in pending],
+        [
+            idempotency.new_record(_key(item), '', HTTPStatus.CREATED, {'status': QueuedTransfer.STATUS_CREATED})
+            for item in pending
+        ],
+    ) if pending else []
+
+    done = [keys[key] for key, payment_id in made.items() if payment_id is not None]
+    with transaction.atomic():
+        _save_results(pending + done, results + [Payment(pk=made[_key(item)]) for item in done])
+    return len(queued)
+
+
+def _in_order(queued: List[QueuedTransfer]) -> List[QueuedTransfer]:
+    """
+    Taken transfers without ones, that would be made before older unfinished transfers of their source accounts,
+    that are not taken: ones made by other workers, or left by stopped workers before PROCESSING_TIMEOUT.
+    Transfers are read again after `queued` are locked, so ones taken by other workers meanwhile are unfinished.
+    """
+    if not queued:
+        return queued
+    older = dict(
+        QueuedTransfer.objects.filter(
+            status__in=(QueuedTransfer.STATUS_QUEUED, QueuedTransfer.STATUS_PROCESSING), pk__lt=queued[-1].pk,
+            from_account__in={item.from_account_id for item in queued},
+        ).exclude(pk__in=[item.pk for item in queued]).order_by().values_list('from_account').annotate(Min('pk'))
+    )
+    return [item for item in queued if item.from_account_id not in older or item.pk < older[item.from_account_id]]
+
+
+def _transfer(item: QueuedTransfer) -> tuple:
+    return item.from_account_id, item.to_account_id, item.amount, item.currency, item.to_currency or item.currency
+
+
+def _key(item: QueuedTransfer) -> str:
+    return 'queued-transfer:{}'.format(item.pk)
+
+
+def _made_payments(keys: Dict[str, QueuedTransfer]) -> Dict[str, Optional[int]]:
+    """
+    Ids of payments of keys, that were saved by earlier attempts of transfers, or None, if their payments
+    are not committed yet
+    """
+    made = {}
+    for alias in sharding.shards():
+        payment_ids = dict(IdempotencyKey.objects.using(alias).filter(key__in=keys).values_list('key', 'payment_id'))
+        if not payment_ids:
+            continue
+        committed = set(
+            Payment.objects.using(alias).filter(pk__in=payment_ids.values()).values_list('pk', flat=True)
+        )
+        made.update((key, pk if pk in committed else None) for key, pk in payment_ids.items())
+    return made
+
+
+def _save_results(queued: List[QueuedTransfer], results: List[Union[Payment, Exception]]):
+    processed_at = timezone.now()
+    for item, result in zip(queued, results):
+        if isinstance(result, Exception):
+            item.status = QueuedTransfer.STATUS_ERROR
+            item.error = result.code
+        else:
+            item.status = QueuedTransfer.STATUS_CREATED
+            item.payment = result
+        item.processed_at = processed_at
+    QueuedTransfer.objects.bulk_update(queued, ('status', 'error', 'payment', 'processed_at'))
@@ -2,11 +2,32 @@ from django.conf.urls import url
 from core import views
 from django.urls import include
 
-v1_patterns = [
-    url(r'^accounts$', views.AccountsList.as_view()),
-    url(r'^payments$', views.PaymentsList.as_view()),
-]
-
-urlpatterns = [
-    url(r'^v1/', include(v1_patterns)),
-]
+
+def v1_patterns(async_reads: bool = False) -> list:
+    reads = views.async_reads if async_reads else (lambda view: view)
+    long_polls = views.async_long_polls if async_reads else (lambda view: view)
+    return [
+        url(r'^accounts$', reads(views.AccountsList.as_view())),
+        url(r'^accounts/(?P<pk>[^/]+)$', views.AccountDetail.as_view()),
+        url(r'^accounts/(?P<pk>[^/]+)/balance$', views.AccountBalance.as_view()),
+        url(r'^fx-rates$', views.FxRatesList.as_view()),
+        url(r'^owners$', views.OwnerTotalsList.as_view()),
+        url(r'^owners/(?P<owner>[^/]+)/accounts$', views.OwnerAccountsList.as_view()),
+        url(r'^payments$', reads(views.PaymentsList.as_view())),
+        url(r'^payments/batch$', views.PaymentsBatch.as_view()),
+        url(r'^payments/queue/(?P<pk>\d+)$', views.QueuedTransferDetail.as_view()),
+        url(r'^payments/dry-run$', views.PaymentsDryRun.as_view()),
+        url(r'^payments/feed$', long_polls(views.PaymentsFeed.as_view())),
+        url(r'^payments/export\.(?P<export_format>json|ndjson)$', views.PaymentsExport.as_view()),
+        url(r'^stats/balance-cache$', views.BalanceCacheStats.as_view()),
+    ]
+
+
+def build_urlpatterns(async_reads: bool = False) -> list:
+    return [
+        url(r'^v1/', include(v1_patterns(async_reads))),
+        url(r'^metrics$', views.Metrics.as_view()),
+    ]
+
+
+urlpatterns = build_urlpatterns()
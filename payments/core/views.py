@@ -1,28 +1,450 @@
+import functools
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.db.models import Sum
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import generics, mixins, status
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.fields import DateTimeField
+from rest_framework.settings import api_settings
 
-from core.models import Account, Payment
-from core.serializers import AccountSerializer, PaymentSerializer
+from core import (
+    balances, conditional, export, feed, idempotency, ledger, metrics, provisioning, sharding, transfer_queue,
+)
+from core.errors import (
+    IdempotencyKeyReused, InsufficientBalance, InvalidAccountCurrency, InvalidAmount, TransferAborted, UnknownAccount,
+    UnknownFxRate,
+)
+from core.filters import AccountsFilter, OwnerTotalsFilter, PaymentsFilter
+from core.models import Account, FxRate, OwnerTotal, OwnerVolume, Payment, QueuedTransfer
+from core.pagination import KeysetPagination, LegsPagination
+from core.renderers import ColumnsRenderer
+from core.serializers import (
+    AccountBalanceSerializer, AccountSerializer, AccountsCreateSerializer, FxRateSerializer, OwnerTotalSerializer,
+    PaymentBatchSerializer, PaymentSerializer, PaymentsFeedSerializer, QueuedTransferSerializer,
+)
 from rest_framework.response import Response
 
+# errors of transfers, that valid requests are rejected with
+TRANSFER_ERRORS = (InsufficientBalance, InvalidAccountCurrency, InvalidAmount, UnknownAccount, UnknownFxRate)
+
 
 class AccountsList(mixins.ListModelMixin, generics.GenericAPIView):
     queryset = Account.objects.all()
     serializer_class = AccountSerializer
+    pagination_class = KeysetPagination
+    filter_backends = (AccountsFilter,)
+    renderer_classes = (*api_settings.DEFAULT_RENDERER_CLASSES, ColumnsRenderer)
+
+    @conditional.conditional_list
+    def get(self, request, *args, **kwargs):
+        return self.list(request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        # only ids of accounts are read from the table, their representations come from the balance cache
+        queryset = sharding.fan_out(self.filter_queryset(self.get_queryset())).only('pk')
+        page = self.paginate_queryset(queryset)
+        data = balances.get_accounts(
+            (acc.pk for acc in (queryset if page is None else page)), conditional.read_versions(request)[0],
+        )
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+    def post(self, request, format=None):
+        """
+        Creates many accounts with opening balances at once, invalid and duplicate ones are rejected one by one
+        """
+        serializer = AccountsCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = serializer.validated_data['accounts']
+        results = [{'status': 'CREATED'} for _ in rows]
+        for _, rejections in provisioning.import_accounts(rows):
+            for number, _, error in rejections:
+                results[number - 1] = _error_result(error)
+        return Response({'status': 'PROCESSED', 'results': results}, status=status.HTTP_201_CREATED)
+
+
+class AccountDetail(generics.GenericAPIView):
+    serializer_class = AccountSerializer
+
+    def get(self, request, pk, format=None):
+        accounts = balances.get_accounts([pk])
+        if not accounts:
+            raise NotFound()
+        return Response(accounts[0])
+
+
+class AccountBalance(generics.GenericAPIView):
+    """
+    Balance of the account at the time of `at` query param, the current one by default
+    """
+    serializer_class = AccountBalanceSerializer
+
+    def get(self, request, pk, format=None):
+        at = request.query_params.get('at')
+        if not at:
+            at = timezone.now()
+        else:
+            try:
+                at = DateTimeField().to_internal_value(at)
+            except ValidationError as e:
+                raise ValidationError({'at': e.detail})
+        try:
+            balance, sequence = ledger.balance_at(pk, at)
+        except UnknownAccount:
+            raise NotFound()
+        return Response(AccountBalanceSerializer({'id': pk, 'at': at, 'balance': balance, 'sequence': sequence}).data)
+
+
+class FxRatesList(generics.GenericAPIView):
+    """
+    Current rates of conversion between currencies, from memory of the process, see `FxRate.current`
+    """
+    serializer_class = FxRateSerializer
+
+    def get(self, request, format=None):
+        rates = [
+            {'from_currency': from_currency, 'to_currency': to_currency, 'rate': rate, 'version': version}
+            for (from_currency, to_currency), (rate, version) in sorted(FxRate.current().items())
+        ]
+        return Response(FxRateSerializer(rates, many=True).data)
+
+
+class OwnerAccountsList(generics.GenericAPIView):
+    serializer_class = AccountSerializer
+
+    def get(self, request, owner, format=None):
+        return Response(balances.get_accounts(balances.get_owner_account_ids(owner)))
+
+
+class OwnerTotalsList(mixins.ListModelMixin, generics.GenericAPIView):
+    """
+    Totals of owners by currencies, with volumes of their payments during the last `days` days, today included.
+    Totals and daily volumes are maintained by payments, so a page is read with two queries per shard, whatever
+    the number of accounts and payments is.
+    """
+    queryset = OwnerTotal.objects.all()
+    serializer_class = OwnerTotalSerializer
+    pagination_class = KeysetPagination
+    filter_backends = (OwnerTotalsFilter,)
+    default_days = 30
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
+    def list(self, request, *args, **kwargs):
+        try:
+            days = int(request.query_params.get('days', self.default_days))
+        except ValueError:
+            raise ValidationError({'days': ['A valid integer is required.']})
+        if days < 1:
+            raise ValidationError({'days': ['Ensure this value is greater than or equal to 1.']})
+
+        queryset = sharding.fan_out(self.filter_queryset(self.get_queryset()), combine=OwnerTotal.combine)
+        page = self.paginate_queryset(queryset)
+        totals = list(queryset if page is None else page)
+        self.add_volumes(totals, timezone.localdate() - timedelta(days=days - 1))
+        data = OwnerTotalSerializer(totals, many=True).data
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+    @staticmethod
+    def add_volumes(totals: List[OwnerTotal], since):
+        volumes = defaultdict(lambda: (0, 0, 0, 0))
+        for alias in sharding.shards():
+            for owner, currency, *row in OwnerVolume.objects.using(alias).filter(
+                owner__in={total.owner for total in totals}, day__gte=since,
+            ).order_by().values_list('owner', 'currency').annotate(
+                Sum('outgoing'), Sum('outgoing_payments'), Sum('incoming'), Sum('incoming_payments'),
+            ):
+                volumes[(owner, currency)] = tuple(map(sum, zip(volumes[(owner, currency)], row)))
+        for total in totals:
+            total.outgoing, total.outgoing_payments, total.incoming, total.incoming_payments = volumes[
+                (total.owner, total.currency)
+            ]
+
+
+class BalanceCacheStats(generics.GenericAPIView):
+    def get(self, request, format=None):
+        return Response(balances.stats())
+
+
+class Metrics(generics.GenericAPIView):
+    def get(self, request, format=None):
+        return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 
 class PaymentsList(mixins.ListModelMixin, generics.GenericAPIView):
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
+    pagination_class = LegsPagination
+    filter_backends = (PaymentsFilter,)
+    renderer_classes = (*api_settings.DEFAULT_RENDERER_CLASSES, ColumnsRenderer)
 
+    @conditional.conditional_list
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
+    def list(self, request, *args, **kwargs):
+        # pages are made of stored transfers, and every transfer is listed as its incoming and outgoing payments
+        queryset = sharding.fan_out(self.filter_queryset(self.get_queryset())).values_list(
+            *PaymentSerializer.fast_columns, named=True,
+        )
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response([leg for legs in self.get_legs(queryset) for leg in legs])
+        # legs of the page are built by the paginator, that counts them
+        return self.get_paginated_response(self.paginator.legs)
+
+    def get_legs(self, rows) -> List[List[dict]]:
+        """
+        Matching legs of every transfer of `values_list(*PaymentSerializer.fast_columns)` rows
+        """
+        legs = PaymentSerializer.fast_legs(rows)
+        leg_filter = PaymentsFilter()
+        # every transfer has two legs, see `fast_legs`
+        return [leg_filter.filter_legs(self.request, legs[i:i + 2]) for i in range(0, len(legs), 2)]
+
     def post(self, request, format=None):
+        key = idempotency.get_key(request)
+        if key is not None:
+            fingerprint = idempotency.fingerprint(request.data)
+            try:
+                response = idempotency.get_response(key, fingerprint)
+            except IdempotencyKeyReused as e:
+                return Response(_error_result(e), status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if response is not None:
+                return self._replay(response)
+
         serializer = PaymentSerializer(data=request.data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response({'status': 'CREATED'}, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        if key is None and transfer_queue.prefers_async(request):
+            return self._enqueue(serializer.validated_data)
+
+        body = {'status': 'CREATED'}
+        record = None if key is None else idempotency.new_record(key, fingerprint, status.HTTP_201_CREATED, body)
+        try:
+            serializer.save(idempotency_key=record)
+        except TRANSFER_ERRORS as e:
+            # rejected payments are answered as dry runs of them are, see `PaymentsDryRun`
+            return Response(_error_result(e), status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        except TransferAborted as e:
+            # the cross-shard transfer was aborted by recovery, nothing is paid, and the request may be retried
+            return Response(_error_result(e), status=status.HTTP_409_CONFLICT)
+        except IntegrityError:
+            if record is None:
+                raise
+            # concurrent request with the same key has won, its payment is the only one made
+            try:
+                response = idempotency.get_response(key, fingerprint)
+            except IdempotencyKeyReused as e:
+                return Response(_error_result(e), status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if response is None:
+                raise
+            return self._replay(response)
+        if record is not None:
+            idempotency.remember(record)
+        return Response(body, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def _enqueue(validated_data):
+        queued = transfer_queue.enqueue(
+            validated_data['from_account'], validated_data['to_account'], validated_data['amount'],
+            validated_data['currency'], validated_data.get('to_currency'),
+        )
+        headers = {'Location': '/v1/payments/queue/{}'.format(queued.pk), 'Preference-Applied': 'respond-async'}
+        body = {'status': QueuedTransfer.STATUS_QUEUED, 'id': queued.pk}
+        return Response(body, status=status.HTTP_202_ACCEPTED, headers=headers)
+
+    @staticmethod
+    def _replay(response):
+        response_status, body = response
+        return Response(body, status=response_status, headers={'Idempotent-Replayed': 'true'})
+
+
+class QueuedTransferDetail(generics.GenericAPIView):
+    serializer_class = QueuedTransferSerializer
+
+    def get(self, request, pk, format=None):
+        queued = QueuedTransfer.objects.filter(pk=pk).first()
+        if queued is None:
+            raise NotFound()
+        return Response(QueuedTransferSerializer(queued).data)
+
+
+class PaymentsExport(generics.GenericAPIView):
+    def get(self, request, export_format, format=None):
+        try:
+            after_id = int(request.query_params.get('after', 0))
+        except ValueError:
+            raise ValidationError({'after': ['A valid integer is required.']})
+        return StreamingHttpResponse(
+            export.export_payments(export_format, after_id), content_type=export.CONTENT_TYPES[export_format]
+        )
+
+
+class PaymentsDryRun(generics.GenericAPIView):
+    serializer_class = PaymentSerializer
+
+    def post(self, request, format=None):
+        """
+        Validates the payment as POST /v1/payments does, but makes nothing, see `Account.check_pay`
+        """
+        serializer = PaymentSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        try:
+            data['from_account'].check_pay(
+                data['to_account'], data['amount'], data['currency'], data.get('to_currency'),
+            )
+        except TRANSFER_ERRORS as e:
+            return Response(_error_result(e), status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        return Response({'status': 'VALID'})
+
+
+class PaymentsFeed(generics.GenericAPIView):
+    def get(self, request, format=None):
+        """
+        Payments after the `since` cursor in the order of the feed, and the cursor of the next read, see `core.feed`.
+        With `wait`, a read, that finds none, waits for at most that number of seconds until new ones are committed
+        """
+        serializer = PaymentsFeedSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        query = serializer.validated_data
+        # under ASGI the request waits on the event loop between reads, see `async_long_polls`
+        timeout = 0 if getattr(request, 'waits_on_event_loop', False) else self.get_timeout(query)
+        payments, cursor = feed.wait_for_payments(
+            query.get('since', 0), query.get('limit', feed.DEFAULT_LIMIT), timeout,
+        )
+        return Response({'payments': payments, 'next': cursor})
+
+    @staticmethod
+    def get_timeout(query: dict) -> float:
+        return min(query.get('wait', 0), settings.PAYMENT_FEED_MAX_WAIT)
+
+
+class PaymentsBatch(generics.GenericAPIView):
+    serializer_class = PaymentBatchSerializer
+
+    def post(self, request, format=None):
+        serializer = PaymentBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        errors = serializer.save()
+        rejected = serializer.validated_data['mode'] == PaymentBatchSerializer.MODE_ALL_OR_NOTHING and any(errors)
+        results = []
+        for error in errors:
+            if error is None:
+                results.append({'status': 'NOT_CREATED' if rejected else 'CREATED'})
+                continue
+            results.append(_error_result(error))
+
+        if rejected:
+            return Response({'status': 'REJECTED', 'results': results}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'status': 'PROCESSED', 'results': results}, status=status.HTTP_201_CREATED)
+
+
+def _error_result(error: Exception) -> dict:
+    result = {'status': 'ERROR', 'error': error.code}
+    if getattr(error, 'account_ids', None):
+        result['account_ids'] = error.account_ids
+    if getattr(error, 'errors', None):
+        result['errors'] = error.errors
+    return result
+
+
+_read_executors = {}  # type: Dict[int, ThreadPoolExecutor]
+_read_executors_lock = threading.Lock()
+
+
+def _read_executor(threads: int) -> ThreadPoolExecutor:
+    with _read_executors_lock:
+        if threads not in _read_executors:
+            _read_executors[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='async-read')
+        return _read_executors[threads]
+
+
+def async_reads(view):
+    """
+    Async variant of the view for the ASGI handler. GET requests are handled, and their responses are rendered,
+    in the pool of ASYNC_READ_THREADS threads, so reads of the process run concurrently, and responses are sent
+    by the event loop, however slowly clients read them. Other requests are handled in the thread of sync code,
+    as the ones of sync views are, so writes, e.g. `Account.pay`, run in transactions as they do under WSGI.
+    """
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        threads = settings.ASYNC_READ_THREADS
+        if request.method not in ('GET', 'HEAD') or not threads:
+            return await sync_to_async(view)(request, *args, **kwargs)
+        read = sync_to_async(_read, thread_sensitive=False, executor=_read_executor(threads))
+        return await read(view, request, *args, **kwargs)
+
+    return async_view
+
+
+def async_long_polls(view):
+    """
+    Async variant of the change feed view for the ASGI handler. A read, that finds no new payments, waits for
+    commits on the event loop, see `feed.watch_commits`, and reads the database again in the pool of async reads
+    after every one of them and every PAYMENT_FEED_CHECK_INTERVAL seconds, so waiting requests hold no threads,
+    and reads of lists are not queued behind them.
+    """
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await sync_to_async(view)(request, *args, **kwargs)
+        threads = settings.ASYNC_READ_THREADS
+        if threads:
+            read = functools.partial(
+                sync_to_async(_read, thread_sensitive=False, executor=_read_executor(threads)), view,
+            )
+        else:
+            read = sync_to_async(view)
+        query = PaymentsFeedSerializer(data=request.GET)
+        deadline = time.monotonic() + (PaymentsFeed.get_timeout(query.validated_data) if query.is_valid() else 0)
+        request.waits_on_event_loop = True
+        with feed.watch_commits() as committed:
+            while True:
+                # commits made during the read are not missed, they set the event
+                committed.clear()
+                response = await read(request, *args, **kwargs)
+                remaining = deadline - time.monotonic()
+                if response.status_code != status.HTTP_200_OK or response.data['payments'] or remaining <= 0:
+                    return response
+                await feed.wait_for_commit(committed, min(remaining, settings.PAYMENT_FEED_CHECK_INTERVAL))
+
+    return async_view
+
+
+def _read(view, request, *args, **kwargs):
+    # threads of the pool are not the ones of requests, their connections are closed as request signals do
+    close_old_connections()
+    try:
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render') and not response.is_rendered:
+            started = time.perf_counter()
+            response.render()
+            request.render_seconds = time.perf_counter() - started
+        return response
+    finally:
+        close_old_connections()
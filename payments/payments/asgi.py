@@ -0,0 +1,17 @@
+"""
+ASGI config for payments project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Read endpoints of lists are async views under it, see `core.middleware.AsyncViewsMiddleware`.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "payments.settings")
+
+application = get_asgi_application()
@@ -43,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.AsyncViewsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,6 +85,113 @@ DATABASES = {
     }
 }
 
+# A local PostgreSQL instead of SQLite, e.g. to run benchmarks against
+if os.environ.get('PAYMENTS_POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['PAYMENTS_POSTGRES_DB'],
+        'USER': os.environ.get('PAYMENTS_POSTGRES_USER', ''),
+        'PASSWORD': os.environ.get('PAYMENTS_POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('PAYMENTS_POSTGRES_HOST', ''),
+        'PORT': os.environ.get('PAYMENTS_POSTGRES_PORT', ''),
+    }
+
+# SQLite databases tuned for concurrent workers, see `core.backends.sqlite3`: readers do not wait for writers
+# in WAL mode, commits are synced at checkpoints, transactions take the write lock when they begin and wait for
+# each other, and connections are reused by requests. PAYMENTS_SQLITE_PROFILE=production uses them
+SQLITE_PRODUCTION_PROFILE = {
+    'ENGINE': 'core.backends.sqlite3',
+    'CONN_MAX_AGE': 600,
+    'OPTIONS': {
+        'transaction_mode': 'IMMEDIATE',
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+            'cache_size': -64000,
+            'temp_store': 'MEMORY',
+            'mmap_size': 268435456,
+        },
+    },
+}
+
+# Accounts are sharded by hashes of their ids across ACCOUNT_SHARDS databases, see `core.sharding`.
+# PAYMENTS_SHARDS - 1 local SQLite shards are configured next to the default database, tests of shards need 3
+_shards = int(os.environ.get('PAYMENTS_SHARDS', 1))
+for _shard in range(1, _shards):
+    DATABASES['shard_{}'.format(_shard)] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_shard_{}.sqlite3'.format(_shard)),
+    }
+ACCOUNT_SHARDS = ['default'] + ['shard_{}'.format(_shard) for _shard in range(1, _shards)]
+
+if os.environ.get('PAYMENTS_SQLITE_PROFILE') == 'production':
+    for _database in DATABASES.values():
+        if _database['ENGINE'] == 'django.db.backends.sqlite3':
+            _database.update(SQLITE_PRODUCTION_PROFILE)
+
+DATABASE_ROUTERS = ['core.sharding.ShardRouter']
+
+
+# Django REST framework
+# http://www.django-rest-framework.org/api-guide/settings/
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.KeysetPagination',
+    # default page size of list endpoints, clients may override it with `page_size` up to
+    # `KeysetPagination.max_page_size`
+    'PAGE_SIZE': 100,
+}
+
+
+# Payments
+
+# responses to payment requests with `Idempotency-Key` header are kept for this number of seconds,
+# see `purge_idempotency_keys` command
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# number of the most recent idempotency keys, that are cached in memory of every process
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+# currencies and numbers of balance buckets of at most ACCOUNT_CACHE_SIZE accounts are cached in memory of every
+# process for ACCOUNT_CACHE_TTL seconds, payments are validated with them, see `Account.cached`
+ACCOUNT_CACHE_SIZE = 100000
+ACCOUNT_CACHE_TTL = 60
+
+# balances of accounts are saved as snapshots every this number of their ledger entries, so balances at any time
+# are found by reading at most this number of payments, see `core.ledger`
+BALANCE_SNAPSHOT_INTERVAL = 1000
+
+# with several shards, every process takes this number of ids of payments at once, see `PaymentIdBlock`
+PAYMENT_ID_BLOCK_SIZE = 1000
+
+# cross-shard transfers, that are prepared, but are not decided for this number of seconds, are aborted
+# by `recover_transfers` command
+CROSS_SHARD_PREPARE_TIMEOUT = 60
+
+# reads of the change feed of payments wait for new ones for at most this number of seconds, and check
+# the database for the ones of other processes every PAYMENT_FEED_CHECK_INTERVAL seconds, see `core.feed`
+PAYMENT_FEED_MAX_WAIT = 30
+PAYMENT_FEED_CHECK_INTERVAL = 1
+
+# every process checks for changed FX rates at most once in this number of seconds, and a process, that sets a rate,
+# uses it at once, see `FxRate`
+FX_RATE_CHECK_INTERVAL = 5
+
+# requests served by the ASGI handler are routed by this URLconf, whose read endpoints of lists are async views:
+# they read in a pool of this number of threads per process, each with a database connection of its own,
+# see `core.views.async_reads`. 0 makes them read in the thread of sync code, as sync views do
+ASYNC_URLCONF = 'core.async_urls'
+ASYNC_READ_THREADS = 8
+
+# cache of account balances, used by account read endpoints, see `core.balances`. Entries are checked against
+# change counters in the database, so changes of any process are seen. The cache may be shared by processes,
+# e.g. {'BACKEND': 'core.cache.DjangoCache', 'OPTIONS': {'alias': 'default'}}
+BALANCE_CACHE = {
+    'BACKEND': 'core.cache.LRUCache',
+    'OPTIONS': {'max_size': 100000},
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
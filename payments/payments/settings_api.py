@@ -0,0 +1,41 @@
+"""
+Django settings of API-only workers of the payments project.
+
+The JSON API uses no sessions, CSRF, authentication, messages or admin pages, so their apps and middleware
+are left out, and the REST framework renders and parses JSON only, without the browsable API.
+Processes start faster and requests pass through fewer middleware. Everything else is as in `payments.settings`.
+Use it with DJANGO_SETTINGS_MODULE=payments.settings_api.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'rest_framework',
+    'core.apps.CoreConfig',
+]
+
+MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.AsyncViewsMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': False,
+    },
+]
+
+REST_FRAMEWORK = dict(
+    REST_FRAMEWORK,  # noqa: F405
+    DEFAULT_RENDERER_CLASSES=['rest_framework.renderers.JSONRenderer'],
+    DEFAULT_PARSER_CLASSES=['rest_framework.parsers.JSONParser'],
+    DEFAULT_AUTHENTICATION_CLASSES=[],
+    DEFAULT_PERMISSION_CLASSES=['rest_framework.permissions.AllowAny'],
+    UNAUTHENTICATED_USER=None,
+)
+
+AUTH_PASSWORD_VALIDATORS = []